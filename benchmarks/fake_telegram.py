@@ -0,0 +1,169 @@
+"""Local stand-in for the Telegram Bot API used by the pipeline benchmark.
+
+Serves the calls the Lambdas make (sendMessage, answerCallbackQuery, getFile
+and file downloads) with configurable latency, 429 rate and file size, and
+records when each reply arrives so end-to-end latency can be measured.
+"""
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeTelegramConfig:
+    def __init__(self, latency_ms=0, rate_429=0.0, retry_after=1, file_size=50 * 1024, seed=None):
+        """
+        Args:
+            latency_ms (float): Delay added to every API call
+            rate_429 (float): Fraction of sendMessage calls answered with 429
+            retry_after (int): retry_after sent with each 429
+            file_size (int): Size in bytes of every downloaded file
+            seed: Seed for the 429 random generator
+        """
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.file_size = file_size
+        self.random = random.Random(seed)
+
+
+class FakeTelegramServer:
+    """Threaded HTTP server on localhost that behaves like api.telegram.org"""
+
+    def __init__(self, config=None):
+        self.config = config or FakeTelegramConfig()
+        self.lock = threading.Lock()
+        # (method, key) -> time.perf_counter() of every call with that key
+        self.replies = {}
+        self.calls = {}
+        self.rate_limited = 0
+        self.next_message_id = 1
+        self.file_body = b'x' * self.config.file_size
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method, key):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.replies.setdefault((method, key), []).append(time.perf_counter())
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                if server.config.latency_ms:
+                    time.sleep(server.config.latency_ms / 1000)
+
+                path = urlparse(self.path).path
+                if path.startswith('/file/'):
+                    server.record('download', path)
+                    self._send(200, server.file_body, 'application/octet-stream')
+                    return
+
+                method = path.rsplit('/', 1)[-1]
+                params = self._read_params()
+                handler = getattr(server, f"_api_{method}", None)
+                if handler is None:
+                    self._send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    return
+                status, payload = handler(params)
+                self._send_json(status, payload)
+
+            def _read_params(self):
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if not length:
+                    return params
+
+                body = self.rfile.read(length)
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif content_type.startswith('multipart/form-data'):
+                    message = BytesParser().parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+                    )
+                    for part in message.get_payload():
+                        name = part.get_param('name', header='content-disposition')
+                        params[name] = part.get_payload(decode=True).decode('utf-8')
+                else:
+                    params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+                return params
+
+            def _send_json(self, status, payload):
+                self._send(status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def _api_sendMessage(self, params):
+        if self.config.rate_429 and self.config.random.random() < self.config.rate_429:
+            with self.lock:
+                self.rate_limited += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.config.retry_after}",
+                'parameters': {'retry_after': self.config.retry_after}
+            }
+
+        chat_id = str(params['chat_id'])
+        reply_to = params.get('reply_to_message_id')
+        self.record('sendMessage', (chat_id, str(reply_to) if reply_to else None))
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id,
+            'from': {'id': 1, 'is_bot': True},
+            'chat': {'id': int(chat_id)},
+            'date': int(time.time()),
+            'text': params.get('text', '')
+        }}
+
+    def _api_answerCallbackQuery(self, params):
+        self.record('answerCallbackQuery', str(params['callback_query_id']))
+        return 200, {'ok': True, 'result': True}
+
+    def _api_getFile(self, params):
+        self.record('getFile', params['file_id'])
+        return 200, {'ok': True, 'result': {
+            'file_id': params['file_id'],
+            'file_size': self.config.file_size,
+            'file_path': f"documents/{params['file_id']}"
+        }}
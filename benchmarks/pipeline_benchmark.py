@@ -0,0 +1,395 @@
+"""End-to-end benchmark of the bot pipeline, run entirely in-process.
+
+All five Lambda handlers run against moto (SQS, DynamoDB, S3) and a local
+fake Telegram Bot API. A mix of updates is fed to the webhook, the queues are
+pumped into their consumers with the batch sizes used in the CDK stack, and
+per-stage and end-to-end latency percentiles are reported.
+
+    python -m benchmarks.pipeline_benchmark --updates 500 --latency-ms 40 --rate-429 0.01
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import sys
+import time
+
+from benchmarks.fake_telegram import FakeTelegramConfig, FakeTelegramServer
+from benchmarks.stats import percentile
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas')
+
+DEFAULT_MIX = 'text=40,command=10,photo=20,album=10,document=10,callback=10'
+
+# (stage name, module, queue env var, batch size as wired in lib/serverless-tg-bot-stack.ts)
+STAGES = [
+    ('attachment_processor', 'tg_attachment_processor', 'UPLOAD_QUEUE_URL', 1),
+    ('attachment_processor_large', 'tg_attachment_processor', 'LARGE_UPLOAD_QUEUE_URL', 1),
+    ('message_processor', 'tg_message_processor', 'PROCESSING_QUEUE_URL', 1),
+    ('callback_processor', 'tg_callback_processor', 'CALLBACK_QUEUE_URL', 1),
+    ('message_sender', 'tg_message_sender', 'OUTGOING_QUEUE_URL', 50),
+]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+class UpdateFactory:
+    """Builds Telegram updates with unique update, message and chat IDs"""
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.update_id = 1000
+        self.message_id = 1
+        self.chat_id = 10000
+        self.file_id = 1
+
+    def _next(self, attr):
+        value = getattr(self, attr)
+        setattr(self, attr, value + 1)
+        return value
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': self._next('message_id'),
+            'from': {'id': chat_id, 'is_bot': False},
+            'chat': {'id': chat_id},
+            'date': int(time.time()),
+        }
+        message.update(fields)
+        return message
+
+    def _photo(self, file_id):
+        return [
+            {'file_id': f"{file_id}_s", 'file_unique_id': f"{file_id}_su", 'file_size': 1024, 'width': 90, 'height': 90},
+            {'file_id': file_id, 'file_unique_id': f"{file_id}_u", 'file_size': 50 * 1024, 'width': 800, 'height': 800},
+        ]
+
+    def build(self, kind):
+        """Return a list of (kind, update, expected reply keys)"""
+        chat_id = self._next('chat_id')
+
+        if kind == 'text':
+            message = self._message(chat_id, text='hello')
+        elif kind == 'command':
+            message = self._message(chat_id, text=self.random.choice(['/start', '/help']))
+        elif kind == 'photo':
+            message = self._message(chat_id, photo=self._photo(f"photo{self._next('file_id')}"))
+        elif kind == 'document':
+            file_id = f"doc{self._next('file_id')}"
+            message = self._message(chat_id, document={
+                'file_id': file_id,
+                'file_unique_id': f"{file_id}_u",
+                'file_name': f"{file_id}.pdf",
+                'mime_type': 'application/pdf',
+                'file_size': 100 * 1024
+            })
+        elif kind == 'album':
+            media_group_id = f"album{chat_id}"
+            messages = [
+                self._message(chat_id, media_group_id=media_group_id, photo=self._photo(f"photo{self._next('file_id')}"))
+                for _ in range(self.random.randint(2, 5))
+            ]
+            # The whole album gets one reply, to its first message
+            return [self._wrap('album', message, reply_to=messages[0]) for message in messages]
+        elif kind == 'callback':
+            update_id = self._next('update_id')
+            message_id = self._next('message_id')
+            callback_id = f"cb{update_id}"
+            update = {
+                'update_id': update_id,
+                'callback_query': {
+                    'id': callback_id,
+                    'from': {'id': chat_id, 'is_bot': False},
+                    'message': {'message_id': message_id, 'chat': {'id': chat_id}, 'text': 'File'},
+                    'data': f"confirm_{message_id}"
+                }
+            }
+            return [('callback', update, [('answerCallbackQuery', callback_id)])]
+        else:
+            raise ValueError(f"Unknown update kind: {kind}")
+
+        return [self._wrap(kind, message)]
+
+    def _wrap(self, kind, message, reply_to=None):
+        update = {'update_id': self._next('update_id'), 'message': message}
+        reply_to = reply_to or message
+        reply_key = ('sendMessage', (str(message['chat']['id']), str(reply_to['message_id'])))
+        return (kind, update, [reply_key])
+
+
+class PipelineBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegramServer(FakeTelegramConfig(
+            latency_ms=args.latency_ms,
+            rate_429=args.rate_429,
+            retry_after=args.retry_after,
+            file_size=args.file_size,
+            seed=args.seed
+        ))
+        # stage -> list of (duration seconds, records)
+        self.invocations = {name: [] for name, _, _, _ in STAGES}
+        self.invocations['webhook'] = []
+        # update index -> (kind, start time, inline reply time, expected reply keys)
+        self.updates = []
+
+    def setup(self):
+        """Start the fake Telegram API and moto, create AWS resources, import the Lambdas"""
+        from moto import mock_aws
+        import boto3
+
+        self.telegram.start()
+        os.environ.update({
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_SECURITY_TOKEN': 'testing',
+            'AWS_SESSION_TOKEN': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'TELEGRAM_BOT_TOKEN': '1:benchmark',
+            'TELEGRAM_API_URL': self.telegram.url,
+            'GLOBAL_RATE_LIMIT': str(self.args.global_rate),
+            'CHAT_RATE_LIMIT': str(self.args.chat_rate),
+        })
+
+        self.mock = mock_aws()
+        self.mock.start()
+
+        dynamodb = boto3.resource('dynamodb')
+        dynamodb.create_table(
+            TableName='bench-message-logs',
+            KeySchema=[
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        dynamodb.create_table(
+            TableName='bench-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        boto3.client('s3').create_bucket(Bucket='bench-file-storage')
+
+        self.sqs = boto3.client('sqs')
+        os.environ.update({
+            'MESSAGE_LOGS_TABLE': 'bench-message-logs',
+            'STATE_TABLE': 'bench-bot-state',
+            'FILE_STORAGE_BUCKET': 'bench-file-storage',
+        })
+        for env_var, name in [
+            ('UPLOAD_QUEUE_URL', 'bench-upload'),
+            ('LARGE_UPLOAD_QUEUE_URL', 'bench-upload-large'),
+            ('PROCESSING_QUEUE_URL', 'bench-processing'),
+            ('CALLBACK_QUEUE_URL', 'bench-callback'),
+            ('OUTGOING_QUEUE_URL', 'bench-outgoing'),
+        ]:
+            os.environ[env_var] = self.sqs.create_queue(QueueName=name)['QueueUrl']
+
+        sys.path.insert(0, os.path.abspath(LAMBDAS_DIR))
+        self.validator = importlib.import_module('tg_message_validator')
+        self.stages = [
+            (name, importlib.import_module(module), os.environ[env_var], batch_size)
+            for name, module, env_var, batch_size in STAGES
+        ]
+
+    def teardown(self):
+        self.mock.stop()
+        self.telegram.stop()
+
+    def inject(self, kind, update, reply_keys):
+        event = {'body': json.dumps(update)}
+        start = time.perf_counter()
+        response = self.validator.lambda_handler(event, None)
+        end = time.perf_counter()
+        self.invocations['webhook'].append((end - start, 1))
+
+        inline_reply = end if 'method' in json.loads(response.get('body') or '{}') else None
+        self.updates.append((kind, start, inline_reply, reply_keys))
+
+    def receive(self, queue_url, batch_size):
+        records = []
+        while len(records) < batch_size:
+            response = self.sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=min(10, batch_size - len(records)),
+                VisibilityTimeout=2,
+                AttributeNames=['All']
+            )
+            messages = response.get('Messages', [])
+            if not messages:
+                break
+            records.extend({
+                'messageId': message['MessageId'],
+                'receiptHandle': message['ReceiptHandle'],
+                'body': message['Body'],
+                'attributes': message.get('Attributes', {}),
+                'messageAttributes': {},
+                'eventSource': 'aws:sqs',
+            } for message in messages)
+        return records
+
+    def pump(self):
+        """Run one batch through every stage that has messages. Returns True if any did"""
+        progressed = False
+        for name, module, queue_url, batch_size in self.stages:
+            records = self.receive(queue_url, batch_size)
+            if not records:
+                continue
+            progressed = True
+
+            start = time.perf_counter()
+            response = module.lambda_handler({'Records': records}, None)
+            self.invocations[name].append((time.perf_counter() - start, len(records)))
+
+            failed = {f['itemIdentifier'] for f in (response or {}).get('batchItemFailures', [])}
+            done = [r for r in records if r['messageId'] not in failed]
+            for i in range(0, len(done), 10):
+                self.sqs.delete_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{'Id': str(n), 'ReceiptHandle': r['receiptHandle']} for n, r in enumerate(done[i:i + 10])]
+                )
+        return progressed
+
+    def queues_empty(self):
+        for _, _, queue_url, _ in self.stages:
+            attributes = self.sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])['Attributes']
+            pending = sum(int(attributes.get(a, 0)) for a in (
+                'ApproximateNumberOfMessages',
+                'ApproximateNumberOfMessagesNotVisible',
+                'ApproximateNumberOfMessagesDelayed'
+            ))
+            if pending:
+                return False
+        return True
+
+    def run(self):
+        factory = UpdateFactory(self.args.seed)
+        weights = parse_mix(self.args.mix)
+        kinds = factory.random.choices(list(weights), weights=list(weights.values()), k=self.args.updates)
+        pending = [item for kind in kinds for item in factory.build(kind)][:self.args.updates]
+
+        self.started = time.perf_counter()
+        deadline = self.started + self.args.timeout
+        while time.perf_counter() < deadline:
+            # Feed one update, then let every stage take a batch
+            if pending:
+                self.inject(*pending.pop(0))
+            if not self.pump() and not pending:
+                if self.queues_empty():
+                    break
+                time.sleep(0.05)
+        self.finished = time.perf_counter()
+
+    def report(self):
+        stages = {}
+        for name, runs in self.invocations.items():
+            durations = [duration for duration, _ in runs]
+            records = sum(count for _, count in runs)
+            stages[name] = {
+                'invocations': len(runs),
+                'records': records,
+                'p50_ms': _ms(percentile(durations, 50)),
+                'p95_ms': _ms(percentile(durations, 95)),
+                'p99_ms': _ms(percentile(durations, 99)),
+                'records_per_second': round(records / sum(durations), 1) if durations else None,
+            }
+
+        first_reply, final_reply = [], []
+        unanswered = 0
+        for kind, start, inline_reply, reply_keys in self.updates:
+            times = [t for key in reply_keys for t in self.telegram.replies.get(key, [])]
+            if inline_reply:
+                times.append(inline_reply)
+            if not times:
+                unanswered += 1
+                continue
+            first_reply.append(min(times) - start)
+            final_reply.append(max(times) - start)
+
+        elapsed = self.finished - self.started
+        return {
+            'updates': len(self.updates),
+            'elapsed_seconds': round(elapsed, 3),
+            'updates_per_second': round(len(self.updates) / elapsed, 1) if elapsed else None,
+            'unanswered': unanswered,
+            'telegram_calls': dict(self.telegram.calls),
+            'telegram_429s': self.telegram.rate_limited,
+            'stages': stages,
+            'end_to_end': {
+                name: {
+                    'p50_ms': _ms(percentile(values, 50)),
+                    'p95_ms': _ms(percentile(values, 95)),
+                    'p99_ms': _ms(percentile(values, 99)),
+                }
+                for name, values in [('first_reply', first_reply), ('final_reply', final_reply)]
+            },
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def print_report(report):
+    print(f"{report['updates']} updates in {report['elapsed_seconds']}s "
+          f"({report['updates_per_second']} updates/s), {report['unanswered']} unanswered, "
+          f"{report['telegram_429s']} Telegram 429s")
+    print()
+    print(f"{'stage':<22}{'invocations':>12}{'records':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'records/s':>11}")
+    for name, stage in report['stages'].items():
+        print(f"{name:<22}{stage['invocations']:>12}{stage['records']:>9}"
+              f"{_fmt(stage['p50_ms']):>9}{_fmt(stage['p95_ms']):>9}{_fmt(stage['p99_ms']):>9}"
+              f"{_fmt(stage['records_per_second']):>11}")
+    print()
+    print(f"{'end to end':<22}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, stats in report['end_to_end'].items():
+        print(f"{name:<22}{_fmt(stats['p50_ms']):>9}{_fmt(stats['p95_ms']):>9}{_fmt(stats['p99_ms']):>9}")
+
+
+def _fmt(value):
+    return '-' if value is None else str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bot pipeline in-process')
+    parser.add_argument('--updates', type=int, default=200, help='Number of updates to feed to the webhook')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Update kind weights, e.g. text=50,photo=50')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to every Telegram API call')
+    parser.add_argument('--rate-429', type=float, default=0, help='Fraction of sendMessage calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after returned with each 429')
+    parser.add_argument('--file-size', type=int, default=50 * 1024, help='Size of downloaded files in bytes')
+    parser.add_argument('--global-rate', type=float, default=28, help='Sender global rate limit (msg/s)')
+    parser.add_argument('--chat-rate', type=float, default=1, help='Sender per-chat rate limit (msg/s)')
+    parser.add_argument('--timeout', type=float, default=300, help='Give up after this many seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    benchmark = PipelineBenchmark(args)
+    benchmark.setup()
+    try:
+        benchmark.run()
+    finally:
+        benchmark.teardown()
+
+    report = benchmark.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
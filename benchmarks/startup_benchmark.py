@@ -0,0 +1,153 @@
+"""Cold-start benchmark of the Lambda handlers.
+
+Every run imports one handler in a fresh interpreter, as Lambda does during
+the init phase, and records how long the import and module-level init took,
+how many modules were loaded and which AWS clients were created. With
+--clients it also times creating the clients the handler needs on its first
+invocation. No AWS or Telegram calls are made.
+
+    python -m benchmarks.startup_benchmark --runs 10
+    python -m benchmarks.startup_benchmark --handler tg_message_sender --importtime 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.stats import percentile
+
+LAMBDAS_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+
+# Handler -> (kind, service) of the AWS clients its first invocation creates
+HANDLERS = {
+    'tg_message_validator': [('resource', 'dynamodb'), ('client', 'sqs')],
+    'tg_message_processor': [('client', 'sqs')],
+    'tg_attachment_processor': [('client', 's3'), ('client', 'sqs')],
+    'tg_callback_processor': [('client', 'sqs')],
+    'tg_message_sender': [('client', 'sqs')],
+}
+
+# Enough configuration for every handler to import, pointing nowhere
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'TELEGRAM_BOT_TOKEN': 'startup_benchmark',
+    'MESSAGE_LOGS_TABLE': 'startup-message-logs',
+    'STATE_TABLE': 'startup-bot-state',
+    'FILE_STORAGE_BUCKET': 'startup-file-storage',
+    'PROCESSING_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/processing',
+    'UPLOAD_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/upload',
+    'LARGE_UPLOAD_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/upload-large',
+    'CALLBACK_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/callback',
+    'OUTGOING_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/outgoing',
+}
+
+# Runs in the fresh interpreter and prints one JSON line
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {lambdas_dir!r})
+import importlib
+importlib.import_module({handler!r})
+init = time.perf_counter() - start
+
+from common import aws
+created = sorted(f"{{kind}}:{{service}}" for kind, service, _ in aws._clients)
+start = time.perf_counter()
+for kind, service in {clients!r}:
+    getattr(aws, kind)(service)
+clients = time.perf_counter() - start
+print(json.dumps({{'init': init, 'clients': clients, 'modules': len(sys.modules), 'created_during_init': created}}))
+"""
+
+
+def probe(handler, with_clients, importtime=False):
+    """Import a handler in a new interpreter. Returns its measurements and the -X importtime log"""
+    code = PROBE.format(lambdas_dir=LAMBDAS_DIR, handler=handler, clients=HANDLERS[handler] if with_clients else [])
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.perf_counter()
+    result = subprocess.run(
+        command,
+        env={**os.environ, **ENVIRONMENT},
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    elapsed = time.perf_counter() - start
+    measurements = json.loads(result.stdout.strip().splitlines()[-1])
+    measurements['process'] = elapsed
+    return measurements, result.stderr
+
+
+def slowest_imports(log, count):
+    """Top imports by cumulative time from a -X importtime log, as (module, ms)"""
+    imports = []
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: -item[1])[:count]
+
+
+def run(handlers, runs, with_clients, importtime_count=0):
+    report = {}
+    for handler in handlers:
+        samples = [probe(handler, with_clients)[0] for _ in range(runs)]
+        stats = {}
+        for name in ('process', 'init', 'clients'):
+            values = [sample[name] for sample in samples]
+            stats[f"{name}_p50_ms"] = _ms(percentile(values, 50))
+            stats[f"{name}_max_ms"] = _ms(max(values))
+        stats['modules'] = samples[-1]['modules']
+        stats['created_during_init'] = samples[-1]['created_during_init']
+        if importtime_count:
+            stats['slowest_imports'] = slowest_imports(probe(handler, with_clients, importtime=True)[1], importtime_count)
+        report[handler] = stats
+    return report
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(report, with_clients):
+    header = f"{'handler':<26}{'process ms':>12}{'init ms':>10}{'init max':>10}"
+    if with_clients:
+        header += f"{'clients ms':>12}"
+    print(header + f"{'modules':>9}  clients created during init")
+    for handler, stats in report.items():
+        line = f"{handler:<26}{stats['process_p50_ms']:>12}{stats['init_p50_ms']:>10}{stats['init_max_ms']:>10}"
+        if with_clients:
+            line += f"{stats['clients_p50_ms']:>12}"
+        print(line + f"{stats['modules']:>9}  {', '.join(stats['created_during_init']) or '-'}")
+
+    for handler, stats in report.items():
+        if 'slowest_imports' in stats:
+            print()
+            print(f"Slowest imports of {handler} (cumulative ms):")
+            for name, ms in stats['slowest_imports']:
+                print(f"  {ms:>9.1f}  {name}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure handler import and init time in fresh interpreters')
+    parser.add_argument('--handler', action='append', choices=sorted(HANDLERS), help='Handler to measure, all by default')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per handler')
+    parser.add_argument('--clients', action='store_true', help='Also time creating the clients of the first invocation')
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='Show the N slowest imports of each handler')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = run(args.handler or list(HANDLERS), args.runs, args.clients, args.importtime)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args.clients)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import os
+import time
+from botocore.exceptions import ClientError
+from common.metrics import timed
+
+# Albums are handled once every file the validator saw has been uploaded or
+# has failed. Each file's settle check runs this long after its upload, giving
+# the album's other messages time to reach the validator.
+ALBUM_SETTLE_SECONDS = int(os.environ.get('ALBUM_SETTLE_SECONDS', 2))
+ALBUM_TTL_SECONDS = 60 * 60
+
+def album_key(media_group_id):
+    return {'pk': f"album#{media_group_id}"}
+
+def expect_album_part(table, media_group_id, chat_id, message_id):
+    """Record at ingress that a file of the album is on its way to be uploaded"""
+    with timed('dynamodb.expect_album_part'):
+        table.update_item(
+            Key=album_key(media_group_id),
+            UpdateExpression='SET chat_id = :chat_id, #ttl = :ttl ADD expected :ids',
+            ExpressionAttributeNames={'#ttl': 'ttl'},
+            ExpressionAttributeValues={
+                ':chat_id': str(chat_id),
+                ':ttl': int(time.time()) + ALBUM_TTL_SECONDS,
+                ':ids': {message_id}
+            }
+        )
+
+def add_album_part(table, media_group_id, chat_id, message_id, s3_key):
+    """Add an uploaded file to its album's aggregate in the state table
+
+    Returns:
+        dict: The aggregate after the update
+    """
+    with timed('dynamodb.add_album_part'):
+        response = table.update_item(
+            Key=album_key(media_group_id),
+            UpdateExpression=(
+                'SET chat_id = :chat_id, #ttl = :ttl, '
+                'parts = list_append(if_not_exists(parts, :empty), :part) '
+                'ADD done :ids'
+            ),
+            ExpressionAttributeNames={'#ttl': 'ttl'},
+            ExpressionAttributeValues={
+                ':chat_id': str(chat_id),
+                ':ttl': int(time.time()) + ALBUM_TTL_SECONDS,
+                ':empty': [],
+                ':part': [{'message_id': message_id, 's3_key': s3_key}],
+                ':ids': {message_id}
+            },
+            ReturnValues='ALL_NEW'
+        )
+    return response['Attributes']
+
+def fail_album_part(table, media_group_id, message_id):
+    """Mark a file that could not be uploaded as done, so the rest of its album can settle
+
+    Returns:
+        dict: The aggregate after the update
+    """
+    with timed('dynamodb.fail_album_part'):
+        response = table.update_item(
+            Key=album_key(media_group_id),
+            UpdateExpression='SET #ttl = :ttl ADD done :ids',
+            ExpressionAttributeNames={'#ttl': 'ttl'},
+            ExpressionAttributeValues={
+                ':ttl': int(time.time()) + ALBUM_TTL_SECONDS,
+                ':ids': {message_id}
+            },
+            ReturnValues='ALL_NEW'
+        )
+    return response['Attributes']
+
+def claim_settled_album(table, media_group_id, token):
+    """Take a settled album for handling
+
+    An album is settled once every expected file is done and at least one was
+    uploaded. The claim is stored as `token`, so a retry of the same settle
+    check takes the album again if its reply was never sent.
+
+    Args:
+        token: Identifies the settle check, stable across its redeliveries
+
+    Returns:
+        dict: The album as {'chat_id', 'media_group_id', 'parts'} with parts
+        sorted by message_id, or None if it isn't settled or was taken by another check
+    """
+    with timed('dynamodb.get_album'):
+        album = table.get_item(Key=album_key(media_group_id), ConsistentRead=True).get('Item')
+    if album is None or album.get('emitted', token) != token or not album.get('parts'):
+        return None
+    if not album.get('expected', set()) <= album.get('done', set()):
+        return None
+
+    try:
+        with timed('dynamodb.claim_album'):
+            table.update_item(
+                Key=album_key(media_group_id),
+                UpdateExpression='SET emitted = :token',
+                ConditionExpression='attribute_not_exists(emitted) OR emitted = :token',
+                ExpressionAttributeValues={':token': token}
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return None
+
+    # A redelivered upload adds its file again, keep one part per message
+    parts = {}
+    for part in album['parts']:
+        parts[int(part['message_id'])] = part['s3_key']
+    return {
+        'chat_id': album['chat_id'],
+        'media_group_id': media_group_id,
+        'parts': [{'message_id': message_id, 's3_key': parts[message_id]} for message_id in sorted(parts)]
+    }
@@ -0,0 +1,138 @@
+import time
+from botocore.exceptions import ClientError
+from common.metrics import timed
+
+# Index of uploaded attachments in the state table, so a file can be found
+# without listing the bucket:
+#   attachment#{chat_id}#{message_id} -> s3_key, size, status, file_unique_id, media_group_id
+#   file#{file_unique_id}             -> s3_key, size of a stored copy of the content
+#   attachment_album#{media_group_id} -> chat_id, message_ids
+# Entries expire together with the files, which the bucket deletes after 30 days.
+STATUS_UPLOADED = 'uploaded'
+STATUS_CONFIRMED = 'confirmed'
+STATUS_DELETED = 'deleted'
+MAX_BATCH_GET_KEYS = 100
+MAX_DELETE_OBJECTS = 1000
+FILE_RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+def attachment_pk(chat_id, message_id):
+    return f"attachment#{chat_id}#{message_id}"
+
+def is_expired(item, now=None):
+    """Whether an entry's file has expired; DynamoDB removes expired items only eventually"""
+    now = time.time() if now is None else now
+    return 'ttl' in item and int(item['ttl']) <= now
+
+def record_upload(table, chat_id, message_id, s3_key, size=None, file_unique_id=None, media_group_id=None):
+    """Add an uploaded file to the index
+
+    A redelivered upload writes the same items again, so this is safe to repeat.
+    """
+    expires_at = int(time.time()) + FILE_RETENTION_SECONDS
+    item = {
+        'pk': attachment_pk(chat_id, message_id),
+        'chat_id': str(chat_id),
+        'message_id': int(message_id),
+        's3_key': s3_key,
+        'status': STATUS_UPLOADED,
+        'ttl': expires_at,
+    }
+    if size is not None:
+        item['size'] = int(size)
+    if file_unique_id:
+        item['file_unique_id'] = file_unique_id
+    if media_group_id:
+        item['media_group_id'] = media_group_id
+
+    with timed('dynamodb.index_attachment'):
+        with table.batch_writer() as batch:
+            batch.put_item(Item=item)
+            if file_unique_id:
+                batch.put_item(Item={
+                    'pk': f"file#{file_unique_id}",
+                    's3_key': s3_key,
+                    'ttl': expires_at,
+                    **({'size': item['size']} if 'size' in item else {})
+                })
+        if media_group_id:
+            table.update_item(
+                Key={'pk': f"attachment_album#{media_group_id}"},
+                UpdateExpression='SET chat_id = :chat_id, #ttl = :ttl ADD message_ids :message_id',
+                ExpressionAttributeNames={'#ttl': 'ttl'},
+                ExpressionAttributeValues={':chat_id': str(chat_id), ':ttl': expires_at, ':message_id': {int(message_id)}}
+            )
+
+def find_upload(table, file_unique_id):
+    """Return the S3 key of a stored copy of this content, or None"""
+    with timed('dynamodb.find_upload'):
+        item = table.get_item(Key={'pk': f"file#{file_unique_id}"}).get('Item')
+    return item['s3_key'] if item and not is_expired(item) else None
+
+def get_attachments(table, chat_id, message_ids):
+    """Look up the index entries of a chat's messages with BatchGetItem
+
+    Returns:
+        list: Items that exist and haven't expired, sorted by message_id
+    """
+    keys = [{'pk': attachment_pk(chat_id, message_id)} for message_id in dict.fromkeys(message_ids)]
+    items = []
+    for i in range(0, len(keys), MAX_BATCH_GET_KEYS):
+        request = {table.name: {'Keys': keys[i:i + MAX_BATCH_GET_KEYS]}}
+        while request:
+            # The resource's client takes and returns plain Python values, like the Table does
+            with timed('dynamodb.get_attachments'):
+                response = table.meta.client.batch_get_item(RequestItems=request)
+            items.extend(response['Responses'].get(table.name, []))
+            request = response.get('UnprocessedKeys')
+    now = time.time()
+    return sorted((item for item in items if not is_expired(item, now)), key=lambda item: int(item['message_id']))
+
+def get_album_attachments(table, chat_id, media_group_id):
+    """Look up the index entries of every file of an album sent to chat_id"""
+    with timed('dynamodb.get_album'):
+        album = table.get_item(Key={'pk': f"attachment_album#{media_group_id}"}).get('Item')
+    if not album or album['chat_id'] != str(chat_id):
+        return []
+    return get_attachments(table, chat_id, sorted(int(message_id) for message_id in album['message_ids']))
+
+def set_status(table, items, status):
+    """Store a new status for index entries returned by get_attachments"""
+    with timed('dynamodb.set_attachment_status'):
+        with table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item={**item, 'status': status})
+
+def delete_attachments(s3, bucket, table, items):
+    """Delete the files of index entries from S3 in as few calls as possible and mark them deleted
+
+    The file#{file_unique_id} entries pointing at a deleted object are removed
+    too, so later uploads of the same content aren't copied from it.
+
+    Returns:
+        list: The keys S3 failed to delete; their entries keep their status
+    """
+    keys = [item['s3_key'] for item in items]
+    failed = set()
+    for i in range(0, len(keys), MAX_DELETE_OBJECTS):
+        with timed('s3.delete_objects'):
+            response = s3.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i + MAX_DELETE_OBJECTS]], 'Quiet': True}
+            )
+        failed.update(error['Key'] for error in response.get('Errors', []))
+
+    deleted = [item for item in items if item['s3_key'] not in failed]
+    set_status(table, deleted, STATUS_DELETED)
+    for item in deleted:
+        if 'file_unique_id' not in item:
+            continue
+        try:
+            table.delete_item(
+                Key={'pk': f"file#{item['file_unique_id']}"},
+                ConditionExpression='s3_key = :key',
+                ExpressionAttributeValues={':key': item['s3_key']}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    return sorted(failed)
@@ -0,0 +1,68 @@
+"""Shared, lazily created AWS clients
+
+Creating a boto3 client loads its service model, and a resource loads two;
+together they are a large part of a cold start. Clients and resources here
+are created on first use, once per process, from a single boto3 session, so
+handlers only pay for the services an invocation actually calls.
+"""
+import threading
+
+_session = None
+_clients = {}
+_lock = threading.Lock()
+
+def get_session():
+    """The boto3 session every client and resource is created from"""
+    global _session
+    if _session is None:
+        # boto3 itself is only imported once an AWS call is about to be made
+        import boto3
+        _session = boto3.session.Session()
+    return _session
+
+def client(service_name, config=None):
+    """Return the low-level client for a service, creating it on first use
+
+    Args:
+        service_name (str): e.g. 's3' or 'sqs'
+        config: Optional botocore Config; each distinct config gets its own client
+    """
+    key = ('client', service_name, config)
+    if key not in _clients:
+        # Creating a client isn't thread-safe, and the handlers' worker threads may race here
+        with _lock:
+            if key not in _clients:
+                _clients[key] = get_session().client(service_name, config=config)
+    return _clients[key]
+
+def resource(service_name):
+    """Return the resource for a service, creating it on first use"""
+    key = ('resource', service_name, None)
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                _clients[key] = get_session().resource(service_name)
+    return _clients[key]
+
+class Lazy:
+    """Stand-in for an object that is only created when one of its attributes is used"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            self._target = self._factory()
+        return getattr(self._target, name)
+
+def lazy_client(service_name, config=None):
+    """A client() that isn't created until it's first called"""
+    return Lazy(lambda: client(service_name, config))
+
+def lazy_resource(service_name):
+    """A resource() that isn't created until it's first used"""
+    return Lazy(lambda: resource(service_name))
+
+def lazy_table(table_name):
+    """A DynamoDB Table that isn't created until it's first used"""
+    return Lazy(lambda: resource('dynamodb').Table(table_name))
@@ -0,0 +1,119 @@
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+class TTLCache:
+    """In-process LRU cache whose entries expire after a TTL
+
+    Kept at module level in a Lambda, it lasts across warm invocations.
+    """
+    def __init__(self, max_size=1024, ttl_seconds=300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+class DynamoDBTTLCache:
+    """Cache shared between Lambda instances, stored as DynamoDB items with a TTL attribute
+
+    Items live in the bot state table under `{namespace}#{key}`, with their
+    absolute expiry as the `ttl` attribute. DynamoDB removes expired items
+    lazily, so expiry is also checked on read. Errors are logged and treated as
+    cache misses.
+    """
+    def __init__(self, table, namespace, ttl_seconds=300):
+        self.table = table
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+
+    def _pk(self, key):
+        return f"{self.namespace}#{key}"
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def get_entry(self, key):
+        """Return (value, expiry as a Unix timestamp), or None if missing or expired"""
+        try:
+            item = self.table.get_item(Key={'pk': self._pk(key)}).get('Item')
+        except ClientError as e:
+            print(f"Error reading cache: {e}")
+            return None
+
+        if not item or item['ttl'] <= int(time.time()):
+            return None
+        return item['value'], int(item['ttl'])
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        try:
+            self.table.put_item(Item={
+                'pk': self._pk(key),
+                'value': value,
+                'ttl': int(time.time() + ttl)
+            })
+        except ClientError as e:
+            print(f"Error writing cache: {e}")
+
+    def delete(self, key):
+        try:
+            self.table.delete_item(Key={'pk': self._pk(key)})
+        except ClientError as e:
+            print(f"Error deleting from cache: {e}")
+
+class TieredCache:
+    """In-process cache in front of an optional shared cache
+
+    A value read from the shared tier is kept locally only for the time it has
+    left there, so the two tiers together never keep it past its TTL.
+    """
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            entry = self.shared.get_entry(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            self.local.set(key, value, ttl_seconds=expires_at - time.time())
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
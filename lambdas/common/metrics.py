@@ -0,0 +1,111 @@
+import functools
+import json
+import os
+import random
+import time
+from contextlib import nullcontext
+
+# Fraction of invocations to time, 0 disables metrics. Cold starts are always timed when enabled.
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 0))
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ServerlessTgBot')
+
+# Importing this module is part of container init, so it marks the start of init
+_init_started = time.perf_counter()
+_cold_start = True
+# Recorder of the invocation being timed, None when it isn't sampled
+_current = None
+_NOOP = nullcontext()
+
+class Recorder:
+    """Span durations of one sampled invocation, emitted as CloudWatch Embedded Metric Format"""
+    def __init__(self, function_name, cold_start):
+        self.function_name = function_name
+        self.start_type = 'cold' if cold_start else 'warm'
+        self.durations = {}
+
+    def add(self, stage, duration_ms):
+        self.durations.setdefault(stage, []).append(round(duration_ms, 3))
+
+    def flush(self):
+        """Print one EMF line per stage; CloudWatch turns them into metrics"""
+        timestamp = int(time.time() * 1000)
+        for stage, values in self.durations.items():
+            print(json.dumps({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': NAMESPACE,
+                        'Dimensions': [['function', 'stage'], ['function', 'stage', 'start_type']],
+                        'Metrics': [{'Name': 'duration', 'Unit': 'Milliseconds'}]
+                    }]
+                },
+                'function': self.function_name,
+                'stage': stage,
+                'start_type': self.start_type,
+                'duration': values if len(values) > 1 else values[0]
+            }))
+
+class _Span:
+    __slots__ = ('recorder', 'stage', 'start')
+
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.add(self.stage, (time.perf_counter() - self.start) * 1000)
+        return False
+
+def timed(stage):
+    """Context manager timing a span of the current invocation
+
+    Costs one global lookup when the invocation isn't sampled.
+
+    Example:
+        with timed('dynamodb.put'):
+            table.put_item(Item=item)
+    """
+    recorder = _current
+    if recorder is None:
+        return _NOOP
+    return _Span(recorder, stage)
+
+def record(stage, duration_ms):
+    """Add a duration measured elsewhere, e.g. from timestamps, to the current invocation"""
+    recorder = _current
+    if recorder is not None:
+        recorder.add(stage, duration_ms)
+
+def instrument_handler(handler):
+    """Decorator for lambda_handler that times sampled invocations and emits their spans
+
+    Adds an 'init' span on cold start (module import to first invocation)
+    and a 'handler' span for the whole invocation.
+    """
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', handler.__module__)
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _current, _cold_start
+        cold_start, _cold_start = _cold_start, False
+        if SAMPLE_RATE <= 0 or not (cold_start or random.random() < SAMPLE_RATE):
+            return handler(event, context)
+
+        recorder = Recorder(function_name, cold_start)
+        if cold_start:
+            recorder.add('init', (time.perf_counter() - _init_started) * 1000)
+
+        _current = recorder
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            recorder.add('handler', (time.perf_counter() - start) * 1000)
+            _current = None
+            recorder.flush()
+
+    return wrapper
@@ -0,0 +1,143 @@
+import datetime
+from dataclasses import dataclass, field
+
+# Attachment fields in the order they are checked, with how to pick the file from each
+ATTACHMENT_TYPES = (
+    ('photo', lambda x: x[-1]),  # Get the largest photo
+    ('video', lambda x: x),
+    ('document', lambda x: x),
+    ('audio', lambda x: x),
+    ('voice', lambda x: x),
+)
+
+LOG_TTL_DAYS = 90
+
+@dataclass(slots=True)
+class FileInfo:
+    """Attachment of a Telegram message"""
+    type: str
+    raw: object  # Original attachment payload, kept by reference
+    file_id: str = None
+    file_unique_id: str = None
+    file_size: int = None
+    mime_type: str = None
+    file_name: str = None
+    media_group_id: str = None
+    caption: str = None
+    _dict: dict = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def parse(cls, message_data):
+        """Build from a raw Telegram message, or return None if it has no attachment"""
+        for att_type, pick in ATTACHMENT_TYPES:
+            attachment = message_data.get(att_type)
+            if attachment is not None:
+                file_data = pick(attachment)
+                return cls(
+                    type=att_type,
+                    raw=attachment,
+                    file_id=file_data.get('file_id'),
+                    file_unique_id=file_data.get('file_unique_id'),
+                    file_size=file_data.get('file_size'),
+                    mime_type=file_data.get('mime_type'),
+                    file_name=file_data.get('file_name'),
+                    media_group_id=message_data.get('media_group_id'),
+                    caption=message_data.get('caption'),
+                )
+        return None
+
+    def to_dict(self):
+        """The file_info dict used in queue messages and logs, built once"""
+        if self._dict is None:
+            self._dict = {
+                'type': self.type,
+                self.type: self.raw,  # Save original data
+                'file_id': self.file_id,
+                'file_unique_id': self.file_unique_id,
+                'file_size': self.file_size,
+                'mime_type': self.mime_type,
+                'file_name': self.file_name,
+                'media_group_id': self.media_group_id,
+                'caption': self.caption,
+            }
+        return self._dict
+
+@dataclass(slots=True)
+class Message:
+    """Telegram message parsed once and passed around instead of the raw dict"""
+    user_id: str
+    chat_id: str
+    message_id: int
+    is_bot: bool = False
+    media_group_id: str = None
+    text: str = ''
+    caption: str = ''
+    date: int = None
+    file_info: FileInfo = None
+
+    @classmethod
+    def parse(cls, message_data):
+        """Build from a raw Telegram message in a single pass"""
+        from_data = message_data.get('from') or {}
+        chat_data = message_data.get('chat') or {}
+        user_id = from_data.get('id')
+        chat_id = chat_data.get('id')
+
+        return cls(
+            user_id=str(user_id) if user_id is not None else None,
+            chat_id=str(chat_id) if chat_id is not None else None,
+            message_id=message_data.get('message_id'),
+            is_bot=from_data.get('is_bot', False),
+            media_group_id=message_data.get('media_group_id'),
+            text=message_data.get('text', ''),
+            caption=message_data.get('caption', ''),
+            date=message_data.get('date'),
+            file_info=FileInfo.parse(message_data),
+        )
+
+    @property
+    def is_valid(self):
+        """Whether the message has the user and chat every handler needs"""
+        return self.user_id is not None and self.chat_id is not None
+
+    def to_queue_dict(self, message_type='user_message'):
+        """Serialize to the dict sent between Lambdas"""
+        data = {
+            'user_id': str(self.user_id),
+            'chat_id': str(self.chat_id),
+            'message_id': self.message_id,
+            'sender_id': str(self.user_id),
+            'is_bot': self.is_bot,
+            'media_group_id': self.media_group_id,
+            'text': self.text,
+            'caption': self.caption,
+            'message_type': message_type
+        }
+        if self.file_info:
+            data['file_info'] = self.file_info.to_dict()
+        return data
+
+    def to_log_item(self, message_type='user_message', now=None):
+        """Serialize to the DynamoDB message log item"""
+        now = now or datetime.datetime.now()
+        item = {
+            'user_id': str(self.user_id),
+            'timestamp': now.isoformat(),
+            'message_type': message_type,
+            'message': self.caption if self.caption else self.text,
+            'telegram_message_id': self.message_id,
+            'chat_id': str(self.chat_id),
+            'sender_id': str(self.user_id),
+            'is_bot': self.is_bot,
+            'ttl': int((now + datetime.timedelta(days=LOG_TTL_DAYS)).timestamp())
+        }
+
+        # Only add media_group_id if it exists and is not None
+        if self.media_group_id:
+            item['media_group_id'] = self.media_group_id
+
+        # Add file info if present
+        if self.file_info:
+            item['file_info'] = self.file_info.to_dict()
+
+        return item
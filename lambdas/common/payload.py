@@ -0,0 +1,143 @@
+import base64
+import json
+import os
+import uuid
+import zlib
+from common import aws
+from common.metrics import timed
+
+# Version written by encode(); 0 keeps sending the legacy plain JSON so consumers
+# can be deployed first while both formats are in flight
+PAYLOAD_VERSION = int(os.environ.get('QUEUE_PAYLOAD_VERSION', 1))
+VERSION_KEY = 'v'
+# Bucket for claim-check offload of messages over the SQS limit
+PAYLOAD_BUCKET = os.environ.get('PAYLOAD_BUCKET')
+PAYLOAD_PREFIX = 'payloads/'
+# Compressed when the JSON is at least this long and compression makes it smaller
+COMPRESS_MIN_BYTES = 2048
+# Leaves room below the 256KB SQS limit for the pointer and message attributes
+MAX_INLINE_BYTES = 250 * 1024
+
+# Long key -> short key of the compact format; keys not listed are kept as they are
+KEYS = {
+    'user_id': 'u',
+    'chat_id': 'c',
+    'message_id': 'm',
+    'is_bot': 'b',
+    'media_group_id': 'g',
+    'text': 't',
+    'caption': 'cp',
+    'message_type': 'mt',
+    'file_info': 'f',
+    'message': 'msg',
+    'reply_to_message_id': 'r',
+    'reply_markup': 'rm',
+    'callback_id': 'cb',
+    'data': 'd',
+    'uploaded_file': 'up',
+    '_trace': 'tr',
+    'attempt': 'a',
+}
+FILE_KEYS = {
+    'type': 'ty',
+    'file_id': 'id',
+    'file_unique_id': 'uid',
+    'file_size': 'sz',
+    'mime_type': 'mime',
+    'file_name': 'fn',
+}
+LONG_KEYS = {short: long for long, short in KEYS.items()}
+
+# Fields of user messages that are dropped when empty and restored on decode
+USER_MESSAGE_DEFAULTS = {'is_bot': False, 'media_group_id': None, 'text': '', 'caption': ''}
+
+_s3 = None
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        _s3 = aws.client('s3')
+    return _s3
+
+def compact(message_body):
+    """Shorten keys and drop fields that are empty or can be rebuilt by expand()
+
+    In user messages sender_id always equals user_id, and file_info repeats
+    the caption and media_group_id of the message and embeds the raw
+    attachment (every photo size), none of which consumers read.
+    """
+    user_message = 'message_type' in message_body
+    data = {}
+    for key, value in message_body.items():
+        if value is None or (user_message and key == 'sender_id'):
+            continue
+        if user_message and key in USER_MESSAGE_DEFAULTS and value == USER_MESSAGE_DEFAULTS[key]:
+            continue
+        if key == 'file_info' and isinstance(value, dict):
+            value = {
+                FILE_KEYS[file_key]: file_value
+                for file_key, file_value in value.items()
+                if file_key in FILE_KEYS and file_value is not None
+            }
+        data[KEYS.get(key, key)] = value
+    data[VERSION_KEY] = PAYLOAD_VERSION
+    return data
+
+def expand(data):
+    """Inverse of compact()"""
+    message_body = {}
+    for key, value in data.items():
+        if key == VERSION_KEY:
+            continue
+        key = LONG_KEYS.get(key, key)
+        if key == 'file_info':
+            value = {file_key: value.get(short) for file_key, short in FILE_KEYS.items()}
+        message_body[key] = value
+
+    if 'message_type' in message_body:
+        for key, default in USER_MESSAGE_DEFAULTS.items():
+            message_body.setdefault(key, default)
+        message_body['sender_id'] = message_body.get('user_id')
+    if 'file_info' in message_body:
+        message_body['file_info']['media_group_id'] = message_body.get('media_group_id')
+        message_body['file_info']['caption'] = message_body.get('caption') or None
+    return message_body
+
+def encode(message_body):
+    """Serialize a queue message body to the string sent to SQS
+
+    Dicts are compacted, compressed when that helps, and offloaded to
+    PAYLOAD_BUCKET when still too large, leaving only a pointer in the message.
+    """
+    if not isinstance(message_body, dict) or PAYLOAD_VERSION == 0:
+        return json.dumps(message_body)
+
+    body = json.dumps(compact(message_body), separators=(',', ':'), ensure_ascii=False)
+    if len(body) >= COMPRESS_MIN_BYTES:
+        compressed = base64.b64encode(zlib.compress(body.encode('utf-8'))).decode('ascii')
+        if len(compressed) + 16 < len(body):
+            body = json.dumps({VERSION_KEY: PAYLOAD_VERSION, 'z': compressed}, separators=(',', ':'))
+
+    if len(body.encode('utf-8')) <= MAX_INLINE_BYTES:
+        return body
+
+    if not PAYLOAD_BUCKET:
+        raise Exception(f"Queue message of {len(body)} bytes is over the SQS limit and PAYLOAD_BUCKET is not set")
+    key = f"{PAYLOAD_PREFIX}{uuid.uuid4().hex}.json"
+    with timed('s3.put_payload'):
+        get_s3().put_object(Bucket=PAYLOAD_BUCKET, Key=key, Body=body.encode('utf-8'))
+    return json.dumps({VERSION_KEY: PAYLOAD_VERSION, 's3': {'b': PAYLOAD_BUCKET, 'k': key}})
+
+def decode(body):
+    """Parse a queue message body in either the compact or the legacy format"""
+    data = json.loads(body)
+    if not isinstance(data, dict) or VERSION_KEY not in data:
+        return data  # Legacy plain JSON
+
+    if 's3' in data:
+        with timed('s3.get_payload'):
+            response = get_s3().get_object(Bucket=data['s3']['b'], Key=data['s3']['k'])
+        data = json.loads(response['Body'].read())
+    if 'z' in data:
+        data = json.loads(zlib.decompress(base64.b64decode(data['z'])))
+    return expand(data)
@@ -0,0 +1,102 @@
+import cProfile
+import functools
+import json
+import marshal
+import os
+import random
+import resource
+import time
+import tracemalloc
+import uuid
+from common import aws
+
+# Fraction of invocations to profile, 0 disables profiling
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# 'cpu' (cProfile), 'memory' (tracemalloc) or both, comma separated
+MODES = {mode.strip() for mode in os.environ.get('PROFILE_MODE', 'cpu').split(',') if mode.strip()}
+# s3://bucket/prefix or a local directory
+OUTPUT = os.environ.get('PROFILE_OUTPUT', '/tmp/profiles')
+TOP_ALLOCATIONS = int(os.environ.get('PROFILE_TOP_ALLOCATIONS', 25))
+TRACEBACK_DEPTH = 1
+
+def profile_key(function_name, request_id):
+    """Per-function, per-invocation name of a profile, sortable by time, without extension"""
+    return f"{function_name}/{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{request_id}"
+
+def write_output(key, body):
+    """Store a profile file under OUTPUT"""
+    if OUTPUT.startswith('s3://'):
+        bucket, _, prefix = OUTPUT[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        aws.client('s3').put_object(Bucket=bucket, Key=f"{prefix}{key}", Body=body)
+        return
+    path = os.path.join(OUTPUT, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(body)
+
+def top_allocations(snapshot, limit):
+    """Largest allocations of a tracemalloc snapshot that are still alive, grouped by line"""
+    return [
+        {'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", 'size': stat.size, 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
+
+def profile_handler(handler):
+    """Decorator for lambda_handler that profiles a sampled fraction of invocations
+
+    Writes `{function}/{time}-{request_id}.prof`, a pstats dump of the
+    invocation (cProfile sees the handler's thread only), and a `.json`
+    summary with the duration, the process's peak RSS and, in memory mode,
+    the traced peak and the allocations still alive when the handler
+    returns. Merge them with tools/merge_profiles.py. Failures to profile or
+    to write are logged and never fail the invocation.
+    """
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', handler.__module__)
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE:
+            return handler(event, context)
+
+        profiler = cProfile.Profile() if 'cpu' in MODES else None
+        trace_memory = 'memory' in MODES and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start(TRACEBACK_DEPTH)
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Another profiler is already running in this process
+                print(f"Error starting profiler: {str(e)}")
+                profiler = None
+
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            if profiler is not None:
+                profiler.disable()
+            summary = {
+                'function': function_name,
+                'duration_ms': round(duration_ms, 3),
+                # Kilobytes on Linux, the most the process has used since it started
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+            if trace_memory:
+                summary['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                summary['top_allocations'] = top_allocations(tracemalloc.take_snapshot(), TOP_ALLOCATIONS)
+                tracemalloc.stop()
+
+            key = profile_key(function_name, getattr(context, 'aws_request_id', None) or uuid.uuid4().hex)
+            try:
+                if profiler is not None:
+                    profiler.create_stats()
+                    write_output(f"{key}.prof", marshal.dumps(profiler.stats))
+                write_output(f"{key}.json", json.dumps(summary).encode('utf-8'))
+            except Exception as e:
+                print(f"Error writing profile: {str(e)}")
+
+    return wrapper
@@ -0,0 +1,73 @@
+import os
+import random
+import botocore.exceptions
+import urllib3.exceptions
+from botocore.exceptions import ClientError
+from common.telegram_api import TelegramError, TelegramRateLimitError
+
+# Payload field counting the failed attempts of a requeued message
+ATTEMPT_KEY = 'attempt'
+# Attempts before a transient failure is given up on and reported as permanent
+MAX_ATTEMPTS = int(os.environ.get('MAX_RETRY_ATTEMPTS', 5))
+BASE_DELAY_SECONDS = int(os.environ.get('RETRY_BASE_DELAY_SECONDS', 10))
+MAX_DELAY_SECONDS = 900  # SQS DelaySeconds limit
+
+TRANSIENT_AWS_ERROR_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException',
+    'RequestTimeout',
+    'InternalError',
+    'ServiceUnavailable',
+}
+
+def is_transient(error):
+    """Whether an error is likely to go away if the same work is tried again later
+
+    Telegram 5xx and 429, AWS throttling and 5xx, and network errors are
+    transient. Everything else (bad requests, missing files, bugs) is permanent.
+    """
+    if isinstance(error, TelegramError):
+        return not error.is_permanent
+    if isinstance(error, ClientError):
+        response = error.response
+        return (
+            response.get('Error', {}).get('Code') in TRANSIENT_AWS_ERROR_CODES
+            or response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+        )
+    return isinstance(error, (
+        botocore.exceptions.ConnectionError,
+        botocore.exceptions.HTTPClientError,
+        urllib3.exceptions.HTTPError,
+        ConnectionError,
+        TimeoutError,
+    ))
+
+def retry_delay(error, attempt):
+    """Seconds to wait before the next attempt, honouring Telegram's retry_after
+
+    Grows exponentially with the attempt number, with jitter so messages that
+    failed together don't all come back at once.
+
+    Args:
+        error: The exception the attempt failed with
+        attempt (int): Number of the failed attempt, starting at 1
+    """
+    if isinstance(error, TelegramRateLimitError) and error.retry_after:
+        return min(int(error.retry_after) + 1, MAX_DELAY_SECONDS)
+    delay = min(BASE_DELAY_SECONDS * 2 ** (attempt - 1), MAX_DELAY_SECONDS)
+    return delay // 2 + random.randint(0, delay - delay // 2)
+
+def queue_url_from_arn(queue_arn):
+    """Build the URL of the queue an SQS event record came from
+
+    Records of the in-memory transport carry the queue URL itself, which is
+    returned unchanged.
+    """
+    if not queue_arn.startswith('arn:'):
+        return queue_arn
+    _, partition, _, region, account, name = queue_arn.split(':')
+    domain = 'amazonaws.com.cn' if partition == 'aws-cn' else 'amazonaws.com'
+    return f"https://sqs.{region}.{domain}/{account}/{name}"
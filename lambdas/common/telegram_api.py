@@ -0,0 +1,200 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from common.metrics import timed
+
+DEFAULT_API_URL = 'https://api.telegram.org'
+CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', 10))
+# Connections kept open to api.telegram.org, and the most calls run at once
+POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 10))
+# Open a connection while a Lambda initialises, so the first invocation skips the TLS handshake
+PREWARM_ON_INIT = (
+    'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+    and os.environ.get('TELEGRAM_PREWARM', 'true').lower() == 'true'
+)
+
+class TelegramError(Exception):
+    """Telegram answered with ok=false or a non-200 status"""
+    def __init__(self, status, description='', parameters=None):
+        super().__init__(f"Telegram API error {status}: {description}")
+        self.status = status
+        self.description = description
+        self.parameters = parameters or {}
+
+    @property
+    def is_permanent(self):
+        """4xx errors such as a blocked bot or a missing chat will not succeed on retry"""
+        return 400 <= self.status < 500 and self.status != 429
+
+class TelegramRateLimitError(TelegramError):
+    """429 Too Many Requests"""
+    @property
+    def retry_after(self):
+        return self.parameters.get('retry_after', 1)
+
+class TelegramBadRequestError(TelegramError):
+    """400 Bad Request, e.g. chat not found or message text is empty"""
+    @property
+    def chat_not_found(self):
+        return 'chat not found' in self.description.lower()
+
+class TelegramForbiddenError(TelegramError):
+    """403 Forbidden, e.g. the bot was blocked by the user or kicked from the group"""
+
+ERRORS_BY_STATUS = {
+    400: TelegramBadRequestError,
+    403: TelegramForbiddenError,
+    429: TelegramRateLimitError,
+}
+
+def raise_for_response(status, data):
+    """Raise the TelegramError matching a response, if it is an error"""
+    try:
+        body = json.loads(data.decode('utf-8'))
+    except ValueError:
+        body = {'ok': False, 'description': data.decode('utf-8', errors='replace')}
+
+    if status == 200 and body.get('ok', True):
+        return body
+
+    status = body.get('error_code') or status
+    error_class = ERRORS_BY_STATUS.get(status, TelegramError)
+    raise error_class(status, body.get('description', ''), body.get('parameters'))
+
+class TelegramClient:
+    """Telegram Bot API client with a sync and an asyncio interface
+
+    Create one at module level so its connection pool stays warm between
+    invocations. Requests are sent as JSON with explicit timeouts and are
+    never retried here; callers decide what to do with a TelegramError.
+
+    Example:
+        telegram = TelegramClient()
+        telegram.send_message(chat_id, 'Hello')
+        results = telegram.call_many([('sendMessage', {...}), ('sendMessage', {...})])
+    """
+    def __init__(self, token=None, api_url=None, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        """
+        Args:
+            token: Bot token, TELEGRAM_BOT_TOKEN by default
+            api_url: Bot API base URL, TELEGRAM_API_URL by default
+            pool_size (int): Connections kept open, also the limit of concurrent async calls
+            connect_timeout (float): Seconds to wait for a connection
+            read_timeout (float): Seconds to wait for each read of a response
+        """
+        self.token = token or os.environ['TELEGRAM_BOT_TOKEN']
+        self.api_url = api_url or os.environ.get('TELEGRAM_API_URL', DEFAULT_API_URL)
+        self.pool_size = pool_size
+        self.http = urllib3.PoolManager(
+            maxsize=pool_size,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout),
+            retries=False
+        )
+        self.executor = None
+
+    def prewarm(self):
+        """Open a connection to the Bot API and leave it in the pool
+
+        Makes a HEAD request to the API host, which needs no token and does
+        nothing. Failures are only logged; the connection is opened again on
+        the first call.
+        """
+        try:
+            with timed('telegram.prewarm'):
+                self.http.request('HEAD', self.api_url)
+        except Exception as e:
+            print(f"Error pre-warming Telegram connection: {str(e)}")
+
+    def call(self, method, params=None):
+        """Call a Bot API method and return its result
+
+        Raises:
+            TelegramError: Or the subclass matching the error status
+        """
+        with timed(f"telegram.{method}"):
+            response = self.http.request(
+                'POST',
+                f"{self.api_url}/bot{self.token}/{method}",
+                body=json.dumps(params or {}).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+        return raise_for_response(response.status, response.data)['result']
+
+    def send_message(self, chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode='HTML'):
+        """Send a text message and return the sent Message"""
+        return self.call('sendMessage', build_send_message(chat_id, text, reply_to_message_id, reply_markup, parse_mode))
+
+    def answer_callback_query(self, callback_id, text=None):
+        params = {'callback_query_id': callback_id}
+        if text:
+            params['text'] = text
+        return self.call('answerCallbackQuery', params)
+
+    def get_file(self, file_id):
+        """Return the File object, whose file_path is valid for at least an hour"""
+        return self.call('getFile', {'file_id': file_id})
+
+    def download(self, file_path):
+        """Open a streaming download of a file
+
+        The body is not read here; the caller streams it and must release the response.
+        """
+        with timed('telegram.download_start'):
+            response = self.http.request(
+                'GET',
+                f"{self.api_url}/file/bot{self.token}/{file_path}",
+                preload_content=False
+            )
+
+        if response.status != 200:
+            response.release_conn()
+            raise TelegramError(response.status, 'Failed to download file')
+        return response
+
+    async def call_async(self, method, params=None):
+        """asyncio version of call(), run on one of pool_size worker threads sharing the pool"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        # Copy the context so metrics and tracing see the caller's current invocation
+        call = functools.partial(contextvars.copy_context().run, self.call, method, params)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def send_message_async(self, chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode='HTML'):
+        return await self.call_async(
+            'sendMessage', build_send_message(chat_id, text, reply_to_message_id, reply_markup, parse_mode)
+        )
+
+    async def call_many_async(self, calls, max_concurrency=None):
+        """Run (method, params) calls concurrently, at most pool_size at a time
+
+        Returns:
+            List with the result or the raised exception of every call, in order
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or self.pool_size)
+
+        async def limited(method, params):
+            async with semaphore:
+                return await self.call_async(method, params)
+
+        return await asyncio.gather(*(limited(method, params) for method, params in calls), return_exceptions=True)
+
+    def call_many(self, calls, max_concurrency=None):
+        """Blocking version of call_many_async() for synchronous handlers"""
+        return asyncio.run(self.call_many_async(calls, max_concurrency))
+
+def build_send_message(chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode='HTML'):
+    """Build sendMessage parameters"""
+    params = {'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        params['parse_mode'] = parse_mode
+    if reply_to_message_id:
+        params['reply_to_message_id'] = reply_to_message_id
+    if reply_markup:
+        params['reply_markup'] = reply_markup
+    return params
@@ -1,8 +1,225 @@
 import json
-import boto3
 import os
-import datetime
+import time
+from contextlib import contextmanager
 from botocore.exceptions import ClientError
+from common.metrics import timed
+from common import aws, payload, tracing
+from common.models import FileInfo, Message
+
+# Where send_to_sqs puts messages instead of SQS, e.g. an InMemoryTransport when
+# all handlers run in one process. None sends to SQS.
+transport = None
+
+def set_transport(new_transport):
+    """Route every TelegramUtils.send_to_sqs call through new_transport, or back to SQS with None"""
+    global transport
+    transport = new_transport
+
+
+class SQSBatchSender:
+    """Buffer SQS messages per queue and send them with SendMessageBatch"""
+
+    MAX_BATCH_ENTRIES = 10
+    MAX_BATCH_BYTES = 256 * 1024
+
+    def __init__(self, sqs, max_attempts=3):
+        """
+        Args:
+            sqs: boto3 SQS client
+            max_attempts (int): How many times to send entries that failed with a non-sender fault
+        """
+        self.sqs = sqs
+        self.max_attempts = max_attempts
+        self.buffers = {}
+
+    def add(self, queue_url, message_body, delay_seconds=None):
+        """Buffer a message, sending the queue's batch as soon as it is full"""
+        entries = self.buffers.setdefault(queue_url, [])
+        entries.append(self._entry(message_body, delay_seconds))
+        if len(entries) >= self.MAX_BATCH_ENTRIES:
+            self.flush(queue_url)
+
+    def flush(self, queue_url=None):
+        """Send buffered messages for one queue, or for all queues if none given"""
+        # Take the buffers first, so a failed send never leaves entries behind
+        # for the next warm invocation to send
+        if queue_url:
+            buffers = {queue_url: self.buffers.pop(queue_url, [])}
+        else:
+            buffers, self.buffers = self.buffers, {}
+
+        errors = []
+        for url, entries in buffers.items():
+            try:
+                for batch in self._split_batches(entries):
+                    errors.extend(self._send_batch(url, batch))
+            except Exception as e:
+                print(f"Error sending batch to {url}: {e}")
+                errors.append({'QueueUrl': url, 'Message': str(e)})
+
+        if errors:
+            raise Exception(f"Failed to send {len(errors)} message(s) to SQS: {errors}")
+
+    def discard(self):
+        """Drop every buffered message without sending it"""
+        self.buffers = {}
+
+    def send(self, queue_url, messages):
+        """Send messages right away, reporting which ones could not be sent
+
+        Args:
+            queue_url: Target queue URL
+            messages: List of (message_body, delay_seconds) pairs
+
+        Returns:
+            list: Positions in `messages` of the ones that were not sent
+        """
+        failed = []
+        offset = 0
+        for batch in self._split_batches([self._entry(body, delay) for body, delay in messages]):
+            try:
+                failed.extend(offset + int(failure['Id']) for failure in self._send_batch(queue_url, batch))
+            except Exception as e:
+                print(f"Error sending batch to {queue_url}: {e}")
+                failed.extend(range(offset, offset + len(batch)))
+            offset += len(batch)
+        return failed
+
+    def _entry(self, message_body, delay_seconds):
+        entry = {'MessageBody': payload.encode(message_body)}
+        if delay_seconds:
+            entry['DelaySeconds'] = delay_seconds
+        return entry
+
+    def _split_batches(self, entries):
+        """Split entries into batches within the SendMessageBatch count and size limits"""
+        batch, batch_bytes = [], 0
+        for entry in entries:
+            entry_bytes = len(entry['MessageBody'].encode('utf-8'))
+            if batch and (len(batch) >= self.MAX_BATCH_ENTRIES or batch_bytes + entry_bytes > self.MAX_BATCH_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(entry)
+            batch_bytes += entry_bytes
+        if batch:
+            yield batch
+
+    def _send_batch(self, queue_url, batch):
+        """Send one batch, retrying only the failed entries. Returns the failures left over"""
+        pending = {str(i): entry for i, entry in enumerate(batch)}
+        permanent_failures = []
+
+        for attempt in range(self.max_attempts):
+            with timed('sqs.send_batch'):
+                response = self.sqs.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{'Id': entry_id, **entry} for entry_id, entry in pending.items()]
+                )
+
+            retry = {}
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    # Malformed entries will fail the same way again
+                    permanent_failures.append(failure)
+                else:
+                    retry[failure['Id']] = pending[failure['Id']]
+
+            pending = retry
+            if not pending:
+                break
+            if attempt < self.max_attempts - 1:
+                time.sleep(0.1 * 2 ** attempt)  # Exponential backoff
+
+        return permanent_failures + [
+            {'Id': entry_id, 'Message': 'Retries exhausted'} for entry_id in pending
+        ]
+
+
+class DynamoDBBatchWriter:
+    """Buffer DynamoDB items for one table and write them with BatchWriteItem"""
+
+    MAX_BATCH_ITEMS = 25
+
+    def __init__(self, dynamodb, table_name, key_names=('user_id', 'timestamp'), max_attempts=5, window_seconds=None):
+        """
+        Args:
+            dynamodb: boto3 DynamoDB resource
+            table_name (str): Table to write to
+            key_names (tuple): Primary key attributes, used to keep duplicate keys out of one batch
+            max_attempts (int): How many times to write unprocessed items before giving up
+            window_seconds (float): Flush once the oldest buffered item is this old.
+                None keeps items until the batch is full or flush() is called.
+        """
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.key_names = key_names
+        self.max_attempts = max_attempts
+        self.window_seconds = window_seconds
+        self.items = []
+        self.window_started = None
+
+    def add(self, item):
+        """Buffer an item, writing the batch when it is full or the window has passed"""
+        if not self.items:
+            self.window_started = time.monotonic()
+        self.items.append(item)
+
+        window_passed = (
+            self.window_seconds is not None
+            and time.monotonic() - self.window_started >= self.window_seconds
+        )
+        if len(self.items) >= self.MAX_BATCH_ITEMS or window_passed:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered items, reporting every item that could not be written"""
+        items, self.items = self.items, []
+        failed = []
+        for batch in self._split_batches(items):
+            failed.extend(self._write_batch(batch))
+
+        if failed:
+            for item, error in failed:
+                print(f"Error logging message: {error}")
+                print(f"Item data: {json.dumps(item)}")
+            raise Exception(f"Failed to log {len(failed)} message(s) to {self.table_name}")
+
+    def _split_batches(self, items):
+        """Split items into batches of at most 25 without repeating a primary key"""
+        batch, keys = [], set()
+        for item in items:
+            key = tuple(item.get(name) for name in self.key_names)
+            if len(batch) >= self.MAX_BATCH_ITEMS or key in keys:
+                yield batch
+                batch, keys = [], set()
+            batch.append(item)
+            keys.add(key)
+        if batch:
+            yield batch
+
+    def _write_batch(self, batch):
+        """Write one batch, retrying unprocessed items. Returns (item, error) pairs that failed"""
+        requests = [{'PutRequest': {'Item': item}} for item in batch]
+
+        for attempt in range(self.max_attempts):
+            try:
+                with timed('dynamodb.batch_write'):
+                    response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                return [(request['PutRequest']['Item'], e) for request in requests]
+
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                return []
+            if attempt < self.max_attempts - 1:
+                time.sleep(0.05 * 2 ** attempt)  # Exponential backoff
+
+        return [
+            (request['PutRequest']['Item'], f"Unprocessed after {self.max_attempts} attempts")
+            for request in requests
+        ]
+
 
 class TelegramUtils:
     def __init__(self, require_outgoing_queue=True):
@@ -11,12 +228,22 @@ class TelegramUtils:
         Args:
             require_outgoing_queue (bool): Whether to require queue URLs in environment
         """
-        self.sqs = boto3.client('sqs')
-        self.dynamodb = boto3.resource('dynamodb')
+        # Created on first use, not every handler needs both
+        self.sqs = aws.lazy_client('sqs')
+        self.dynamodb = aws.lazy_resource('dynamodb')
+        self.sqs_batch_sender = SQSBatchSender(self.sqs)
+        self.buffer_sqs = False
         
         # Get table name if available
         if 'MESSAGE_LOGS_TABLE' in os.environ:
-            self.message_logs_table = self.dynamodb.Table(os.environ['MESSAGE_LOGS_TABLE'])
+            self.message_logs_table = aws.lazy_table(os.environ['MESSAGE_LOGS_TABLE'])
+            window = os.environ.get('LOG_BATCH_WINDOW_SECONDS')
+            self.log_batch_writer = DynamoDBBatchWriter(
+                self.dynamodb,
+                os.environ['MESSAGE_LOGS_TABLE'],
+                window_seconds=float(window) if window else None
+            )
+        self.buffer_logs = False
         
         # Get queue URLs if required
         if require_outgoing_queue:
@@ -24,95 +251,134 @@ class TelegramUtils:
     
     def extract_file_info(self, message):
         """Extract file information from different types of attachments"""
-        attachment_types = [
-            ('photo', lambda x: x[-1]),  # Get the largest photo
-            ('video', lambda x: x),
-            ('document', lambda x: x),
-            ('audio', lambda x: x),
-            ('voice', lambda x: x),
-        ]
-        
-        for att_type, processor in attachment_types:
-            if att_type in message:
-                file_data = processor(message[att_type])
-                return {
-                    'type': att_type,
-                    att_type: message[att_type],  # Save original data
-                    'file_id': file_data.get('file_id'),
-                    'file_unique_id': file_data.get('file_unique_id'),
-                    'file_size': file_data.get('file_size'),
-                    'mime_type': file_data.get('mime_type'),
-                    'file_name': file_data.get('file_name'),
-                    'media_group_id': message.get('media_group_id'),
-                    'caption': message.get('caption'),
-                }
-        return None
+        file_info = FileInfo.parse(message)
+        return file_info.to_dict() if file_info else None
 
     def extract_message_data(self, message_data, message_type='user_message'):
-        """Extract all necessary data from Telegram message"""
-        from_data = message_data.get('from', {})
-        chat_data = message_data.get('chat', {})
-        
-        # Basic message data
-        data = {
-            'user_id': str(from_data.get('id')),
-            'chat_id': str(chat_data.get('id')),
-            'message_id': message_data.get('message_id'),
-            'sender_id': str(from_data.get('id')),
-            'is_bot': from_data.get('is_bot', False),
-            'media_group_id': message_data.get('media_group_id'),
-            'text': message_data.get('text', ''),
-            'caption': message_data.get('caption', ''),
-            'message_type': message_type
-        }
-        
-        # Extract file info if present
-        file_info = self.extract_file_info(message_data)
-        if file_info:
-            data['file_info'] = file_info
-        
-        return data
+        """Extract all necessary data from Telegram message
+
+        Args:
+            message_data: Raw Telegram message dict or an already parsed Message
+        """
+        if not isinstance(message_data, Message):
+            message_data = Message.parse(message_data)
+        return message_data.to_queue_dict(message_type)
+
+    def build_log_item(self, message_data, message_type='user_message'):
+        """Build the DynamoDB log item for a Telegram message
+
+        Args:
+            message_data: Raw Telegram message dict or an already parsed Message
+        """
+        if not isinstance(message_data, Message):
+            message_data = Message.parse(message_data)
+        return message_data.to_log_item(message_type)
 
     def log_message(self, message_data, message_type='user_message'):
-        """Log message to DynamoDB using Telegram message data"""
-        data = self.extract_message_data(message_data, message_type)
-        timestamp = datetime.datetime.now().isoformat()
-        
-        item = {
-            'user_id': data['user_id'],
-            'timestamp': timestamp,
-            'message_type': data['message_type'],
-            'message': data['caption'] if data['caption'] else data['text'],
-            'telegram_message_id': data['message_id'],
-            'chat_id': data['chat_id'],
-            'sender_id': data['sender_id'],
-            'is_bot': data['is_bot'],
-            'ttl': int((datetime.datetime.now() + datetime.timedelta(days=90)).timestamp())
-        }
-        
-        # Only add media_group_id if it exists and is not None
-        if data.get('media_group_id'):
-            item['media_group_id'] = data['media_group_id']
-        
-        # Add file info if present
-        if 'file_info' in data:
-            item['file_info'] = data['file_info']
-        
+        """Log message to DynamoDB using Telegram message data, or buffer it while inside batch_logs()"""
+        item = self.build_log_item(message_data, message_type)
+
+        if self.buffer_logs:
+            self.log_batch_writer.add(item)
+            return
+
         try:
-            self.message_logs_table.put_item(Item=item)
+            with timed('dynamodb.put'):
+                self.message_logs_table.put_item(Item=item)
         except ClientError as e:
             print(f"Error logging message: {e}")
             print(f"Item data: {json.dumps(item)}")
             raise
     
-    def send_to_sqs(self, queue_url, message_body):
-        """Send message to SQS queue"""
-        self.sqs.send_message(
-            QueueUrl=queue_url, 
-            MessageBody=json.dumps(message_body)
-        )
+    def send_to_sqs(self, queue_url, message_body, delay_seconds=None):
+        """Send message to SQS queue, or buffer it while inside batch_sends()
+
+        Args:
+            queue_url: Target queue URL
+            message_body: JSON-serializable message
+            delay_seconds: Optional delivery delay, capped at the SQS maximum of 900 seconds
+        """
+        if delay_seconds:
+            delay_seconds = min(int(delay_seconds), 900)
+
+        if isinstance(message_body, dict):
+            message_body = tracing.stamp(message_body, queue_url)
+
+        if transport is not None:
+            transport.send(queue_url, payload.encode(message_body), delay_seconds)
+            return
+
+        if self.buffer_sqs:
+            self.sqs_batch_sender.add(queue_url, message_body, delay_seconds)
+            return
+
+        params = {
+            'QueueUrl': queue_url,
+            'MessageBody': payload.encode(message_body)
+        }
+        if delay_seconds:
+            params['DelaySeconds'] = delay_seconds
+        with timed('sqs.send'):
+            self.sqs.send_message(**params)
+
+    def send_all_to_sqs(self, queue_url, messages):
+        """Send messages to SQS now, in as few calls as possible
+
+        Unlike batch_sends(), which fails as a whole, this reports the
+        messages that could not be sent so only those need retrying.
+
+        Args:
+            queue_url: Target queue URL
+            messages: List of (message_body, delay_seconds) pairs, delays capped at 900 seconds
+
+        Returns:
+            list: Positions in `messages` of the ones that were not sent
+        """
+        messages = [
+            (tracing.stamp(body, queue_url) if isinstance(body, dict) else body,
+             min(int(delay), 900) if delay else None)
+            for body, delay in messages
+        ]
+        if transport is not None:
+            for body, delay in messages:
+                transport.send(queue_url, payload.encode(body), delay)
+            return []
+        return self.sqs_batch_sender.send(queue_url, messages)
+
+    @contextmanager
+    def batch_sends(self):
+        """Buffer send_to_sqs calls and flush them with SendMessageBatch on exit
+
+        Wrap the body of a lambda_handler with this so all messages produced
+        by one invocation go out in as few SQS calls as possible. If the body
+        raises, the buffered messages are dropped instead: the invocation is
+        retried and will produce them again.
+        """
+        self.buffer_sqs = True
+        try:
+            yield self
+        except BaseException:
+            self.sqs_batch_sender.discard()
+            raise
+        finally:
+            self.buffer_sqs = False
+        self.sqs_batch_sender.flush()
+
+    @contextmanager
+    def batch_logs(self):
+        """Buffer log_message calls and write them with BatchWriteItem on exit
+
+        Items are also written early once 25 are buffered or once
+        LOG_BATCH_WINDOW_SECONDS has passed since the first buffered item.
+        """
+        self.buffer_logs = True
+        try:
+            yield self
+        finally:
+            self.buffer_logs = False
+            self.log_batch_writer.flush()
     
-    def send_message(self, chat_id, text, reply_to_message_id=None, inline_buttons=None):
+    def send_message(self, chat_id, text, reply_to_message_id=None, inline_buttons=None, delay_seconds=None):
         """Send message to user through SQS outgoing queue
         
         Args:
@@ -122,6 +388,7 @@ class TelegramUtils:
             inline_buttons: Optional list of button rows, where each button is dict with 'text' and 'callback_data'
                 Example: [[{'text': 'Button 1', 'callback_data': 'btn1'}],
                          [{'text': 'Button 2', 'callback_data': 'btn2'}]]
+            delay_seconds: Optional delay before the sender sees the message
         """
         if not hasattr(self, 'outgoing_queue_url'):
             raise ValueError("Outgoing queue URL not configured")
@@ -138,4 +405,4 @@ class TelegramUtils:
                 'inline_keyboard': inline_buttons
             }
 
-        self.send_to_sqs(self.outgoing_queue_url, outgoing_message) 
\ No newline at end of file
+        self.send_to_sqs(self.outgoing_queue_url, outgoing_message, delay_seconds=delay_seconds) 
\ No newline at end of file
@@ -0,0 +1,146 @@
+import math
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from common.metrics import timed
+
+def sliding_count(current, previous, elapsed_fraction):
+    """Sliding-window estimate from two fixed windows
+
+    The previous window's count is weighted by how much of it still overlaps
+    a window ending now.
+    """
+    return current + previous * (1 - elapsed_fraction)
+
+class LocalWindowCounter:
+    """In-process sliding-window counters, kept at module level between warm invocations
+
+    Each key keeps the counts of the current and the previous fixed window.
+    The least recently used keys are evicted beyond max_keys.
+    """
+    def __init__(self, window_seconds, max_keys=10000):
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        # key -> [window index, count in that window, count in the window before]
+        self.windows = OrderedDict()
+
+    def _counts(self, key, window):
+        """Counts of the given window and the one before, rolling the key forward"""
+        entry = self.windows.get(key)
+        if entry is None or entry[0] < window - 1:
+            return 0, 0
+        if entry[0] == window - 1:
+            return 0, entry[1]
+        return entry[1], entry[2]
+
+    def estimate(self, key, now=None):
+        now = time.time() if now is None else now
+        window, elapsed = divmod(now, self.window_seconds)
+        current, previous = self._counts(key, int(window))
+        return sliding_count(current, previous, elapsed / self.window_seconds)
+
+    def hit(self, key, now=None):
+        """Count a hit and return the estimate including it"""
+        now = time.time() if now is None else now
+        window = int(now // self.window_seconds)
+        current, previous = self._counts(key, window)
+        self.set(key, window, current + 1, previous)
+        return self.estimate(key, now)
+
+    def set(self, key, window, current, previous):
+        """Adopt the counts of a window, e.g. the shared ones read from DynamoDB"""
+        self.windows[key] = [window, current, previous]
+        self.windows.move_to_end(key)
+        while len(self.windows) > self.max_keys:
+            self.windows.popitem(last=False)
+
+class DynamoDBWindowCounter:
+    """Sliding-window counters shared between Lambda instances as DynamoDB atomic counters
+
+    Each key is one item under `throttle#{key}` with an attribute per fixed
+    window. A hit is a single UpdateItem that increments the current window,
+    removes the one before the previous, and returns both remaining counts.
+    """
+    def __init__(self, table, window_seconds):
+        self.table = table
+        self.window_seconds = window_seconds
+
+    def hit(self, key, now=None):
+        """Count a hit
+
+        Returns:
+            tuple: (window index, count in that window, count in the window before)
+        """
+        now = time.time() if now is None else now
+        window = int(now // self.window_seconds)
+        with timed('dynamodb.throttle'):
+            response = self.table.update_item(
+                Key={'pk': f"throttle#{key}"},
+                UpdateExpression='ADD #current :one SET #ttl = :ttl REMOVE #old',
+                ExpressionAttributeNames={'#current': f"w{window}", '#old': f"w{window - 2}", '#ttl': 'ttl'},
+                ExpressionAttributeValues={':one': 1, ':ttl': math.ceil((window + 2) * self.window_seconds)},
+                ReturnValues='ALL_NEW'
+            )
+        attributes = response['Attributes']
+        return window, int(attributes[f"w{window}"]), int(attributes.get(f"w{window - 1}", 0))
+
+class Throttle:
+    """Per-user and per-chat rate limits over a sliding window
+
+    A key already over its limit in the in-process tier is refused without a
+    DynamoDB call. Otherwise the hit is counted in the shared tier, if a table
+    is given, and the shared counts replace the local ones. Refused hits are
+    not counted, so a flooding sender still gets `limit` updates per window
+    through. DynamoDB errors fall back to the local counts.
+
+    Example:
+        throttle = Throttle(user_limit=30, chat_limit=120, window_seconds=60, table=state_table)
+        if not throttle.allow(user_id, chat_id):
+            ...
+    """
+    def __init__(self, user_limit, chat_limit, window_seconds=60, table=None):
+        """
+        Args:
+            user_limit (int): Updates a user may send per window, 0 for no limit
+            chat_limit (int): Updates a chat may receive per window, 0 for no limit
+            window_seconds (float): Length of the sliding window
+            table: Optional DynamoDB Table for the shared tier, keyed by `pk`
+        """
+        self.limits = {'user': user_limit, 'chat': chat_limit}
+        self.window_seconds = window_seconds
+        self.local = LocalWindowCounter(window_seconds)
+        self.shared = DynamoDBWindowCounter(table, window_seconds) if table is not None else None
+
+    def allow(self, user_id=None, chat_id=None, now=None):
+        """Count an update and tell whether it is within every limit
+
+        Private chats have the user's ID, so only the user limit applies to them.
+        """
+        now = time.time() if now is None else now
+        keys = []
+        if user_id is not None and self.limits['user']:
+            keys.append((f"user#{user_id}", self.limits['user']))
+        if chat_id is not None and self.limits['chat'] and chat_id != user_id:
+            keys.append((f"chat#{chat_id}", self.limits['chat']))
+
+        # Refuse from the warm tier before counting anything
+        for key, limit in keys:
+            if self.local.estimate(key, now) >= limit:
+                return False
+
+        allowed = True
+        for key, limit in keys:
+            if self.count(key, now) > limit:
+                allowed = False
+        return allowed
+
+    def count(self, key, now):
+        """Count a hit in the shared tier if there is one, returning the sliding estimate"""
+        if self.shared is not None:
+            try:
+                window, current, previous = self.shared.hit(key, now)
+                self.local.set(key, window, current, previous)
+                return self.local.estimate(key, now)
+            except ClientError as e:
+                print(f"Error counting throttle hit: {e}")
+        return self.local.hit(key, now)
@@ -0,0 +1,90 @@
+import os
+import time
+import uuid
+from contextvars import ContextVar
+from common.metrics import record
+
+# Key of the trace envelope inside queue message bodies
+TRACE_KEY = '_trace'
+# Older hops are dropped so repeatedly requeued messages don't grow without bound
+MAX_HOPS = 10
+
+# Environment variables holding queue URLs, mapped to the hop names used in metrics
+QUEUE_NAMES = {
+    'UPLOAD_QUEUE_URL': 'upload',
+    'LARGE_UPLOAD_QUEUE_URL': 'upload_large',
+    'PROCESSING_QUEUE_URL': 'processing',
+    'CALLBACK_QUEUE_URL': 'callback',
+    'OUTGOING_QUEUE_URL': 'outgoing',
+}
+
+# Trace of the update or queue record being handled by this thread
+_current_trace = ContextVar('current_trace', default=None)
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def queue_name(queue_url):
+    """Short hop name for a queue URL"""
+    for env_var, name in QUEUE_NAMES.items():
+        if os.environ.get(env_var) == queue_url:
+            return name
+    return queue_url.rsplit('/', 1)[-1]
+
+def begin(message=None):
+    """Start a trace for an update received by the webhook
+
+    The trace envelope looks like:
+        {'id': correlation ID,
+         'ingress': Telegram message date in ms (when known),
+         'received': webhook receive time in ms,
+         'hops': [{'q': queue, 'enq': enqueue time, 'deq': dequeue time}, ...]}
+    """
+    trace = {'id': uuid.uuid4().hex, 'received': now_ms(), 'hops': []}
+    if message and message.get('date'):
+        trace['ingress'] = message['date'] * 1000
+    _current_trace.set(trace)
+    return trace
+
+def receive(body):
+    """Mark a queue message as dequeued, record its queue dwell time and make its trace current"""
+    trace = body.get(TRACE_KEY) if isinstance(body, dict) else None
+    _current_trace.set(trace)
+    if not trace or not trace['hops']:
+        return trace
+
+    hop = trace['hops'][-1]
+    hop['deq'] = now_ms()
+    record(f"queue_dwell.{hop['q']}", hop['deq'] - hop['enq'])
+    return trace
+
+def stamp(message_body, queue_url):
+    """Return a copy of the message carrying its trace plus a new hop for queue_url
+
+    Uses the message's own trace if it has one, otherwise the current one.
+    Records how long the current hop spent processing before this send.
+    """
+    trace = message_body.get(TRACE_KEY) or _current_trace.get()
+    if trace is None:
+        return message_body
+
+    now = now_ms()
+    hops = trace['hops']
+    if hops and 'deq' in hops[-1]:
+        record(f"hop_processing.{hops[-1]['q']}", now - hops[-1]['deq'])
+    elif not hops:
+        record('hop_processing.webhook', now - trace['received'])
+
+    hops = hops[-(MAX_HOPS - 1):] + [{'q': queue_name(queue_url), 'enq': now}]
+    return {**message_body, TRACE_KEY: {**trace, 'hops': hops}}
+
+def reply_sent(message_body):
+    """Record time-to-reply once Telegram has accepted the reply"""
+    trace = message_body.get(TRACE_KEY)
+    if not trace:
+        return
+
+    now = now_ms()
+    record('reply_latency', now - trace['received'])
+    if 'ingress' in trace:
+        record('reply_latency_from_ingress', now - trace['ingress'])
@@ -0,0 +1,67 @@
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+class InMemoryTransport:
+    """Thread-safe in-process stand-in for the SQS queues
+
+    Used by the monolith runner: TelegramUtils.send_to_sqs hands messages to
+    send() instead of SQS, and workers receive them as Lambda SQS event records.
+    DelaySeconds is honoured; there is no visibility timeout, so redelivery of
+    failed records is up to the caller.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # queue URL -> heap of (due time, sequence, record)
+        self.queues = {}
+        self.sequence = itertools.count()
+
+    def send(self, queue_url, body, delay_seconds=None):
+        """Add an encoded message body to the queue, visible after delay_seconds"""
+        record = {
+            'messageId': uuid.uuid4().hex,
+            'body': body,
+            'attributes': {'ApproximateReceiveCount': '0'},
+            'messageAttributes': {},
+            'eventSource': 'memory',
+            # Lets handlers requeue to the queue a record came from, as with an SQS queue ARN
+            'eventSourceARN': queue_url,
+        }
+        self.put(queue_url, record, delay_seconds)
+
+    def put(self, queue_url, record, delay_seconds=None):
+        """Add an existing record, e.g. one whose processing failed"""
+        due = time.monotonic() + (delay_seconds or 0)
+        with self.condition:
+            heapq.heappush(self.queues.setdefault(queue_url, []), (due, next(self.sequence), record))
+            self.condition.notify_all()
+
+    def receive(self, queue_url, max_messages=10, wait_seconds=1):
+        """Take up to max_messages visible records, waiting up to wait_seconds for the first"""
+        deadline = time.monotonic() + wait_seconds
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                heap = self.queues.setdefault(queue_url, [])
+                records = []
+                while heap and heap[0][0] <= now and len(records) < max_messages:
+                    records.append(heapq.heappop(heap)[2])
+                if records or now >= deadline:
+                    for record in records:
+                        attributes = record['attributes']
+                        attributes['ApproximateReceiveCount'] = str(int(attributes['ApproximateReceiveCount']) + 1)
+                    return records
+
+                timeout = deadline - now
+                if heap:
+                    timeout = min(timeout, heap[0][0] - now)
+                self.condition.wait(timeout)
+
+    def pending(self, queue_url=None):
+        """Number of queued records, delayed ones included"""
+        with self.condition:
+            if queue_url is not None:
+                return len(self.queues.get(queue_url, []))
+            return sum(len(heap) for heap in self.queues.values())
@@ -1,21 +1,44 @@
 import json
-import boto3
 import os
-import urllib3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from common.telegram_utils import TelegramUtils
+from common.telegram_api import TelegramClient, TelegramError, PREWARM_ON_INIT
+from common.cache import TTLCache, DynamoDBTTLCache, TieredCache
+from common.albums import ALBUM_SETTLE_SECONDS, add_album_part, fail_album_part
+from common.attachments import find_upload, record_upload
+from common.metrics import timed, instrument_handler
+from common.profiling import profile_handler
+from common import aws, payload, retries, tracing
 
-# Initialize clients
-s3 = boto3.client('s3')
-http = urllib3.PoolManager()
+# Initialize clients. Failed uploads are retried later through the queue, so
+# the client itself only makes one quick retry
+s3 = aws.lazy_client('s3', config=Config(retries={'mode': 'standard', 'max_attempts': 2}))
+telegram = TelegramClient()
 telegram_utils = TelegramUtils()
+if PREWARM_ON_INIT:
+    telegram.prewarm()
 
 # Constants
-MAX_RETRY_ATTEMPTS = int(os.environ.get('MAX_RETRY_ATTEMPTS', 3))
 FILE_STORAGE_BUCKET = os.environ['FILE_STORAGE_BUCKET']
-TELEGRAM_BOT_TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
 PROCESSING_QUEUE_URL = os.environ['PROCESSING_QUEUE_URL']
+UPLOAD_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for every part but the last
+MAX_PENDING_PARTS = 2  # Parts being uploaded while the next one downloads
+DEDUP_PREFIX = 'by_unique_id/'
+FILE_PATH_TTL_SECONDS = 50 * 60  # Telegram keeps file paths valid for at least an hour
+
+# Album files are aggregated into one reply, and uploads are added to the
+# attachment index, when STATE_TABLE is configured
+state_table = aws.lazy_table(os.environ['STATE_TABLE']) if 'STATE_TABLE' in os.environ else None
+
+# getFile results, shared between instances when STATE_TABLE is configured
+file_path_cache = TieredCache(
+    TTLCache(max_size=1024, ttl_seconds=FILE_PATH_TTL_SECONDS),
+    DynamoDBTTLCache(state_table, 'file_path', ttl_seconds=FILE_PATH_TTL_SECONDS) if state_table is not None else None
+)
 
 def get_file_extension(file_info):
     """Get file extension based on mime type or file path"""    
@@ -39,52 +62,160 @@ def get_file_extension(file_info):
     return ''
 
 def get_file_from_telegram(file_id):
-    """Get file path from Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getFile"
-    response = http.request(
-        'GET',
-        url,
-        fields={'file_id': file_id}
-    )
-    
-    if response.status != 200:
-        raise Exception(f"Failed to get file path: {response.data.decode('utf-8')}")
-    
-    file_data = json.loads(response.data.decode('utf-8'))
-    return file_data['result']['file_path']
+    """Get file path from Telegram, using the file path cache when possible"""
+    file_path = file_path_cache.get(file_id)
+    if file_path:
+        return file_path
+
+    file_path = telegram.get_file(file_id)['file_path']
+    file_path_cache.set(file_id, file_path)
+    return file_path
 
 def download_file(file_path):
-    """Download file from Telegram"""
-    url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}"
-    response = http.request('GET', url)
-    
-    if response.status != 200:
-        raise Exception(f"Failed to download file: {response.status}")
-    
-    return response.data
+    """Open a streaming download from Telegram
+
+    The body is not read here; the caller streams it and must close the response.
+    """
+    return telegram.download(file_path)
+
+def open_download(file_id):
+    """Resolve a file's path and open its download
+
+    A cached path that Telegram no longer serves (404) is dropped and the
+    path is asked for once more before giving up.
+    """
+    file_path = get_file_from_telegram(file_id)
+    try:
+        return download_file(file_path)
+    except TelegramError as e:
+        if e.status != 404:
+            raise
+        print(f"Cached file path of {file_id} expired, asking Telegram again")
+        file_path_cache.delete(file_id)
+        return download_file(get_file_from_telegram(file_id))
+
+def read_part(stream):
+    """Read up to UPLOAD_PART_SIZE bytes from the stream, fewer only at the end"""
+    chunks = []
+    size = 0
+    while size < UPLOAD_PART_SIZE:
+        chunk = stream.read(UPLOAD_PART_SIZE - size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b''.join(chunks)
 
-def upload_to_s3(chat_id, message_id, media_group_id, file_name, file_data):
-    """Upload file to S3 with retry logic"""
+def upload_part(key, upload_id, part_number, body):
+    """Upload one part of a multipart upload"""
+    response = s3.upload_part(
+        Bucket=FILE_STORAGE_BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body
+    )
+    return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+def get_s3_key(chat_id, message_id, media_group_id, file_name):
+    """Build the S3 key for a message attachment"""
     # Determine the folder structure based on media_group_id
     if media_group_id:
-        key = f"{chat_id}/{media_group_id}/{message_id}/{file_name}"
-    else:
-        key = f"{chat_id}/no_media_group/{message_id}/{file_name}"
-    
-    for attempt in range(MAX_RETRY_ATTEMPTS):
-        try:
-            s3.put_object(
+        return f"{chat_id}/{media_group_id}/{message_id}/{file_name}"
+    return f"{chat_id}/no_media_group/{message_id}/{file_name}"
+
+def find_existing_upload(file_unique_id):
+    """Return the S3 key already holding this file's content, or None
+
+    Looked up in the attachment index when STATE_TABLE is configured. Otherwise
+    every upload leaves a zero-byte marker under DEDUP_PREFIX named after
+    Telegram's file_unique_id, with the key of the uploaded object in its metadata.
+    """
+    if state_table is not None:
+        return find_upload(state_table, file_unique_id)
+    try:
+        with timed('s3.head'):
+            response = s3.head_object(Bucket=FILE_STORAGE_BUCKET, Key=f"{DEDUP_PREFIX}{file_unique_id}")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['Metadata'].get('source-key')
+
+def remember_upload(file_unique_id, key):
+    """Record which S3 key holds the content of file_unique_id
+
+    With STATE_TABLE configured this is part of index_upload() instead.
+    """
+    if state_table is not None:
+        return
+    try:
+        s3.put_object(
+            Bucket=FILE_STORAGE_BUCKET,
+            Key=f"{DEDUP_PREFIX}{file_unique_id}",
+            Body=b'',
+            Metadata={'source-key': key}
+        )
+    except ClientError as e:
+        # The upload itself succeeded, we only lose deduplication for this file
+        print(f"Error writing dedup marker: {e}")
+
+def copy_existing_upload(source_key, key):
+    """Server-side copy of an earlier upload. Returns False if it no longer exists"""
+    if source_key == key:
+        # Redelivery of a message we already uploaded
+        return True
+    try:
+        with timed('s3.copy'):
+            s3.copy_object(
                 Bucket=FILE_STORAGE_BUCKET,
                 Key=key,
-                Body=file_data
+                CopySource={'Bucket': FILE_STORAGE_BUCKET, 'Key': source_key}
             )
-            return key
-        except Exception as e:
-            if attempt == MAX_RETRY_ATTEMPTS - 1:
-                raise e
-            time.sleep(2 ** attempt)  # Exponential backoff
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+def upload_to_s3(key, stream):
+    """Stream file to S3
+
+    Files that fit in one part are uploaded with a single put_object. Larger
+    files go through a multipart upload: parts are uploaded in the background
+    while the next ones are still being downloaded, with at most
+    MAX_PENDING_PARTS parts held in memory. A failed multipart upload is aborted.
+    """
+    part = read_part(stream)
+    if len(part) < UPLOAD_PART_SIZE:
+        s3.put_object(Bucket=FILE_STORAGE_BUCKET, Key=key, Body=part)
+        return key
+
+    upload_id = s3.create_multipart_upload(Bucket=FILE_STORAGE_BUCKET, Key=key)['UploadId']
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=MAX_PENDING_PARTS) as executor:
+            pending = deque()
+            while part:
+                # Wait for the oldest part before buffering another one
+                if len(pending) >= MAX_PENDING_PARTS:
+                    pending.popleft().result()
+                future = executor.submit(upload_part, key, upload_id, len(futures) + 1, part)
+                futures.append(future)
+                pending.append(future)
+                part = read_part(stream)
+
+        s3.complete_multipart_upload(
+            Bucket=FILE_STORAGE_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [future.result() for future in futures]}
+        )
+    except Exception:
+        s3.abort_multipart_upload(Bucket=FILE_STORAGE_BUCKET, Key=key, UploadId=upload_id)
+        raise
     
-    return None
+    return key
 
 def process_file(data):
     """Process a single file"""
@@ -103,53 +234,151 @@ def process_file(data):
         # Fallback name if no identifiers found
         file_name = f"file_{int(time.time())}"
     
-    # Get file path from Telegram
-    file_path = get_file_from_telegram(file_id)
-    
-    # Download file
-    file_data = download_file(file_path)
-    
     # Get media_group_id from data (might be None)
     media_group_id = data.get('media_group_id')
     
-    # Upload to S3 with new path structure
-    s3_key = upload_to_s3(
+    s3_key = get_s3_key(
         chat_id=data['chat_id'],
         message_id=data['message_id'],
         media_group_id=media_group_id,
-        file_name=file_name,
-        file_data=file_data
+        file_name=file_name
     )
     
+    # Forwarded and re-sent files share file_unique_id, copy them instead of downloading again
+    file_unique_id = file_info.get('file_unique_id')
+    if file_unique_id:
+        source_key = find_existing_upload(file_unique_id)
+        if source_key and copy_existing_upload(source_key, s3_key):
+            return s3_key
+    
+    # Get file path from Telegram and stream the download into S3 with new path structure
+    stream = open_download(file_id)
+    try:
+        # Download and upload overlap, so they are timed as one span
+        with timed('s3.upload'):
+            upload_to_s3(s3_key, stream)
+    except Exception:
+        # Don't hand a half-read connection back to the pool
+        stream.close()
+        raise
+    stream.release_conn()
+    
+    if file_unique_id:
+        remember_upload(file_unique_id, s3_key)
+    
     return s3_key
 
+def index_upload(data, s3_key):
+    """Add an uploaded file to the attachment index the callback processor looks files up in"""
+    if state_table is None:
+        return
+    file_info = data['file_info']
+    record_upload(
+        state_table,
+        data['chat_id'],
+        data['message_id'],
+        s3_key,
+        size=file_info.get('file_size'),
+        file_unique_id=file_info.get('file_unique_id'),
+        media_group_id=data.get('media_group_id')
+    )
+
+def schedule_album_settle(data):
+    """Have the processor check, after a short delay, whether the file's album is complete"""
+    telegram_utils.send_to_sqs(PROCESSING_QUEUE_URL, {
+        'message_type': 'album_settle',
+        'chat_id': data['chat_id'],
+        'media_group_id': data['media_group_id']
+    }, delay_seconds=ALBUM_SETTLE_SECONDS)
+
+def forward_upload(data, s3_key):
+    """Hand an uploaded file to the message processor
+
+    Album files are added to their album's aggregate instead, together with
+    a delayed settle check; the processor replies once for the whole album.
+    """
+    data['uploaded_file'] = s3_key
+    media_group_id = data.get('media_group_id')
+    if media_group_id and state_table is not None:
+        album = add_album_part(state_table, media_group_id, data['chat_id'], data['message_id'], s3_key)
+        # A file arriving after the album was handled gets its own reply
+        if not album.get('emitted'):
+            schedule_album_settle(data)
+            return
+
+    telegram_utils.send_to_sqs(PROCESSING_QUEUE_URL, data)
+
+def handle_failure(record, data, error):
+    """Requeue a file that failed for a transient reason, or tell the user it failed
+
+    Transient failures go back to the queue the record came from with a
+    growing delay and the attempt count in the payload, so the Lambda doesn't
+    sleep through the backoff. Only permanent failures, or transient ones
+    that used up MAX_RETRY_ATTEMPTS, are reported to the user.
+
+    Returns:
+        bool: False if the record couldn't be requeued and should be left to SQS to redeliver
+    """
+    attempt = int(data.get(retries.ATTEMPT_KEY, 0)) + 1
+    if retries.is_transient(error) and attempt < retries.MAX_ATTEMPTS:
+        if 'eventSourceARN' not in record:
+            return False
+        delay = retries.retry_delay(error, attempt)
+        print(f"Retrying file in {delay}s after attempt {attempt}: {str(error)}")
+        data = {key: value for key, value in data.items() if key != 'uploaded_file'}
+        data[retries.ATTEMPT_KEY] = attempt
+        telegram_utils.send_to_sqs(retries.queue_url_from_arn(record['eventSourceARN']), data, delay_seconds=delay)
+        return True
+
+    print(f"Error processing file after {attempt} attempt(s): {str(error)}")
+    telegram_utils.send_message(
+        data['chat_id'],
+        f"❌ Failed to process file: {str(error)}",
+        data['message_id']
+    )
+    # The rest of the album no longer waits for this file
+    if data.get('media_group_id') and state_table is not None:
+        if not fail_album_part(state_table, data['media_group_id'], data['message_id']).get('emitted'):
+            schedule_album_settle(data)
+    return True
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
-    for record in event['Records']:
-        try:
-            data = json.loads(record['body'])
-            
+    failed_ids = []
+    with telegram_utils.batch_sends():
+        for record in event['Records']:
+            try:
+                with timed('json.parse'):
+                    data = payload.decode(record['body'])
+                tracing.receive(data)
+            except Exception as e:
+                print(f"Error decoding message: {str(e)}")
+                # Claim-check bodies are read from S3, which can fail transiently; let SQS redeliver
+                # those. A malformed body fails the same way every time, so it is dropped.
+                if retries.is_transient(e):
+                    failed_ids.append(record['messageId'])
+                continue
+
             try:
                 # Process the file
                 s3_key = process_file(data)
-                
-                # Forward to processing queue with uploaded file info
+
+                # Index the file, then forward to processing queue with uploaded file info
                 if s3_key:
-                    data['uploaded_file'] = s3_key
-                    telegram_utils.send_to_sqs(PROCESSING_QUEUE_URL, data)
-                
+                    index_upload(data, s3_key)
+                    forward_upload(data, s3_key)
+
             except Exception as e:
-                telegram_utils.send_message(
-                    data['chat_id'],
-                    f"❌ Failed to process file: {str(e)}",
-                    data['message_id']
-                )
-                raise e
-                
-        except Exception as e:
-            print(f"Error processing message: {str(e)}")
-            continue
+                try:
+                    if not handle_failure(record, data, e):
+                        failed_ids.append(record['messageId'])
+                except Exception as failure_error:
+                    print(f"Error handling failed file: {str(failure_error)}")
+                    failed_ids.append(record['messageId'])
     
     return {
         'statusCode': 200,
-        'body': json.dumps('Processing complete')
+        'body': json.dumps('Processing complete'),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]
     } 
\ No newline at end of file
@@ -1,48 +1,99 @@
 import json
 import os
-import urllib3
 from common.telegram_utils import TelegramUtils
+from common.telegram_api import TelegramClient, PREWARM_ON_INIT
+from common.attachments import (
+    STATUS_CONFIRMED, STATUS_DELETED, get_attachments, get_album_attachments, set_status, delete_attachments
+)
+from common.metrics import timed, instrument_handler
+from common.profiling import profile_handler
+from common import aws, payload, tracing
 
 # Initialize clients
-http = urllib3.PoolManager()
+telegram = TelegramClient()
 telegram_utils = TelegramUtils()
+s3 = aws.lazy_client('s3')
+if PREWARM_ON_INIT:
+    telegram.prewarm()
+
+FILE_STORAGE_BUCKET = os.environ.get('FILE_STORAGE_BUCKET')
+# Files are looked up in the attachment index written by the attachment processor
+state_table = aws.lazy_table(os.environ['STATE_TABLE']) if 'STATE_TABLE' in os.environ else None
 
 def answer_callback_query(callback_id, text=None):
     """Answer callback query to remove loading state"""
-    url = f"https://api.telegram.org/bot{os.environ['TELEGRAM_BOT_TOKEN']}/answerCallbackQuery"
-    
-    data = {'callback_query_id': callback_id}
-    if text:
-        data['text'] = text
-        
-    response = http.request('POST', url, fields=data)
-    if response.status != 200:
-        raise Exception(f"Failed to answer callback query: {response.data.decode('utf-8')}")
+    telegram.answer_callback_query(callback_id, text)
+
+def find_attachments(chat_id, target):
+    """Index entries of the file or album a button refers to, deleted ones included
+
+    Args:
+        target (str): callback_data without the action, '{message_id}' or 'album_{media_group_id}'
+    """
+    if state_table is None:
+        return []
+    if target.startswith('album_'):
+        return get_album_attachments(state_table, chat_id, target[len('album_'):])
+    return get_attachments(state_table, chat_id, [int(target)])
+
+def confirm_files(chat_id, callback_id, target):
+    """Mark the files a Confirm button refers to as confirmed"""
+    items = [item for item in find_attachments(chat_id, target) if item['status'] != STATUS_DELETED]
+    if not items:
+        answer_callback_query(callback_id, "File not found")
+        return
+
+    set_status(state_table, items, STATUS_CONFIRMED)
+    what = 'album' if target.startswith('album_') else 'file'
+    answer_callback_query(callback_id, f"✅ {what.capitalize()} confirmed!")
+    telegram_utils.send_message(chat_id, f"Thank you for confirming the {what}!")
+
+def delete_files(chat_id, callback_id, target):
+    """Delete the files a Delete button refers to from S3"""
+    items = [item for item in find_attachments(chat_id, target) if item['status'] != STATUS_DELETED]
+    if not items:
+        answer_callback_query(callback_id, "File not found or already deleted")
+        return
+
+    failed = delete_attachments(s3, FILE_STORAGE_BUCKET, state_table, items)
+    if failed:
+        print(f"Error deleting files: {failed}")
+        answer_callback_query(callback_id, "❌ Some files could not be deleted, please try again")
+        return
+
+    answer_callback_query(callback_id, "🗑 Deleted")
+    if len(items) == 1:
+        telegram_utils.send_message(chat_id, "File has been deleted.")
+    else:
+        telegram_utils.send_message(chat_id, f"{len(items)} files have been deleted.")
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
-    for record in event['Records']:
-        try:
-            data = json.loads(record['body'])
-            callback_id = data['callback_id']
-            chat_id = data['chat_id']
-            message_id = data['message_id']
-            callback_data = data['data']
-            user_id = data['user_id']
+    with telegram_utils.batch_sends():
+        for record in event['Records']:
+            try:
+                with timed('json.parse'):
+                    data = payload.decode(record['body'])
+                tracing.receive(data)
+                callback_id = data['callback_id']
+                chat_id = data['chat_id']
+                message_id = data['message_id']
+                callback_data = data['data']
+                user_id = data['user_id']
             
-            # Process callback data and send appropriate response
-            if callback_data.startswith('confirm_'):
-                answer_callback_query(callback_id, "✅ File confirmed!")
-                telegram_utils.send_message(chat_id, "Thank you for confirming the file!")
-            elif callback_data.startswith('delete_'):
-                answer_callback_query(callback_id, "❌ File marked for deletion")
-                telegram_utils.send_message(chat_id, "File will be deleted (not implemented yet)")
-            else:
-                answer_callback_query(callback_id, "Unknown action")
+                # Process callback data and send appropriate response
+                if callback_data.startswith('confirm_'):
+                    confirm_files(chat_id, callback_id, callback_data[len('confirm_'):])
+                elif callback_data.startswith('delete_'):
+                    delete_files(chat_id, callback_id, callback_data[len('delete_'):])
+                else:
+                    answer_callback_query(callback_id, "Unknown action")
             
-        except Exception as e:
-            print(f"Error processing callback: {str(e)}")
-            print(f"Callback data: {json.dumps(data)}")
-            continue
+            except Exception as e:
+                print(f"Error processing callback: {str(e)}")
+                print(f"Callback data: {json.dumps(data)}")
+                continue
     
     return {
         'statusCode': 200,
@@ -1,9 +1,14 @@
 import json
 import os
 from common.telegram_utils import TelegramUtils
+from common.albums import claim_settled_album
+from common.metrics import timed, instrument_handler
+from common.profiling import profile_handler
+from common import aws, payload, tracing
 
 # Initialize telegram utils
 telegram_utils = TelegramUtils()
+state_table = aws.lazy_table(os.environ['STATE_TABLE']) if 'STATE_TABLE' in os.environ else None
 
 ERROR_MESSAGE = """
 ❌ Unknown command.
@@ -16,38 +21,79 @@ Check out the project:
 https://github.com/dmgritsan/aws-serverless-tg-bot
 """
 
+def handle_album_settle(data, token):
+    """Reply once for a whole album once all of its files are done
+
+    Args:
+        data: The album_settle message
+        token: ID of the settle check's SQS record, the same when SQS redelivers it
+    """
+    album = claim_settled_album(state_table, data['media_group_id'], token)
+    if album is None:
+        return
+
+    first_message_id = album['parts'][0]['message_id']
+    files = '\n'.join(part['s3_key'] for part in album['parts'])
+    buttons = [
+        [{'text': '✅ Confirm', 'callback_data': f"confirm_album_{album['media_group_id']}"}],
+        [{'text': '❌ Delete', 'callback_data': f"delete_album_{album['media_group_id']}"}]
+    ]
+    telegram_utils.send_message(
+        album['chat_id'],
+        f"✅ Album of {len(album['parts'])} files has been uploaded successfully:\n{files}",
+        first_message_id,
+        inline_buttons=buttons
+    )
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
-    for record in event['Records']:
-        try:
-            data = json.loads(record['body'])
+    failed_ids = []
+    with telegram_utils.batch_sends():
+        for record in event['Records']:
+            try:
+                with timed('json.parse'):
+                    data = payload.decode(record['body'])
+                tracing.receive(data)
             
-            # Handle messages with uploaded files
-            if 'uploaded_file' in data:
-                # Create test buttons
-                buttons = [
-                    [{'text': '✅ Confirm', 'callback_data': f'confirm_{data["message_id"]}'}],
-                    [{'text': '❌ Delete', 'callback_data': f'delete_{data["message_id"]}'}]
-                ]
+                # Handle albums whose files have all been uploaded
+                if data.get('message_type') == 'album_settle':
+                    try:
+                        handle_album_settle(data, record['messageId'])
+                    except Exception as e:
+                        # Left to SQS to redeliver, otherwise the album would never be answered
+                        print(f"Error settling album: {str(e)}")
+                        failed_ids.append(record['messageId'])
+                    continue
+            
+                # Handle messages with uploaded files
+                if 'uploaded_file' in data:
+                    # Create test buttons
+                    buttons = [
+                        [{'text': '✅ Confirm', 'callback_data': f'confirm_{data["message_id"]}'}],
+                        [{'text': '❌ Delete', 'callback_data': f'delete_{data["message_id"]}'}]
+                    ]
                 
-                telegram_utils.send_message(
-                    data['chat_id'],
-                    f"✅ File has been uploaded successfully: {data['uploaded_file']}",
-                    data['message_id'],
-                    inline_buttons=buttons
-                )
-                continue
+                    telegram_utils.send_message(
+                        data['chat_id'],
+                        f"✅ File has been uploaded successfully: {data['uploaded_file']}",
+                        data['message_id'],
+                        inline_buttons=buttons
+                    )
+                    continue
             
-            # Handle text messages
-            if data.get('text'):
-                # Here you can add your text processing logic
-                # For now, just send error message for unknown commands
-                telegram_utils.send_message(data['chat_id'], ERROR_MESSAGE, data['message_id'])
+                # Handle text messages
+                if data.get('text'):
+                    # Here you can add your text processing logic
+                    # For now, just send error message for unknown commands
+                    telegram_utils.send_message(data['chat_id'], ERROR_MESSAGE, data['message_id'])
             
-        except Exception as e:
-            print(f"Error processing message: {str(e)}")
-            continue
+            except Exception as e:
+                print(f"Error processing message: {str(e)}")
+                continue
     
     return {
         'statusCode': 200,
-        'body': json.dumps('Processing complete')
-    } 
\ No newline at end of file
+        'body': json.dumps('Processing complete'),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]
+    }
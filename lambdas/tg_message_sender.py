@@ -1,63 +1,409 @@
 import json
+import math
 import os
-import urllib3
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from common.telegram_utils import TelegramUtils
+from common.telegram_api import TelegramClient, TelegramError, TelegramRateLimitError, PREWARM_ON_INIT
+from common.metrics import timed, instrument_handler
+from common.profiling import profile_handler
+from common import payload, retries, tracing
+
+# Constants
+OUTGOING_QUEUE_URL = os.environ['OUTGOING_QUEUE_URL']
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 10))
+# Limits are kept just under Telegram's documented ones (30 msg/s overall,
+# 1 msg/s per chat, 20 msg/min per group). They apply per Lambda instance.
+GLOBAL_RATE_LIMIT = float(os.environ.get('GLOBAL_RATE_LIMIT', 28))
+CHAT_RATE_LIMIT = float(os.environ.get('CHAT_RATE_LIMIT', 1))
+GROUP_RATE_LIMIT_PER_MINUTE = float(os.environ.get('GROUP_RATE_LIMIT_PER_MINUTE', 19))
+MAX_TRACKED_CHATS = 10000
+# Consecutive messages to one chat in a batch are sent as one; the event source's
+# batching window decides how long messages wait for company
+COALESCE_MESSAGES = os.environ.get('COALESCE_MESSAGES', 'true').lower() == 'true'
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit, in UTF-16 code units
+# Delay before retrying the rest of a split message after a transient error, so sent parts aren't repeated
+PART_RETRY_DELAY_SECONDS = 5
+
+# A tag, an entity or a single character: the units HTML text can be split between
+HTML_ATOM = re.compile(r'<[^<>]*>|&#?\w+;|.', re.S)
+# Tags whose whitespace is significant, so a split inside them trims nothing
+PREFORMATTED_TAGS = {'pre', 'code'}
 
 # Initialize clients
-http = urllib3.PoolManager()
-telegram_utils = TelegramUtils(require_outgoing_queue=False)
+telegram = TelegramClient(pool_size=MAX_WORKERS)
+telegram_utils = TelegramUtils()
+if PREWARM_ON_INIT:
+    telegram.prewarm()
 
-# Constants
-TELEGRAM_BOT_TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until one token is available"""
+        self._refill(now)
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        """Hold the bucket empty for `seconds`, e.g. after a 429"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def is_idle(self, now):
+        """Whether the bucket is full again and can be forgotten"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+class RateLimitScheduler:
+    """Decide whether a message can go out now or how long it must wait
+
+    Tracks one global bucket plus per-chat buckets. Group chats (negative
+    chat IDs) get an extra per-minute bucket on top of the per-chat one.
+    Safe to share between sender threads.
+    """
+    def __init__(self, global_rate=GLOBAL_RATE_LIMIT, chat_rate=CHAT_RATE_LIMIT,
+                 group_rate_per_minute=GROUP_RATE_LIMIT_PER_MINUTE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate_per_minute = group_rate_per_minute
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def _buckets_for(self, chat_id, now):
+        chat_id = str(chat_id)
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) >= MAX_TRACKED_CHATS:
+                self._forget_idle_chats(now)
+            buckets = [TokenBucket(self.chat_rate, 1)]
+            if chat_id.startswith('-'):
+                buckets.append(TokenBucket(self.group_rate_per_minute / 60, self.group_rate_per_minute))
+            self.chat_buckets[chat_id] = buckets
+        return [self.global_bucket] + self.chat_buckets[chat_id]
+
+    def _forget_idle_chats(self, now):
+        for chat_id in [c for c, buckets in self.chat_buckets.items() if all(b.is_idle(now) for b in buckets)]:
+            del self.chat_buckets[chat_id]
+
+    def reserve(self, chat_id):
+        """Take a send slot for the chat. Returns 0 on success, otherwise seconds to wait"""
+        with self.lock:
+            now = time.monotonic()
+            buckets = self._buckets_for(chat_id, now)
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait > 0:
+                return wait
+
+            for bucket in buckets:
+                bucket.consume(now)
+            return 0
+
+    def slot_seconds(self, chat_id):
+        """Seconds between two messages to the chat at its sustained rate"""
+        slot = 1 / self.chat_rate
+        if str(chat_id).startswith('-'):
+            slot = max(slot, 60 / self.group_rate_per_minute)
+        return slot
+
+    def block(self, chat_id, retry_after):
+        """Honour a 429 retry_after for the chat"""
+        with self.lock:
+            now = time.monotonic()
+            for bucket in self.chat_buckets.get(str(chat_id), []):
+                bucket.block(now, retry_after)
+
+# Kept at module level so limits carry over between warm invocations
+scheduler = RateLimitScheduler()
 
 def send_telegram_message(chat_id, message, reply_to_message_id=None, reply_markup=None):
-    """Send message to Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    
-    data = {
-        'chat_id': chat_id,
-        'text': message,
-        'parse_mode': 'HTML'
-    }
-    
-    if reply_to_message_id:
-        data['reply_to_message_id'] = reply_to_message_id
-        
-    if reply_markup:
-        data['reply_markup'] = json.dumps(reply_markup)
-    
-    response = http.request(
-        'POST',
-        url,
-        fields=data
+    """Send message to Telegram and return the sent message"""
+    return telegram.send_message(chat_id, message, reply_to_message_id, reply_markup)
+
+def requeue_messages(messages):
+    """Put messages back on the outgoing queue, each to be sent after its delay
+
+    Args:
+        messages: List of (message, delay in seconds) pairs
+
+    Returns:
+        list: Positions in `messages` of the ones that could not be requeued
+    """
+    return telegram_utils.send_all_to_sqs(
+        OUTGOING_QUEUE_URL, [(message, max(1, math.ceil(delay))) for message, delay in messages]
     )
-    
-    if response.status != 200:
-        raise Exception(f"Failed to send message: {response.data.decode('utf-8')}")
-    
-    return json.loads(response.data.decode('utf-8'))
 
-def lambda_handler(event, context):
-    for record in event['Records']:
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def split_html(text, limit=MAX_MESSAGE_LENGTH):
+    """Split HTML text into parts of at most `limit` UTF-16 code units
+
+    Parts end at a line break or space when there is one, never inside a tag
+    or entity. Tags open at a split are closed at the end of the part and
+    reopened at the start of the next. The line break or space a part ends at
+    is dropped, unless the split is inside a <pre> or <code> block.
+    """
+    if utf16_len(text) <= limit:
+        return [text]
+
+    atoms = HTML_ATOM.findall(text)
+    parts = []
+    stack = []  # Open tags as (name, opening tag)
+    start = 0
+    while start < len(atoms):
+        prefix = ''.join(tag for _, tag in stack)
+        length = utf16_len(prefix)
+        open_tags = list(stack)
+        breaks = {}  # '\n' or ' ' -> (index after it, open tags there)
+        end = start
+        while end < len(atoms):
+            atom = atoms[end]
+            closing = sum(len(name) + 3 for name, _ in open_tags)
+            if length + utf16_len(atom) + closing > limit and end > start:
+                break
+            length += utf16_len(atom)
+            if atom.startswith('</'):
+                name = atom[2:-1].strip()
+                for i in range(len(open_tags) - 1, -1, -1):
+                    if open_tags[i][0] == name:
+                        del open_tags[i]
+                        break
+            elif atom.startswith('<') and re.match(r'<\w', atom):
+                open_tags.append((re.match(r'<(\w+)', atom).group(1), atom))
+            end += 1
+            if atom in ('\n', ' '):
+                breaks[atom] = (end, list(open_tags))
+
+        if end < len(atoms):
+            # Prefer a line break unless it would leave the part less than half full
+            newline, space = breaks.get('\n'), breaks.get(' ')
+            if newline and (not space or newline[0] - start > (end - start) // 2):
+                end, open_tags = newline
+            elif space:
+                end, open_tags = space
+
+        body_end = end
+        if end < len(atoms) and atoms[end - 1] in ('\n', ' ') and \
+                not any(name in PREFORMATTED_TAGS for name, _ in open_tags):
+            body_end -= 1
+        body = ''.join(atoms[start:body_end])
+        if body.strip():
+            parts.append(prefix + body + ''.join(f"</{name}>" for name, _ in reversed(open_tags)))
+        stack = open_tags
+        start = end
+
+    return parts
+
+def can_merge(first, second):
+    """Whether two messages to the same chat can be sent as one"""
+    for message in (first, second):
+        markup = message.get('reply_markup')
+        if markup and set(markup) != {'inline_keyboard'}:
+            return False
+    # Identical keyboards stacked under one text can't tell which part they act on
+    if first.get('reply_markup') and second.get('reply_markup'):
+        return False
+    # In groups, replies to different messages are usually to different users
+    replies = {message.get('reply_to_message_id') for message in (first, second)} - {None}
+    if len(replies) > 1 and str(first['chat_id']).startswith('-'):
+        return False
+    return utf16_len(first['message']) + utf16_len(second['message']) + 2 <= MAX_MESSAGE_LENGTH
+
+def merge_messages(first, second):
+    """Combine two messages: texts joined by a blank line, keeping either's keyboard"""
+    merged = dict(first)
+    merged['message'] = f"{first['message']}\n\n{second['message']}"
+    merged['reply_to_message_id'] = first.get('reply_to_message_id') or second.get('reply_to_message_id')
+    markup = first.get('reply_markup') or second.get('reply_markup')
+    if markup:
+        merged['reply_markup'] = markup
+    return merged
+
+def plan_chat_messages(items):
+    """Turn a chat's queued messages into the messages to send
+
+    Consecutive mergeable messages are coalesced and text over Telegram's
+    limit is split. Every part of a split message keeps the same sources list.
+
+    Args:
+        items: List of (record, message) pairs in queue order
+
+    Returns:
+        List of (sources, message) where sources are the (record, message)
+        pairs the message was built from
+    """
+    planned = []
+    for record, message in items:
+        if COALESCE_MESSAGES and planned and can_merge(planned[-1][1], message):
+            sources, previous = planned[-1]
+            planned[-1] = (sources + [(record, message)], merge_messages(previous, message))
+        else:
+            planned.append(([(record, message)], message))
+
+    result = []
+    for sources, message in planned:
+        parts = split_html(message['message'])
+        for index, text in enumerate(parts):
+            part = dict(message, message=text)
+            # Reply to the original on the first part, show the keyboard under the last
+            if index > 0:
+                part.pop('reply_to_message_id', None)
+            if index < len(parts) - 1:
+                part.pop('reply_markup', None)
+            result.append((sources, part))
+    return result
+
+def send_chat_messages(chat_id, items):
+    """Send one chat's messages in order, stopping at the first one that can't go out
+
+    Runs in a worker thread, so it only talks to Telegram and the scheduler.
+    Everything after a deferred or failed message gets the same outcome to
+    keep the chat's order. Deferred messages are delayed one send slot apart,
+    so they come back in order and can go out one after another.
+
+    Args:
+        chat_id: Telegram chat ID
+        items: List of (sources, message) pairs from plan_chat_messages()
+
+    Returns:
+        List of (sources, message, outcome, value) where outcome is 'sent'
+        (value is the sent Telegram message), 'deferred' (value is the delay in
+        seconds), 'failed' or 'dropped'
+    """
+    def defer(rest, wait):
+        slot = scheduler.slot_seconds(chat_id)
+        return [(s, m, 'deferred', wait + i * slot) for i, (s, m) in enumerate(rest)]
+
+    results = []
+    for index, (sources, message) in enumerate(items):
+        rest = items[index:]
+
+        # Defer instead of sleeping when the chat or bot is over its limit
+        wait = scheduler.reserve(chat_id)
+        if wait > 0:
+            return results + defer(rest, wait)
+
         try:
-            message = json.loads(record['body'])
-            chat_id = message['chat_id']
-            text = message['message']
-            reply_to = message.get('reply_to_message_id')
-            reply_markup = message.get('reply_markup')
-            
-            # Send message to Telegram
-            response = send_telegram_message(chat_id, text, reply_to, reply_markup)
-            
-            # Log the sent message using the response data
-            telegram_utils.log_message(response['result'], message_type='bot_message')
-            
+            response = send_telegram_message(
+                chat_id,
+                message['message'],
+                message.get('reply_to_message_id'),
+                message.get('reply_markup')
+            )
+        except TelegramRateLimitError as e:
+            scheduler.block(chat_id, e.retry_after)
+            return results + defer(rest, e.retry_after)
         except Exception as e:
             print(f"Error sending message: {str(e)}")
             print(f"Message data: {json.dumps(message)}")
+            if isinstance(e, TelegramError) and e.is_permanent:
+                results.append((sources, message, 'dropped', None))
+                continue
+            if results and results[-1][0] is sources and results[-1][2] == 'sent':
+                # Earlier parts of this message went out, so requeue the rest instead of redelivering it all
+                return results + defer(rest, PART_RETRY_DELAY_SECONDS)
+            return results + [(s, m, 'failed', None) for s, m in rest]
+
+        if results and results[-1][0] is sources:
+            results.append((sources, message, 'sent', response))
             continue
-    
+        for _, source_message in sources:
+            tracing.reply_sent(source_message)
+        results.append((sources, message, 'sent', response))
+
+    return results
+
+def process_chat(chat_id, items):
+    """Plan and send one chat's messages, failing only this chat's records on an unexpected error
+
+    Args:
+        chat_id: Telegram chat ID
+        items: List of (record, message) pairs in queue order
+    """
+    try:
+        return send_chat_messages(chat_id, plan_chat_messages(items))
+    except Exception as e:
+        print(f"Error sending messages to chat {chat_id}: {str(e)}")
+        return [([(record, message)], message, 'failed', None) for record, message in items]
+
+@instrument_handler
+@profile_handler
+def lambda_handler(event, context):
+    # Group records by chat, keeping queue order within each chat
+    chats = {}
+    decode_failed_ids = []
+    for record in event['Records']:
+        try:
+            with timed('json.parse'):
+                message = payload.decode(record['body'])
+        except Exception as e:
+            print(f"Error decoding message: {str(e)}")
+            # Claim-check bodies are read from S3, which can fail transiently; let SQS redeliver
+            # those. A malformed body fails the same way every time, so it is dropped.
+            if retries.is_transient(e):
+                decode_failed_ids.append(record['messageId'])
+            else:
+                print(f"Message data: {record['body']}")
+            continue
+
+        try:
+            if not isinstance(message.get('message'), str) or 'chat_id' not in message:
+                raise ValueError("Message needs 'chat_id' and a 'message' text")
+            tracing.receive(message)
+            chats.setdefault(str(message['chat_id']), []).append((record, message))
+        except Exception as e:
+            print(f"Error parsing message: {str(e)}")
+            print(f"Message data: {record['body']}")
+
+    # Different chats are sent concurrently, each chat sequentially
+    results = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for chat_results in executor.map(lambda chat: process_chat(*chat), chats.items()):
+            results.extend(chat_results)
+
+    # dict keeps the order and drops records shared by several parts
+    failed_ids = dict.fromkeys(decode_failed_ids)
+    failed_ids.update({
+        record['messageId']: None
+        for sources, _, outcome, _ in results if outcome == 'failed'
+        for record, _ in sources
+    })
+    deferred = [(sources, message, delay) for sources, message, outcome, delay in results if outcome == 'deferred']
+
+    try:
+        not_requeued = requeue_messages([(message, delay) for _, message, delay in deferred])
+    except Exception as e:
+        print(f"Error requeueing messages: {str(e)}")
+        not_requeued = range(len(deferred))
+    # Let SQS redeliver whatever could not be requeued
+    failed_ids.update((record['messageId'], None) for i in not_requeued for record, _ in deferred[i][0])
+
+    try:
+        with telegram_utils.batch_logs():
+            for _, _, outcome, sent_message in results:
+                if outcome == 'sent':
+                    # Log the sent message as Telegram returned it
+                    telegram_utils.log_message(sent_message, message_type='bot_message')
+    except Exception as e:
+        # Messages are already delivered, so a logging failure must not fail them
+        print(f"Error writing message logs: {str(e)}")
+
     return {
-        'statusCode': 200,
-        'body': json.dumps('Message sending complete')
-    } 
\ No newline at end of file
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]
+    }
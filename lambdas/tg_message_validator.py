@@ -1,17 +1,50 @@
 import json
-import boto3
 import os
+import random
+import time
 from botocore.exceptions import ClientError
 from common.telegram_utils import TelegramUtils
+from common.cache import TTLCache
+from common.throttle import Throttle
+from common.models import Message
+from common.albums import expect_album_part
+from common.metrics import timed, instrument_handler
+from common.profiling import profile_handler
+from common import aws, tracing
 
 # Initialize these as None
 dynamodb = None
 message_logs_table = None
+state_table = None
 sqs = None
 processing_queue_url = None
 upload_queue_url = None
+large_upload_queue_url = None
 callback_queue_url = None
 telegram_utils = None
+throttle = None
+
+MEDIA_GROUP_CLAIM_TTL_SECONDS = 60 * 60
+# Bots can only download files up to 20MB with getFile
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+# Files above this size, or of unknown size, go to the large upload queue
+LARGE_FILE_THRESHOLD = int(os.environ.get('LARGE_FILE_THRESHOLD', 5 * 1024 * 1024))
+UPDATE_CLAIM_TTL_SECONDS = 24 * 60 * 60  # Telegram gives up redelivering well within a day
+
+# Sliding-window rate limits per user and per chat, 0 disables one
+THROTTLE_USER_LIMIT = int(os.environ.get('THROTTLE_USER_LIMIT', 30))
+THROTTLE_CHAT_LIMIT = int(os.environ.get('THROTTLE_CHAT_LIMIT', 120))
+THROTTLE_WINDOW_SECONDS = float(os.environ.get('THROTTLE_WINDOW_SECONDS', 60))
+# What happens to updates over a limit: 'drop' them, let a 'sample' of them
+# through, or 'deprioritise' them by delaying their queue messages
+THROTTLE_ACTION = os.environ.get('THROTTLE_ACTION', 'drop')
+THROTTLE_SAMPLE_RATE = float(os.environ.get('THROTTLE_SAMPLE_RATE', 0.1))
+THROTTLE_DELAY_SECONDS = int(os.environ.get('THROTTLE_DELAY_SECONDS', 300))
+
+# update_ids already handled by this instance, checked before DynamoDB
+recent_update_ids = TTLCache(max_size=4096, ttl_seconds=UPDATE_CLAIM_TTL_SECONDS)
+# update_ids already counted against the rate limits, so redeliveries aren't counted again
+counted_update_ids = TTLCache(max_size=4096, ttl_seconds=UPDATE_CLAIM_TTL_SECONDS)
 
 WELCOME_MESSAGE = """
 👋 Welcome to AWS Serverless TG Bot Demo!
@@ -41,18 +74,45 @@ Available commands:
 /help - Show this help message
 """
 
+def load_static_commands():
+    """Commands with a fixed reply, mapped to their reply text
+
+    Read from the STATIC_COMMANDS environment variable as a JSON object, or
+    from the JSON file STATIC_COMMANDS_FILE points to. Without either, /start
+    and /help get the built-in replies.
+    """
+    if os.environ.get('STATIC_COMMANDS'):
+        commands = json.loads(os.environ['STATIC_COMMANDS'])
+    elif os.environ.get('STATIC_COMMANDS_FILE'):
+        with open(os.environ['STATIC_COMMANDS_FILE'], encoding='utf-8') as f:
+            commands = json.load(f)
+    else:
+        return {'/start': WELCOME_MESSAGE, '/help': HELP_MESSAGE}
+    if not isinstance(commands, dict) or not all(isinstance(text, str) for text in commands.values()):
+        raise ValueError('Static commands must be a JSON object of command to reply text')
+    return commands
+
+# The reply goes back to Telegram in the webhook response itself, skipping
+# the outgoing queue and the sender Lambda
+STATIC_COMMANDS = load_static_commands()
+# Set INLINE_REPLIES=false to send static replies through the outgoing queue instead
+INLINE_REPLIES = os.environ.get('INLINE_REPLIES', 'true').lower() == 'true'
+
 def get_aws_resources():
     """Lazy initialization of AWS resources"""
-    global dynamodb, message_logs_table, sqs, processing_queue_url, upload_queue_url, callback_queue_url, telegram_utils
+    global dynamodb, message_logs_table, state_table, sqs, processing_queue_url, upload_queue_url, large_upload_queue_url, callback_queue_url, telegram_utils, throttle
     
     if dynamodb is None:
-        dynamodb = boto3.resource('dynamodb')
+        dynamodb = aws.resource('dynamodb')
         message_logs_table = dynamodb.Table(os.environ['MESSAGE_LOGS_TABLE'])
+        state_table = dynamodb.Table(os.environ['STATE_TABLE'])
+        throttle = Throttle(THROTTLE_USER_LIMIT, THROTTLE_CHAT_LIMIT, THROTTLE_WINDOW_SECONDS, table=state_table)
     
     if sqs is None:
-        sqs = boto3.client('sqs')
+        sqs = aws.client('sqs')
         processing_queue_url = os.environ['PROCESSING_QUEUE_URL']
         upload_queue_url = os.environ['UPLOAD_QUEUE_URL']
+        large_upload_queue_url = os.environ.get('LARGE_UPLOAD_QUEUE_URL', upload_queue_url)
         callback_queue_url = os.environ['CALLBACK_QUEUE_URL']
     
     if telegram_utils is None:
@@ -61,89 +121,275 @@ def get_aws_resources():
     return dynamodb, message_logs_table, sqs, processing_queue_url, upload_queue_url, callback_queue_url, telegram_utils
 
 def is_first_media_group_message(media_group_id):
+    """Check if this is the first message with this media_group_id
+
+    Album messages arrive concurrently, so the check is a single conditional
+    put of a short-lived marker: exactly one message of the group creates it.
+    """
     if not media_group_id:
         return True
-    """Check if this is the first message with this media_group_id"""
     try:
-        response = message_logs_table.query(
-            IndexName='MediaGroupIndex',
-            KeyConditionExpression='media_group_id = :mgid',
-            ExpressionAttributeValues={
-                ':mgid': media_group_id
-            },
-            Limit=1  # We only need to know if there's more than one
-        )
-        return len(response.get('Items', [])) == 0
+        with timed('dynamodb.claim_media_group'):
+            state_table.put_item(
+                Item={
+                    'pk': f"media_group#{media_group_id}",
+                    'ttl': int(time.time()) + MEDIA_GROUP_CLAIM_TTL_SECONDS
+                },
+                ConditionExpression='attribute_not_exists(pk)'
+            )
+        return True
     except ClientError as e:
-        print(f"Error querying media group: {e}")
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Error claiming media group: {e}")
+        return False
+
+def get_bot_id():
+    """The bot's user ID is the part of the token before the colon"""
+    return os.environ['TELEGRAM_BOT_TOKEN'].split(':')[0]
+
+def is_recent_update(update_id):
+    """Whether this instance already handled the update, without a DynamoDB call"""
+    return update_id is not None and f"{get_bot_id()}#{update_id}" in recent_update_ids
+
+def claim_update(update_id):
+    """Check if this update is new, marking it as seen
+
+    Telegram redelivers updates when the webhook is slow or fails. The first
+    delivery creates a marker with a conditional put; later ones find it and
+    are acknowledged without doing any work.
+    """
+    if update_id is None:
+        return True
+    
+    key = f"{get_bot_id()}#{update_id}"
+    if key in recent_update_ids:
         return False
+    
+    try:
+        with timed('dynamodb.claim_update'):
+            state_table.put_item(
+                Item={
+                    'pk': f"update#{key}",
+                    'ttl': int(time.time()) + UPDATE_CLAIM_TTL_SECONDS
+                },
+                ConditionExpression='attribute_not_exists(pk)'
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            recent_update_ids.set(key, True)
+            return False
+        # Better to handle an update twice than to drop it
+        print(f"Error claiming update: {e}")
+        return True
+    
+    recent_update_ids.set(key, True)
+    return True
+
+def release_update(update_id):
+    """Forget a claimed update so Telegram's redelivery is processed"""
+    if update_id is None:
+        return
+    
+    key = f"{get_bot_id()}#{update_id}"
+    recent_update_ids.delete(key)
+    try:
+        state_table.delete_item(Key={'pk': f"update#{key}"})
+    except ClientError as e:
+        print(f"Error releasing update: {e}")
+
+def get_sender_and_chat(body):
+    """User and chat IDs of a message or callback update, None where missing"""
+    if 'callback_query' in body:
+        callback_query = body['callback_query']
+        return callback_query.get('from', {}).get('id'), callback_query.get('message', {}).get('chat', {}).get('id')
+    message = body.get('message') or {}
+    return message.get('from', {}).get('id'), message.get('chat', {}).get('id')
+
+def shed_action(body):
+    """Decide what to do with an update from a user or chat over its rate limit
 
+    Returns:
+        None to handle the update normally, 'drop' to acknowledge it without
+        doing anything, or 'delay' to handle it with delayed queue messages
+    """
+    update_id = body.get('update_id')
+    if update_id is not None:
+        key = f"{get_bot_id()}#{update_id}"
+        if key in counted_update_ids:
+            # A redelivery, e.g. of an update that failed and was released
+            return None
+        counted_update_ids.set(key, True)
+    if throttle.allow(*get_sender_and_chat(body)):
+        return None
+    if THROTTLE_ACTION == 'deprioritise':
+        return 'delay'
+    if THROTTLE_ACTION == 'sample' and random.random() < THROTTLE_SAMPLE_RATE:
+        return None
+    return 'drop'
+
+def choose_upload_queue(file_info):
+    """Pick the upload queue for an attachment by its size and type
+
+    Returns:
+        The queue URL, or None if the file is too big for the bot to download
+    """
+    file_size = file_info.file_size
+    if file_size is not None and file_size > MAX_DOWNLOAD_SIZE:
+        return None
+    if file_size is None:
+        # Telegram always sends sizes for photos, which are small anyway
+        return upload_queue_url if file_info.type == 'photo' else large_upload_queue_url
+    if file_size > LARGE_FILE_THRESHOLD or (file_info.mime_type or '').startswith('video/'):
+        return large_upload_queue_url
+    return upload_queue_url
+
+def build_file_too_large_message(file_info):
+    return (
+        f"❌ This file is {file_info.file_size / (1024 * 1024):.1f} MB. "
+        f"Bots can only download files up to {MAX_DOWNLOAD_SIZE // (1024 * 1024)} MB, "
+        "please send a smaller one."
+    )
+
+def build_inline_reply(chat_id, text, reply_to_message_id=None):
+    """Build a webhook response that has Telegram call sendMessage for us"""
+    reply = {
+        'method': 'sendMessage',
+        'chat_id': chat_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    }
+    if reply_to_message_id:
+        reply['reply_to_message_id'] = reply_to_message_id
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(reply)
+    }
+
+def build_bot_message(chat_id, text):
+    """Telegram-style message for a reply we never get a sendMessage result for"""
+    return {
+        'message_id': None,
+        'from': {'id': get_bot_id(), 'is_bot': True},
+        'chat': {'id': chat_id},
+        'text': text
+    }
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     # Get AWS resources at the start of handler
-    dynamodb, message_logs_table, sqs, processing_queue_url, upload_queue_url, callback_queue_url, telegram_utils = get_aws_resources()
+    with timed('aws_init'):
+        dynamodb, message_logs_table, sqs, processing_queue_url, upload_queue_url, callback_queue_url, telegram_utils = get_aws_resources()
     
+    update_id = None
     try:
-        # Parse webhook data
-        body = json.loads(event.get('body', '{}'))
-        
-        # Handle callback queries
-        if 'callback_query' in body:
-            callback_data = {
-                'callback_id': body['callback_query']['id'],
-                'chat_id': body['callback_query']['message']['chat']['id'],
-                'message_id': body['callback_query']['message']['message_id'],
-                'data': body['callback_query']['data'],
-                'user_id': body['callback_query']['from']['id']
-            }
-            telegram_utils.send_to_sqs(callback_queue_url, callback_data)
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'status': 'ok'})
-            }
+        with telegram_utils.batch_sends():
+            # Parse webhook data
+            with timed('json.parse'):
+                body = json.loads(event.get('body', '{}'))
+            tracing.begin(body.get('message'))
+            
+            # Redeliveries this instance already handled cost no DynamoDB calls and no rate limit
+            if is_recent_update(body.get('update_id')):
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'status': 'duplicate'})
+                }
+            
+            # Shed updates over the rate limits before anything is written downstream
+            with timed('throttle'):
+                action = shed_action(body)
+            if action == 'drop':
+                print(f"Dropping throttled update {body.get('update_id')}")
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'status': 'throttled'})
+                }
+            delay_seconds = THROTTLE_DELAY_SECONDS if action == 'delay' else None
+            
+            # Acknowledge redelivered updates without doing any work
+            if not claim_update(body.get('update_id')):
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'status': 'duplicate'})
+                }
+            update_id = body.get('update_id')
         
-        message = body.get('message', {})
-        # Handle regular messages (existing code)
-        data = telegram_utils.extract_message_data(message)
-        if not data['user_id'] or not data['chat_id']:
-            print("Error: Invalid message format - missing user or chat data")
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Missing or invalid user/chat data in request'})
-            }
+            # Handle callback queries
+            if 'callback_query' in body:
+                callback_data = {
+                    'callback_id': body['callback_query']['id'],
+                    'chat_id': body['callback_query']['message']['chat']['id'],
+                    'message_id': body['callback_query']['message']['message_id'],
+                    'data': body['callback_query']['data'],
+                    'user_id': body['callback_query']['from']['id']
+                }
+                telegram_utils.send_to_sqs(callback_queue_url, callback_data, delay_seconds=delay_seconds)
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'status': 'ok'})
+                }
         
-        first_media_group_message = is_first_media_group_message(data['media_group_id'])
-        # Log message
-        telegram_utils.log_message(message)
+            # Parse the message once; the queue payload and log item are built from it
+            message = Message.parse(body.get('message', {}))
+            if not message.is_valid:
+                print("Error: Invalid message format - missing user or chat data")
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': 'Missing or invalid user/chat data in request'})
+                }
+            data = message.to_queue_dict()
         
-        # Handle basic commands directly
-        if data['text'] == '/start':
-            telegram_utils.send_message(data['chat_id'], WELCOME_MESSAGE, data['message_id'])
-            return {'statusCode': 200, 'body': json.dumps({'status': 'ok'})}
+            reply_text = STATIC_COMMANDS.get(message.text)
+            if message.file_info:
+                file_queue_url = choose_upload_queue(message.file_info)
+                if file_queue_url is None:
+                    # Reject now instead of after a getFile round trip in the attachment processor
+                    reply_text = build_file_too_large_message(message.file_info)
             
-        elif data['text'] == '/help':
-            telegram_utils.send_message(data['chat_id'], HELP_MESSAGE, data['message_id'])
-            return {'statusCode': 200, 'body': json.dumps({'status': 'ok'})}
+            # Log message, together with an inline reply in the same batch
+            with telegram_utils.batch_logs():
+                telegram_utils.log_message(message)
+                if reply_text and INLINE_REPLIES:
+                    telegram_utils.log_message(
+                        build_bot_message(data['chat_id'], reply_text),
+                        message_type='bot_message'
+                    )
+        
+            # Answer commands and rejected files directly
+            if reply_text:
+                if INLINE_REPLIES:
+                    return build_inline_reply(data['chat_id'], reply_text, data['message_id'])
+                telegram_utils.send_message(data['chat_id'], reply_text, data['message_id'], delay_seconds=delay_seconds)
+                return {'statusCode': 200, 'body': json.dumps({'status': 'ok'})}
         
-        # Route message based on content
-        if 'file_info' in data:
-            # Send to upload queue
-            telegram_utils.send_to_sqs(upload_queue_url, data)
+            # Route message based on content
+            if 'file_info' in data:
+                # The album is handled once every file recorded here is uploaded
+                if message.media_group_id:
+                    expect_album_part(state_table, message.media_group_id, data['chat_id'], data['message_id'])
+
+                # Send to the upload queue for the file's size tier
+                telegram_utils.send_to_sqs(file_queue_url, data, delay_seconds=delay_seconds)
             
-            # Only send notification for first message in media group
-            if first_media_group_message:
-                telegram_utils.send_message(data['chat_id'], "📤 Processing your file...", data['message_id'])
-        else:
-            # Text-only message goes to processing queue
-            telegram_utils.send_to_sqs(processing_queue_url, data)
+                # Only send notification for first message in media group
+                if is_first_media_group_message(message.media_group_id):
+                    telegram_utils.send_message(data['chat_id'], "📤 Processing your file...", data['message_id'], delay_seconds=delay_seconds)
+            else:
+                # Text-only message goes to processing queue
+                telegram_utils.send_to_sqs(processing_queue_url, data, delay_seconds=delay_seconds)
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'status': 'ok'})
-        }
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'status': 'ok'})
+            }
 
     except Exception as e:
         print(f"Error processing webhook: {str(e)}")
         print(f"Event: {json.dumps(event)}")
+        release_update(update_id)
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
@@ -18,6 +18,10 @@ export class ServerlessTgBotStack extends cdk.Stack {
     super(scope, id, props);
 
     const env = props.environment;
+    // Fraction of Lambda invocations that emit per-stage timings as CloudWatch EMF
+    const metricsSampleRate = env === 'dev' ? '1' : '0.05';
+    // Fraction of invocations profiled into the file bucket, off unless asked for
+    const profileSampleRate = process.env.PROFILE_SAMPLE_RATE || '0';
 
     // Create SQS queues with proper configuration
     const outgoingQueue = new sqs.Queue(this, `OutgoingQueue-${env}`, {
@@ -38,6 +42,13 @@ export class ServerlessTgBotStack extends cdk.Stack {
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
+    // Files over LARGE_FILE_THRESHOLD, visibility covers the large processor's timeout
+    const largeUploadQueue = new sqs.Queue(this, `LargeUploadQueue-${env}`, {
+      visibilityTimeout: cdk.Duration.seconds(180),
+      retentionPeriod: cdk.Duration.days(1),
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     const callbackQueue = new sqs.Queue(this, 'CallbackQueue', {
       queueName: `${id}-callback-queue-${env}`,
       visibilityTimeout: cdk.Duration.seconds(60),
@@ -61,6 +72,14 @@ export class ServerlessTgBotStack extends cdk.Stack {
       sortKey: { name: 'timestamp', type: dynamodb.AttributeType.STRING },
     });
 
+    // Small TTL'd items shared between Lambda instances (caches, markers)
+    const botStateTable = new dynamodb.Table(this, `BotState-${env}`, {
+      partitionKey: { name: 'pk', type: dynamodb.AttributeType.STRING },
+      timeToLiveAttribute: 'ttl',
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     // Create S3 bucket for file storage
     const fileStorageBucket = new s3.Bucket(this, `FileStorage-${env}`, {
       removalPolicy: cdk.RemovalPolicy.DESTROY,
@@ -69,6 +88,20 @@ export class ServerlessTgBotStack extends cdk.Stack {
         {
           // Automatically delete objects after 30 days
           expiration: cdk.Duration.days(30),
+          // Deleting a file only adds a delete marker, remove the data it hides
+          noncurrentVersionExpiration: cdk.Duration.days(1),
+        },
+        {
+          // Claim-check payloads only need to outlive the 1 day queue retention
+          prefix: 'payloads/',
+          expiration: cdk.Duration.days(2),
+          noncurrentVersionExpiration: cdk.Duration.days(1),
+        },
+        {
+          // Handler profiles are only looked at while investigating
+          prefix: 'profiles/',
+          expiration: cdk.Duration.days(7),
+          noncurrentVersionExpiration: cdk.Duration.days(1),
         }
       ],
       // Enable versioning for better data protection
@@ -84,15 +117,22 @@ export class ServerlessTgBotStack extends cdk.Stack {
       runtime: lambda.Runtime.PYTHON_3_12,
       handler: 'tg_message_validator.lambda_handler',
       code: lambda.Code.fromAsset(path.join(__dirname, '../lambdas'), {
-        exclude: ['*.*', '!tg_message_validator.py', '!common/telegram_utils.py'],
+        exclude: ['*.*', '!tg_message_validator.py', '!common/*.py'],
       }),
       environment: {
+        METRICS_SAMPLE_RATE: metricsSampleRate,
         MESSAGE_LOGS_TABLE: messageLogsTable.tableName,
+        STATE_TABLE: botStateTable.tableName,
         OUTGOING_QUEUE_URL: outgoingQueue.queueUrl,
         PROCESSING_QUEUE_URL: processingQueue.queueUrl,
         UPLOAD_QUEUE_URL: uploadQueue.queueUrl,
+        LARGE_UPLOAD_QUEUE_URL: largeUploadQueue.queueUrl,
         CALLBACK_QUEUE_URL: callbackQueue.queueUrl,
         TELEGRAM_BOT_TOKEN: process.env.TELEGRAM_BOT_TOKEN || '',
+        // Updates per minute; over-limit updates are dropped, sampled or deprioritised
+        THROTTLE_USER_LIMIT: process.env.THROTTLE_USER_LIMIT || '30',
+        THROTTLE_CHAT_LIMIT: process.env.THROTTLE_CHAT_LIMIT || '120',
+        THROTTLE_ACTION: process.env.THROTTLE_ACTION || 'drop',
       },
       role: new iam.Role(this, 'MessageValidatorRole', {
         assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
@@ -106,15 +146,20 @@ export class ServerlessTgBotStack extends cdk.Stack {
                 effect: iam.Effect.ALLOW,
                 actions: [
                   'dynamodb:PutItem',
-                  'dynamodb:Query',
+                  'dynamodb:BatchWriteItem',
+                  'dynamodb:DeleteItem',
+                  // Rate limit counters
+                  'dynamodb:UpdateItem',
                   'sqs:SendMessage',
                   'sqs:GetQueueUrl'
                 ],
                 resources: [
                   messageLogsTable.tableArn,
+                  botStateTable.tableArn,
                   outgoingQueue.queueArn,
                   processingQueue.queueArn,
                   uploadQueue.queueArn,
+                  largeUploadQueue.queueArn,
                   callbackQueue.queueArn
                 ]
               })
@@ -130,10 +175,12 @@ export class ServerlessTgBotStack extends cdk.Stack {
       runtime: lambda.Runtime.PYTHON_3_12,
       handler: 'tg_message_processor.lambda_handler',
       code: lambda.Code.fromAsset(path.join(__dirname, '../lambdas'), {
-        exclude: ['*.*', '!tg_message_processor.py', '!common/telegram_utils.py'],
+        exclude: ['*.*', '!tg_message_processor.py', '!common/*.py'],
       }),
       environment: {
+        METRICS_SAMPLE_RATE: metricsSampleRate,
         MESSAGE_LOGS_TABLE: messageLogsTable.tableName,
+        STATE_TABLE: botStateTable.tableName,
         OUTGOING_QUEUE_URL: outgoingQueue.queueUrl,
         UPLOAD_QUEUE_URL: uploadQueue.queueUrl,
       },
@@ -162,6 +209,12 @@ export class ServerlessTgBotStack extends cdk.Stack {
                   uploadQueue.queueArn,
                   processingQueue.queueArn
                 ]
+              }),
+              // Reads and claims settled album aggregates
+              new iam.PolicyStatement({
+                effect: iam.Effect.ALLOW,
+                actions: ['dynamodb:GetItem', 'dynamodb:UpdateItem'],
+                resources: [botStateTable.tableArn]
               })
             ]
           })
@@ -173,13 +226,14 @@ export class ServerlessTgBotStack extends cdk.Stack {
     // Add SQS trigger for Message Processor
     messageProcessor.addEventSource(new SqsEventSource(processingQueue, {
       batchSize: 1,
+      reportBatchItemFailures: true,
     }));
 
     const messageSender = new lambda.Function(this, 'TelegramMessageSender', {
       runtime: lambda.Runtime.PYTHON_3_12,
       handler: 'tg_message_sender.lambda_handler',
       code: lambda.Code.fromAsset(path.join(__dirname, '../lambdas'), {
-        exclude: ['*.*', '!tg_message_sender.py', '!common/telegram_utils.py'],
+        exclude: ['*.*', '!tg_message_sender.py', '!common/*.py'],
       }),
       role: new iam.Role(this, 'MessageSenderRole', {
         assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
@@ -191,8 +245,14 @@ export class ServerlessTgBotStack extends cdk.Stack {
             statements: [
               new iam.PolicyStatement({
                 effect: iam.Effect.ALLOW,
-                actions: ['dynamodb:PutItem'],
+                actions: ['dynamodb:PutItem', 'dynamodb:BatchWriteItem'],
                 resources: [messageLogsTable.tableArn]
+              }),
+              // Rate-limited messages are put back on the outgoing queue with a delay
+              new iam.PolicyStatement({
+                effect: iam.Effect.ALLOW,
+                actions: ['sqs:SendMessage'],
+                resources: [outgoingQueue.queueArn]
               })
             ]
           })
@@ -200,63 +260,108 @@ export class ServerlessTgBotStack extends cdk.Stack {
       }),
       timeout: cdk.Duration.seconds(30),
       environment: {
+        METRICS_SAMPLE_RATE: metricsSampleRate,
         MESSAGE_LOGS_TABLE: messageLogsTable.tableName,
+        OUTGOING_QUEUE_URL: outgoingQueue.queueUrl,
         TELEGRAM_BOT_TOKEN: process.env.TELEGRAM_BOT_TOKEN || '',
+        // Rate limits are tracked per instance, so split Telegram's 30 msg/s across maxConcurrency
+        GLOBAL_RATE_LIMIT: '14',
       },
     });
 
     // Add SQS trigger for Message Sender
     messageSender.addEventSource(new SqsEventSource(outgoingQueue, {
-      batchSize: 1,
+      batchSize: 50,
+      maxBatchingWindow: cdk.Duration.seconds(1),
+      maxConcurrency: 2,
+      reportBatchItemFailures: true,
     }));
 
-    // Create Lambda function for attachment processing
-    const attachmentProcessor = new lambda.Function(this, 'TelegramAttachmentProcessor', {
-      runtime: lambda.Runtime.PYTHON_3_12,
-      handler: 'tg_attachment_processor.lambda_handler',
-      code: lambda.Code.fromAsset(path.join(__dirname, '../lambdas'), {
-        exclude: ['*.*', '!tg_attachment_processor.py', '!common/telegram_utils.py'],
-      }),
-      environment: {
-        FILE_STORAGE_BUCKET: fileStorageBucket.bucketName,
-        PROCESSING_QUEUE_URL: processingQueue.queueUrl,
-        OUTGOING_QUEUE_URL: outgoingQueue.queueUrl,
-        TELEGRAM_BOT_TOKEN: process.env.TELEGRAM_BOT_TOKEN || '',
-        MAX_RETRY_ATTEMPTS: '3',
-      },
-      role: new iam.Role(this, 'AttachmentProcessorRole', {
-        assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
-        managedPolicies: [
-          iam.ManagedPolicy.fromAwsManagedPolicyName('service-role/AWSLambdaBasicExecutionRole'),
-        ],
-        inlinePolicies: {
-          'LambdaAccess': new iam.PolicyDocument({
-            statements: [
-              new iam.PolicyStatement({
-                effect: iam.Effect.ALLOW,
-                actions: [
-                  's3:PutObject',
-                  's3:GetObject',
-                  'sqs:SendMessage',
-                  'sqs:GetQueueUrl'
-                ],
-                resources: [
-                  `${fileStorageBucket.bucketArn}/*`,
-                  processingQueue.queueArn,
-                  outgoingQueue.queueArn
-                ]
-              })
-            ]
-          })
-        }
-      }),
-      timeout: cdk.Duration.seconds(60),
-      memorySize: 256,
-    });
+    // Create Lambda functions for attachment processing, one per size tier. Small files
+    // need little memory or time; large ones get more memory (and with it network
+    // bandwidth) and a longer timeout, and never hold up small ones. Files that fail
+    // for a transient reason are put back on the processor's own queue with a delay.
+    const createAttachmentProcessor = (id: string, roleId: string, queue: sqs.Queue, memorySize: number, timeout: cdk.Duration) =>
+      new lambda.Function(this, id, {
+        runtime: lambda.Runtime.PYTHON_3_12,
+        handler: 'tg_attachment_processor.lambda_handler',
+        code: lambda.Code.fromAsset(path.join(__dirname, '../lambdas'), {
+          exclude: ['*.*', '!tg_attachment_processor.py', '!common/*.py'],
+        }),
+        environment: {
+          METRICS_SAMPLE_RATE: metricsSampleRate,
+          FILE_STORAGE_BUCKET: fileStorageBucket.bucketName,
+          PROCESSING_QUEUE_URL: processingQueue.queueUrl,
+          OUTGOING_QUEUE_URL: outgoingQueue.queueUrl,
+          STATE_TABLE: botStateTable.tableName,
+          TELEGRAM_BOT_TOKEN: process.env.TELEGRAM_BOT_TOKEN || '',
+          MAX_RETRY_ATTEMPTS: '5',
+        },
+        role: new iam.Role(this, roleId, {
+          assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
+          managedPolicies: [
+            iam.ManagedPolicy.fromAwsManagedPolicyName('service-role/AWSLambdaBasicExecutionRole'),
+          ],
+          inlinePolicies: {
+            'LambdaAccess': new iam.PolicyDocument({
+              statements: [
+                new iam.PolicyStatement({
+                  effect: iam.Effect.ALLOW,
+                  actions: [
+                    's3:PutObject',
+                    's3:GetObject',
+                    's3:AbortMultipartUpload',
+                    // Lets HEAD on a missing dedup marker return 404 instead of 403
+                    's3:ListBucket',
+                    'sqs:SendMessage',
+                    'sqs:GetQueueUrl'
+                  ],
+                  resources: [
+                    fileStorageBucket.bucketArn,
+                    `${fileStorageBucket.bucketArn}/*`,
+                    processingQueue.queueArn,
+                    outgoingQueue.queueArn,
+                    queue.queueArn
+                  ]
+                }),
+                new iam.PolicyStatement({
+                  effect: iam.Effect.ALLOW,
+                  actions: [
+                    'dynamodb:GetItem',
+                    'dynamodb:PutItem',
+                    // Adds uploaded album files to their aggregate
+                    'dynamodb:UpdateItem',
+                    // Writes the attachment index entries of each file in one call
+                    'dynamodb:BatchWriteItem'
+                  ],
+                  resources: [botStateTable.tableArn]
+                })
+              ]
+            })
+          }
+        }),
+        timeout,
+        // Files are streamed to S3 in 5MB parts, so memory no longer scales with file size
+        memorySize,
+      });
+
+    // Up to LARGE_FILE_THRESHOLD (5MB): one PutObject per file
+    const attachmentProcessor = createAttachmentProcessor(
+      'TelegramAttachmentProcessor', 'AttachmentProcessorRole', uploadQueue, 128, cdk.Duration.seconds(30)
+    );
+    // Up to Telegram's 20MB download limit, or of unknown size
+    const largeAttachmentProcessor = createAttachmentProcessor(
+      'TelegramLargeAttachmentProcessor', 'LargeAttachmentProcessorRole', largeUploadQueue, 512, cdk.Duration.seconds(120)
+    );
 
-    // Add SQS trigger for Attachment Processor
+    // Add SQS triggers for the Attachment Processors
     attachmentProcessor.addEventSource(new SqsEventSource(uploadQueue, {
       batchSize: 1,
+      reportBatchItemFailures: true,
+    }));
+    largeAttachmentProcessor.addEventSource(new SqsEventSource(largeUploadQueue, {
+      batchSize: 1,
+      reportBatchItemFailures: true,
     }));
 
     // Create Lambda function for callback processing
@@ -264,10 +369,13 @@ export class ServerlessTgBotStack extends cdk.Stack {
       runtime: lambda.Runtime.PYTHON_3_12,
       handler: 'tg_callback_processor.lambda_handler',
       code: lambda.Code.fromAsset(path.join(__dirname, '../lambdas'), {
-        exclude: ['*.*', '!tg_callback_processor.py', '!common/telegram_utils.py'],
+        exclude: ['*.*', '!tg_callback_processor.py', '!common/*.py'],
       }),
       environment: {
+        METRICS_SAMPLE_RATE: metricsSampleRate,
         OUTGOING_QUEUE_URL: outgoingQueue.queueUrl,
+        STATE_TABLE: botStateTable.tableName,
+        FILE_STORAGE_BUCKET: fileStorageBucket.bucketName,
         TELEGRAM_BOT_TOKEN: process.env.TELEGRAM_BOT_TOKEN || '',
       },
       role: new iam.Role(this, 'CallbackProcessorRole', {
@@ -287,6 +395,23 @@ export class ServerlessTgBotStack extends cdk.Stack {
                 resources: [
                   outgoingQueue.queueArn
                 ]
+              }),
+              new iam.PolicyStatement({
+                effect: iam.Effect.ALLOW,
+                actions: [
+                  // Confirm and Delete buttons look files up in the attachment index
+                  'dynamodb:GetItem',
+                  'dynamodb:BatchGetItem',
+                  'dynamodb:BatchWriteItem',
+                  'dynamodb:DeleteItem'
+                ],
+                resources: [botStateTable.tableArn]
+              }),
+              new iam.PolicyStatement({
+                effect: iam.Effect.ALLOW,
+                // Also covers DeleteObjects
+                actions: ['s3:DeleteObject'],
+                resources: [`${fileStorageBucket.bucketArn}/*`]
               })
             ]
           })
@@ -300,6 +425,26 @@ export class ServerlessTgBotStack extends cdk.Stack {
       batchSize: 1,
     }));
 
+    // Queue messages over the SQS size limit are offloaded to the file bucket (claim check)
+    for (const fn of [messageValidator, messageProcessor, messageSender, attachmentProcessor, largeAttachmentProcessor, callbackProcessor]) {
+      fn.addEnvironment('PAYLOAD_BUCKET', fileStorageBucket.bucketName);
+      fn.addToRolePolicy(new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ['s3:PutObject', 's3:GetObject'],
+        resources: [`${fileStorageBucket.bucketArn}/payloads/*`]
+      }));
+
+      // Sampled invocations are profiled when PROFILE_SAMPLE_RATE is set at deploy time
+      fn.addEnvironment('PROFILE_SAMPLE_RATE', profileSampleRate);
+      fn.addEnvironment('PROFILE_MODE', process.env.PROFILE_MODE || 'cpu');
+      fn.addEnvironment('PROFILE_OUTPUT', `s3://${fileStorageBucket.bucketName}/profiles/`);
+      fn.addToRolePolicy(new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ['s3:PutObject'],
+        resources: [`${fileStorageBucket.bucketArn}/profiles/*`]
+      }));
+    }
+
     // Create API Gateway
     const api = new apigateway.RestApi(this, 'ServerlessTgBotApi', {
       restApiName: `Serverless Telegram Bot API - ${env}`,
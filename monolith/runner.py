@@ -0,0 +1,245 @@
+"""Run the whole bot in one process, without API Gateway or SQS.
+
+Updates come from getUpdates long polling or a local webhook server and are
+passed to the validator's lambda_handler. The queues are replaced by an
+in-memory transport, and every consumer Lambda runs in its own worker thread,
+taking batches of the same size as in the CDK stack. DynamoDB and S3 are used
+as configured in the environment, or run in-process with --moto.
+
+    python monolith/runner.py --poll
+    python monolith/runner.py --webhook 8080 --moto
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas')
+
+QUEUES = {
+    'UPLOAD_QUEUE_URL': 'memory://upload',
+    'LARGE_UPLOAD_QUEUE_URL': 'memory://upload_large',
+    'PROCESSING_QUEUE_URL': 'memory://processing',
+    'CALLBACK_QUEUE_URL': 'memory://callback',
+    'OUTGOING_QUEUE_URL': 'memory://outgoing',
+}
+
+# (module, queue env vars in priority order, batch size as wired in lib/serverless-tg-bot-stack.ts)
+# A module shares its state between the queues it serves, so each gets a single worker
+STAGES = [
+    ('tg_attachment_processor', ['UPLOAD_QUEUE_URL', 'LARGE_UPLOAD_QUEUE_URL'], 1),
+    ('tg_message_processor', ['PROCESSING_QUEUE_URL'], 1),
+    ('tg_callback_processor', ['CALLBACK_QUEUE_URL'], 1),
+    ('tg_message_sender', ['OUTGOING_QUEUE_URL'], 50),
+]
+
+POLL_TIMEOUT_SECONDS = 30
+# Stand-ins for the queues' visibility timeout and a dead-letter queue
+RETRY_DELAY_SECONDS = 30
+MAX_RECEIVE_COUNT = 5
+
+
+def start_moto():
+    """Run DynamoDB and S3 in-process and create the tables and bucket the Lambdas expect"""
+    from moto import mock_aws
+    import boto3
+
+    for key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        os.environ.setdefault(key, 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.update({
+        'MESSAGE_LOGS_TABLE': 'local-message-logs',
+        'STATE_TABLE': 'local-bot-state',
+        'FILE_STORAGE_BUCKET': 'local-file-storage',
+    })
+
+    mock = mock_aws()
+    mock.start()
+    dynamodb = boto3.resource('dynamodb')
+    dynamodb.create_table(
+        TableName='local-message-logs',
+        KeySchema=[
+            {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    dynamodb.create_table(
+        TableName='local-bot-state',
+        KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    boto3.client('s3').create_bucket(Bucket='local-file-storage')
+    return mock
+
+
+class Monolith:
+    """The Lambdas of the pipeline wired together through an in-memory transport"""
+
+    def __init__(self):
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """Import the handlers with in-memory queue URLs and start a worker per consumer"""
+        for env_var, queue_url in QUEUES.items():
+            os.environ.setdefault(env_var, queue_url)
+        if os.path.abspath(LAMBDAS_DIR) not in sys.path:
+            sys.path.insert(0, os.path.abspath(LAMBDAS_DIR))
+
+        from common.telegram_api import TelegramClient
+        from common.telegram_utils import set_transport
+        from common.transport import InMemoryTransport
+
+        self.transport = InMemoryTransport()
+        set_transport(self.transport)
+        self.telegram = TelegramClient(read_timeout=POLL_TIMEOUT_SECONDS + 10)
+        self.validator = importlib.import_module('tg_message_validator')
+
+        for module_name, env_vars, batch_size in STAGES:
+            thread = threading.Thread(
+                target=self.work,
+                args=(importlib.import_module(module_name), [os.environ[v] for v in env_vars], batch_size),
+                name=module_name,
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        from common.telegram_utils import set_transport
+
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        set_transport(None)
+
+    def work(self, module, queue_urls, batch_size):
+        """Feed batches from the queues to a handler until stopped, redelivering failed records
+
+        Earlier queues are drained first, so small uploads don't wait behind large ones.
+        """
+        while not self.stopping.is_set():
+            for queue_url in queue_urls:
+                # Only block on the last queue, the others are just checked
+                wait_seconds = 0.5 if queue_url == queue_urls[-1] else 0
+                records = self.transport.receive(queue_url, batch_size, wait_seconds=wait_seconds)
+                if records:
+                    break
+            if not records:
+                continue
+
+            try:
+                response = module.lambda_handler({'Records': records}, None)
+                failed_ids = {f['itemIdentifier'] for f in (response or {}).get('batchItemFailures', [])}
+            except Exception as e:
+                print(f"Error in {module.__name__}: {str(e)}")
+                failed_ids = {record['messageId'] for record in records}
+
+            for record in records:
+                if record['messageId'] not in failed_ids:
+                    continue
+                if int(record['attributes']['ApproximateReceiveCount']) >= MAX_RECEIVE_COUNT:
+                    print(f"Dropping message after {MAX_RECEIVE_COUNT} attempts: {record['body']}")
+                else:
+                    self.transport.put(queue_url, record, RETRY_DELAY_SECONDS)
+
+    def handle_update(self, update):
+        """Pass an update to the validator and return its webhook response"""
+        return self.validator.lambda_handler({'body': json.dumps(update)}, None)
+
+    def process_update(self, update):
+        """Handle an update received without a webhook, making any inline reply call ourselves"""
+        response = self.handle_update(update)
+        reply = json.loads(response.get('body') or '{}')
+        if 'method' in reply:
+            method = reply.pop('method')
+            try:
+                self.telegram.call(method, reply)
+            except Exception as e:
+                print(f"Error sending inline reply: {str(e)}")
+        return response
+
+    def poll(self):
+        """Fetch updates with getUpdates long polling until stopped
+
+        Telegram refuses getUpdates while a webhook is set; remove it with
+        deleteWebhook first.
+        """
+        offset = None
+        while not self.stopping.is_set():
+            params = {'timeout': POLL_TIMEOUT_SECONDS}
+            if offset is not None:
+                params['offset'] = offset
+            try:
+                updates = self.telegram.call('getUpdates', params)
+            except Exception as e:
+                print(f"Error getting updates: {str(e)}")
+                time.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.process_update(update)
+
+    def serve_webhook(self, port, host='127.0.0.1'):
+        """Serve the webhook locally, answering like API Gateway would"""
+        monolith = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                response = monolith.validator.lambda_handler({'body': self.rfile.read(length).decode('utf-8')}, None)
+                body = (response.get('body') or '').encode('utf-8')
+                self.send_response(response.get('statusCode', 200))
+                for name, value in (response.get('headers') or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        # Single-threaded like one warm validator instance; the handlers keep per-instance state
+        server = HTTPServer((host, port), WebhookHandler)
+        print(f"Webhook listening on http://{host}:{server.server_address[1]}/", flush=True)
+        return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the bot pipeline in one process')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--poll', action='store_true', help='Get updates with getUpdates long polling')
+    source.add_argument('--webhook', type=int, metavar='PORT', help='Serve the webhook on this port')
+    parser.add_argument('--host', default='127.0.0.1', help='Address the webhook server binds to')
+    parser.add_argument('--moto', action='store_true', help='Run DynamoDB and S3 in-process with moto')
+    args = parser.parse_args(argv)
+
+    mock = start_moto() if args.moto else None
+    monolith = Monolith().start()
+    try:
+        if args.poll:
+            monolith.poll()
+        else:
+            monolith.serve_webhook(args.webhook, args.host).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monolith.stop()
+        if mock:
+            mock.stop()
+
+
+if __name__ == '__main__':
+    main()
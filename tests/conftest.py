@@ -0,0 +1,12 @@
+import os
+import pytest
+
+@pytest.fixture
+def aws_credentials():
+    """Mocked AWS Credentials for moto"""
+    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    os.environ['AWS_SECURITY_TOKEN'] = 'testing'
+    os.environ['AWS_SESSION_TOKEN'] = 'testing'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+    os.environ['TELEGRAM_BOT_TOKEN'] = 'test_token'
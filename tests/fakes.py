@@ -0,0 +1,67 @@
+"""Bot API and AWS stand-ins shared by the handler tests"""
+import io
+import json
+from botocore.exceptions import ClientError
+
+class FakeResponse(io.BytesIO):
+    """urllib3 response stand-in that can be read whole or streamed
+
+    Args:
+        status (int): HTTP status
+        body: Raw bytes, or a value to send as JSON
+    """
+    def __init__(self, status, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        super().__init__(body)
+        self.status = status
+        self.data = body
+        self.released = False
+
+    def release_conn(self):
+        self.released = True
+
+class FakeTelegram:
+    """Stand-in for urllib3.PoolManager playing the Bot API
+
+    Every URL called is kept in `requests`, sendMessage fields in `sent` and
+    answerCallbackQuery texts in `answers`. Queued `responses` are returned
+    first; otherwise calls succeed, with getFile and downloads served from `files`.
+    """
+    def __init__(self, files=None, responses=None):
+        self.files = files or {}
+        self.responses = responses or []
+        self.requests = []
+        self.sent = []
+        self.answers = []
+
+    def request(self, method, url, body=None, **kwargs):
+        self.requests.append(url)
+        name = url.rsplit('/', 1)[-1]
+        fields = json.loads(body) if body else {}
+        if name == 'sendMessage':
+            self.sent.append(fields)
+        elif name == 'answerCallbackQuery':
+            self.answers.append(fields.get('text'))
+
+        if self.responses:
+            return self.responses.pop(0)
+        if '/file/bot' in url:
+            if name not in self.files:
+                return FakeResponse(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return FakeResponse(200, self.files[name])
+        if name == 'getFile':
+            return FakeResponse(200, {'ok': True, 'result': {'file_path': f"files/{fields['file_id']}"}})
+        if name == 'sendMessage':
+            return FakeResponse(200, {'ok': True, 'result': {
+                'message_id': len(self.sent),
+                'from': {'id': 1, 'is_bot': True},
+                'chat': {'id': int(fields['chat_id'])},
+                'text': fields['text']
+            }})
+        return FakeResponse(200, {'ok': True, 'result': True})
+
+class ThrottledS3:
+    """S3 client stand-in whose reads are throttled"""
+    def get_object(self, **kwargs):
+        raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'}}, 'GetObject')
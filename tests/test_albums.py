@@ -0,0 +1,66 @@
+import pytest
+import boto3
+from moto import mock_aws
+from common.albums import expect_album_part, add_album_part, fail_album_part, claim_settled_album
+
+@pytest.fixture
+def state_table(aws_credentials):
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb')
+        yield dynamodb.create_table(
+            TableName='test-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+def test_album_settles_once_every_expected_file_is_uploaded(state_table):
+    for message_id in (10, 11, 12):
+        expect_album_part(state_table, 'album1', '789', message_id)
+    # 11 is a video, still uploading from the large upload queue
+    add_album_part(state_table, 'album1', '789', 12, '789/album1/12/photo.jpg')
+    add_album_part(state_table, 'album1', '789', 10, '789/album1/10/photo.jpg')
+
+    assert claim_settled_album(state_table, 'album1', 'check-a') is None
+
+    add_album_part(state_table, 'album1', '789', 11, '789/album1/11/video.mp4')
+    album = claim_settled_album(state_table, 'album1', 'check-b')
+
+    assert album['chat_id'] == '789'
+    assert [part['message_id'] for part in album['parts']] == [10, 11, 12]
+    assert album['parts'][0]['s3_key'] == '789/album1/10/photo.jpg'
+    assert claim_settled_album(state_table, 'album1', 'check-c') is None
+
+def test_retried_settle_check_claims_again(state_table):
+    expect_album_part(state_table, 'album2', '789', 10)
+    add_album_part(state_table, 'album2', '789', 10, 'a')
+
+    assert claim_settled_album(state_table, 'album2', 'check-a') is not None
+    # The reply was never sent, so SQS redelivers the same check
+    assert claim_settled_album(state_table, 'album2', 'check-a') is not None
+    assert claim_settled_album(state_table, 'album2', 'check-b') is None
+
+def test_failed_file_does_not_hold_back_the_album(state_table):
+    for message_id in (10, 11):
+        expect_album_part(state_table, 'album3', '789', message_id)
+    add_album_part(state_table, 'album3', '789', 10, 'a')
+    fail_album_part(state_table, 'album3', 11)
+
+    album = claim_settled_album(state_table, 'album3', 'check-a')
+
+    assert album['parts'] == [{'message_id': 10, 's3_key': 'a'}]
+
+def test_redelivered_file_is_counted_once(state_table):
+    expect_album_part(state_table, 'album4', '789', 10)
+    add_album_part(state_table, 'album4', '789', 10, 'a')
+    add_album_part(state_table, 'album4', '789', 10, 'a')
+
+    album = claim_settled_album(state_table, 'album4', 'check-a')
+
+    assert album['parts'] == [{'message_id': 10, 's3_key': 'a'}]
+
+def test_late_file_sees_the_album_was_handled(state_table):
+    add_album_part(state_table, 'album5', '789', 10, 'a')
+    claim_settled_album(state_table, 'album5', 'check-a')
+
+    assert add_album_part(state_table, 'album5', '789', 11, 'b').get('emitted')
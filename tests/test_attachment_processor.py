@@ -0,0 +1,213 @@
+import os
+import json
+import importlib
+import pytest
+import boto3
+from moto import mock_aws
+from common import payload, retries
+from fakes import FakeResponse, FakeTelegram, ThrottledS3
+
+class FailingTelegram:
+    """Stand-in for urllib3.PoolManager answering every call with an error"""
+    def __init__(self, status, description):
+        self.status = status
+        self.description = description
+
+    def request(self, method, url, body=None, **kwargs):
+        error = {'ok': False, 'error_code': self.status, 'description': self.description}
+        return FakeResponse(self.status, error)
+
+@pytest.fixture
+def processor(aws_credentials, monkeypatch):
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test-file-storage')
+        boto3.resource('dynamodb').create_table(
+            TableName='test-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        sqs = boto3.client('sqs')
+        monkeypatch.setenv('FILE_STORAGE_BUCKET', 'test-file-storage')
+        monkeypatch.setenv('STATE_TABLE', 'test-bot-state')
+        monkeypatch.setenv('PROCESSING_QUEUE_URL', sqs.create_queue(QueueName='test-processing-queue')['QueueUrl'])
+        monkeypatch.setenv('OUTGOING_QUEUE_URL', sqs.create_queue(QueueName='test-outgoing-queue')['QueueUrl'])
+        monkeypatch.setenv('UPLOAD_QUEUE_URL', sqs.create_queue(QueueName='test-upload-queue')['QueueUrl'])
+
+        import tg_attachment_processor
+        module = importlib.reload(tg_attachment_processor)
+        yield module
+
+def make_data(file_id, message_id=200):
+    return {
+        'chat_id': '789',
+        'message_id': message_id,
+        'media_group_id': None,
+        'file_info': {'type': 'document', 'file_id': file_id, 'file_unique_id': f'{file_id}_unique', 'file_name': f'{file_id}.bin'}
+    }
+
+def test_small_file_is_uploaded_in_one_put(processor):
+    processor.telegram.http = FakeTelegram({'small': b'x' * 1024})
+
+    key = processor.process_file(make_data('small'))
+
+    assert key == '789/no_media_group/200/small.bin'
+    body = processor.s3.get_object(Bucket='test-file-storage', Key=key)['Body'].read()
+    assert body == b'x' * 1024
+
+def test_large_file_is_streamed_in_parts(processor):
+    content = os.urandom(processor.UPLOAD_PART_SIZE * 2 + 123)
+    processor.telegram.http = FakeTelegram({'large': content})
+
+    key = processor.process_file(make_data('large'))
+
+    head = processor.s3.head_object(Bucket='test-file-storage', Key=key)
+    assert head['ContentLength'] == len(content)
+    assert head['ETag'].endswith('-3"')
+    assert processor.s3.get_object(Bucket='test-file-storage', Key=key)['Body'].read() == content
+
+def test_failed_multipart_upload_is_aborted(processor, monkeypatch):
+    processor.telegram.http = FakeTelegram({'large': b'x' * (processor.UPLOAD_PART_SIZE * 2)})
+
+    def failing_upload_part(**kwargs):
+        raise Exception('S3 unavailable')
+    monkeypatch.setattr(processor.s3, 'upload_part', failing_upload_part)
+
+    with pytest.raises(Exception, match='S3 unavailable'):
+        processor.process_file(make_data('large'))
+
+    assert processor.s3.list_multipart_uploads(Bucket='test-file-storage').get('Uploads', []) == []
+
+def test_repeated_file_is_copied_without_download(processor, monkeypatch):
+    # Deduplication through S3 markers, used without a state table
+    monkeypatch.setattr(processor, 'state_table', None)
+    processor.telegram.http = FakeTelegram({'meme': b'funny' * 100})
+    processor.process_file(make_data('meme', message_id=200))
+    requests_after_first = len(processor.telegram.http.requests)
+
+    key = processor.process_file(make_data('meme', message_id=201))
+
+    assert len(processor.telegram.http.requests) == requests_after_first
+    assert key == '789/no_media_group/201/meme.bin'
+    assert processor.s3.get_object(Bucket='test-file-storage', Key=key)['Body'].read() == b'funny' * 100
+
+def test_missing_source_falls_back_to_download(processor, monkeypatch):
+    # Deduplication through S3 markers, used without a state table
+    monkeypatch.setattr(processor, 'state_table', None)
+    processor.telegram.http = FakeTelegram({'doc': b'content'})
+    first_key = processor.process_file(make_data('doc', message_id=200))
+    processor.s3.delete_object(Bucket='test-file-storage', Key=first_key)
+
+    key = processor.process_file(make_data('doc', message_id=201))
+
+    assert processor.telegram.http.requests[-1].endswith('files/doc')
+    assert processor.s3.get_object(Bucket='test-file-storage', Key=key)['Body'].read() == b'content'
+
+def test_expired_cached_file_path_is_fetched_again(processor):
+    processor.telegram.http = FakeTelegram({'doc': b'content'})
+    processor.file_path_cache.set('doc', 'files/expired')
+
+    key = processor.process_file(make_data('doc'))
+
+    assert processor.s3.get_object(Bucket='test-file-storage', Key=key)['Body'].read() == b'content'
+    assert processor.file_path_cache.get('doc') == 'files/doc'
+
+def upload_records(processor):
+    """Take the messages waiting on the upload queue as Lambda event records"""
+    sqs = processor.telegram_utils.sqs
+    queue_url = os.environ['UPLOAD_QUEUE_URL']
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+    for message in messages:
+        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+    return [
+        {'messageId': message['MessageId'], 'body': message['Body'], 'eventSourceARN': queue_arn}
+        for message in messages
+    ]
+
+def queue_attribute(processor, env_var, name):
+    sqs = processor.telegram_utils.sqs
+    return int(sqs.get_queue_attributes(QueueUrl=os.environ[env_var], AttributeNames=[name])['Attributes'][name])
+
+def send_upload(processor, data):
+    processor.telegram_utils.sqs.send_message(QueueUrl=os.environ['UPLOAD_QUEUE_URL'], MessageBody=payload.encode(data))
+
+def test_transient_failure_is_requeued_with_delay(processor):
+    processor.telegram.http = FailingTelegram(502, 'Bad Gateway')
+    send_upload(processor, make_data('doc'))
+
+    response = processor.lambda_handler({'Records': upload_records(processor)}, None)
+
+    assert response['batchItemFailures'] == []
+    assert queue_attribute(processor, 'UPLOAD_QUEUE_URL', 'ApproximateNumberOfMessagesDelayed') == 1
+    assert queue_attribute(processor, 'OUTGOING_QUEUE_URL', 'ApproximateNumberOfMessages') == 0
+
+def test_user_is_told_once_retries_are_used_up(processor, monkeypatch):
+    monkeypatch.setattr(retries, 'BASE_DELAY_SECONDS', 0)
+    monkeypatch.setattr(retries, 'MAX_ATTEMPTS', 3)
+    processor.telegram.http = FailingTelegram(500, 'Internal Server Error')
+    send_upload(processor, make_data('doc'))
+
+    attempts = 0
+    while records := upload_records(processor):
+        attempts += 1
+        assert payload.decode(records[0]['body']).get('attempt', 0) == attempts - 1
+        processor.lambda_handler({'Records': records}, None)
+
+    assert attempts == 3
+    assert queue_attribute(processor, 'OUTGOING_QUEUE_URL', 'ApproximateNumberOfMessages') == 1
+
+def test_permanent_failure_is_reported_without_retry(processor):
+    processor.telegram.http = FailingTelegram(400, 'Bad Request: file is too big')
+    send_upload(processor, make_data('doc'))
+
+    response = processor.lambda_handler({'Records': upload_records(processor)}, None)
+
+    assert response['batchItemFailures'] == []
+    assert queue_attribute(processor, 'UPLOAD_QUEUE_URL', 'ApproximateNumberOfMessagesDelayed') == 0
+    outgoing = processor.telegram_utils.sqs.receive_message(QueueUrl=os.environ['OUTGOING_QUEUE_URL'])['Messages']
+    assert 'file is too big' in payload.decode(outgoing[0]['Body'])['message']
+
+def test_transient_failure_without_source_queue_is_left_to_sqs(processor):
+    processor.telegram.http = FailingTelegram(429, 'Too Many Requests')
+    record = {'messageId': 'm1', 'body': payload.encode(make_data('doc'))}
+
+    response = processor.lambda_handler({'Records': [record]}, None)
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm1'}]
+
+def test_claim_check_read_error_is_left_to_sqs(processor, monkeypatch):
+    monkeypatch.setattr(payload, 'get_s3', lambda: ThrottledS3())
+    record = {'messageId': 'm1', 'body': json.dumps({payload.VERSION_KEY: payload.PAYLOAD_VERSION, 's3': {'b': 'test-file-storage', 'k': 'payloads/missing.json'}})}
+
+    response = processor.lambda_handler({'Records': [record]}, None)
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm1'}]
+
+def test_malformed_body_is_dropped(processor):
+    record = {'messageId': 'm1', 'body': '{not json'}
+
+    response = processor.lambda_handler({'Records': [record]}, None)
+
+    assert response['batchItemFailures'] == []
+
+def test_uploads_are_indexed_and_deduplicated_through_the_index(processor):
+    table = processor.state_table
+    processor.telegram.http = FakeTelegram({'meme': b'funny' * 100})
+    data = make_data('meme', message_id=200)
+    data['file_info']['file_size'] = 500
+    send_upload(processor, data)
+    send_upload(processor, make_data('meme', message_id=201))
+
+    processor.lambda_handler({'Records': upload_records(processor)}, None)
+
+    first = table.get_item(Key={'pk': 'attachment#789#200'})['Item']
+    assert first['s3_key'] == '789/no_media_group/200/meme.bin'
+    assert first['size'] == 500
+    assert first['status'] == 'uploaded'
+    assert table.get_item(Key={'pk': 'attachment#789#201'})['Item']['s3_key'] == '789/no_media_group/201/meme.bin'
+    assert table.get_item(Key={'pk': 'file#meme_unique'})['Item']['s3_key'] == '789/no_media_group/201/meme.bin'
+    # The second file was copied, not downloaded again, and no S3 marker was written
+    assert sum(url.endswith('files/meme') for url in processor.telegram.http.requests) == 1
+    assert not processor.s3.list_objects_v2(Bucket='test-file-storage', Prefix=processor.DEDUP_PREFIX).get('KeyCount')
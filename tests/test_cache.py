@@ -0,0 +1,58 @@
+import time
+import pytest
+import boto3
+from moto import mock_aws
+from common.cache import TTLCache, DynamoDBTTLCache, TieredCache
+
+@pytest.fixture
+def state_table(aws_credentials):
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb')
+        yield dynamodb.create_table(
+            TableName='test-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(ttl_seconds=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl_seconds=0)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+
+def test_shared_tier_fills_local_tier(state_table):
+    shared = DynamoDBTTLCache(state_table, 'file_path', ttl_seconds=60)
+    shared.set('file1', 'photos/file_1.jpg')
+    cache = TieredCache(TTLCache(), shared)
+
+    assert cache.get('file1') == 'photos/file_1.jpg'
+    assert cache.local.get('file1') == 'photos/file_1.jpg'
+
+def test_local_tier_keeps_only_the_shared_items_remaining_ttl(state_table):
+    state_table.put_item(Item={'pk': 'file_path#file1', 'value': 'photos/file_1.jpg', 'ttl': int(time.time()) + 5})
+    cache = TieredCache(TTLCache(ttl_seconds=3000), DynamoDBTTLCache(state_table, 'file_path', ttl_seconds=3000))
+
+    assert cache.get('file1') == 'photos/file_1.jpg'
+    _, expires_at = cache.local.entries['file1']
+    assert expires_at - time.monotonic() <= 5
+
+    cache.delete('file1')
+    assert cache.get('file1') is None
+
+def test_shared_tier_ignores_expired_items(state_table):
+    state_table.put_item(Item={'pk': 'file_path#old', 'value': 'x', 'ttl': int(time.time()) - 1})
+
+    assert DynamoDBTTLCache(state_table, 'file_path').get('old') is None
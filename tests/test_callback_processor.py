@@ -0,0 +1,99 @@
+import json
+import importlib
+import pytest
+import boto3
+from moto import mock_aws
+from common.attachments import record_upload
+from fakes import FakeTelegram
+
+@pytest.fixture
+def processor(aws_credentials, monkeypatch):
+    with mock_aws():
+        table = boto3.resource('dynamodb').create_table(
+            TableName='test-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        boto3.client('s3').create_bucket(Bucket='test-file-storage')
+        sqs = boto3.client('sqs')
+        monkeypatch.setenv('STATE_TABLE', table.name)
+        monkeypatch.setenv('FILE_STORAGE_BUCKET', 'test-file-storage')
+        monkeypatch.setenv('OUTGOING_QUEUE_URL', sqs.create_queue(QueueName='test-outgoing-queue')['QueueUrl'])
+
+        import tg_callback_processor
+        module = importlib.reload(tg_callback_processor)
+        module.telegram.http = FakeTelegram()
+        yield module
+
+def upload(processor, message_id, media_group_id=None, file_unique_id=None):
+    key = f"789/{media_group_id or 'no_media_group'}/{message_id}/photo.jpg"
+    processor.s3.put_object(Bucket='test-file-storage', Key=key, Body=b'photo')
+    record_upload(processor.state_table, '789', message_id, key, size=5,
+                  file_unique_id=file_unique_id, media_group_id=media_group_id)
+    return key
+
+def press(processor, data, chat_id=789):
+    record = {'body': json.dumps({
+        'callback_id': 'cb1', 'chat_id': chat_id, 'message_id': 1000, 'user_id': 123, 'data': data
+    })}
+    processor.lambda_handler({'Records': [record]}, None)
+    return processor.telegram.http.answers[-1]
+
+def stored_keys(processor):
+    return [obj['Key'] for obj in processor.s3.list_objects_v2(Bucket='test-file-storage').get('Contents', [])]
+
+def status(processor, message_id):
+    return processor.state_table.get_item(Key={'pk': f"attachment#789#{message_id}"})['Item']['status']
+
+def test_confirm_marks_file_confirmed(processor):
+    upload(processor, 10)
+
+    assert press(processor, 'confirm_10') == '✅ File confirmed!'
+    assert status(processor, 10) == 'confirmed'
+
+def test_delete_removes_file_and_its_dedup_entry(processor):
+    upload(processor, 10, file_unique_id='u10')
+    keep = upload(processor, 11)
+
+    assert press(processor, 'delete_10') == '🗑 Deleted'
+    assert stored_keys(processor) == [keep]
+    assert status(processor, 10) == 'deleted'
+    assert 'Item' not in processor.state_table.get_item(Key={'pk': 'file#u10'})
+
+    assert press(processor, 'delete_10') == 'File not found or already deleted'
+    assert press(processor, 'confirm_10') == 'File not found'
+
+def test_delete_album_removes_every_file_in_one_call(processor, monkeypatch):
+    for message_id in (20, 21, 22):
+        upload(processor, message_id, media_group_id='album1')
+    calls = []
+    delete_objects = processor.s3.delete_objects
+    monkeypatch.setattr(processor.s3, 'delete_objects', lambda **kwargs: calls.append(kwargs) or delete_objects(**kwargs))
+
+    assert press(processor, 'delete_album_album1') == '🗑 Deleted'
+    assert len(calls) == 1
+    assert stored_keys(processor) == []
+    assert [status(processor, message_id) for message_id in (20, 21, 22)] == ['deleted'] * 3
+
+def test_files_of_other_chats_are_not_found(processor):
+    upload(processor, 10)
+    upload(processor, 20, media_group_id='album1')
+
+    assert press(processor, 'delete_10', chat_id=111) == 'File not found or already deleted'
+    assert press(processor, 'delete_album_album1', chat_id=111) == 'File not found or already deleted'
+    assert len(stored_keys(processor)) == 2
+
+def test_index_entries_expire_with_the_files(processor, monkeypatch):
+    from common import attachments
+    upload(processor, 10, media_group_id='album1', file_unique_id='u10')
+
+    for pk in ('attachment#789#10', 'file#u10', 'attachment_album#album1'):
+        item = processor.state_table.get_item(Key={'pk': pk})['Item']
+        assert int(item['ttl']) > attachments.time.time() + attachments.FILE_RETENTION_SECONDS - 60
+
+    # Until DynamoDB removes them, expired entries are treated as gone
+    monkeypatch.setattr(attachments, 'FILE_RETENTION_SECONDS', -1)
+    upload(processor, 11, file_unique_id='u11')
+    assert press(processor, 'confirm_11') == 'File not found'
+    assert attachments.find_upload(processor.state_table, 'u11') is None
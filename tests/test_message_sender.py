@@ -0,0 +1,250 @@
+import os
+import json
+import importlib
+import pytest
+import boto3
+from moto import mock_aws
+from common import payload
+from fakes import FakeResponse, FakeTelegram, ThrottledS3
+
+@pytest.fixture
+def sender(aws_credentials):
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb')
+        table = dynamodb.create_table(
+            TableName='test-message-logs',
+            KeySchema=[
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        os.environ['MESSAGE_LOGS_TABLE'] = table.name
+        sqs = boto3.client('sqs')
+        os.environ['OUTGOING_QUEUE_URL'] = sqs.create_queue(QueueName='test-outgoing-queue')['QueueUrl']
+
+        import tg_message_sender
+        module = importlib.reload(tg_message_sender)
+        module.telegram.http = FakeTelegram()
+        yield module
+
+def make_event(*messages):
+    return {'Records': [{'messageId': str(i), 'body': json.dumps(m)} for i, m in enumerate(messages)]}
+
+def get_requeued(sender):
+    response = sender.telegram_utils.sqs.receive_message(
+        QueueUrl=os.environ['OUTGOING_QUEUE_URL'],
+        MaxNumberOfMessages=10,
+        AttributeNames=['All']
+    )
+    return [payload.decode(msg['Body']) for msg in response.get('Messages', [])]
+
+def test_second_message_to_chat_is_deferred(sender):
+    sender.COALESCE_MESSAGES = False
+    event = make_event(
+        {'chat_id': 789, 'message': 'first'},
+        {'chat_id': 789, 'message': 'second'},
+        {'chat_id': 790, 'message': 'other chat'}
+    )
+
+    response = sender.lambda_handler(event, None)
+
+    assert response['batchItemFailures'] == []
+    assert sorted(f['text'] for f in sender.telegram.http.sent) == ['first', 'other chat']
+    # Requeued with a delay, so it is not visible yet
+    assert get_requeued(sender) == []
+
+def test_deferred_messages_are_staggered(sender):
+    sender.COALESCE_MESSAGES = False
+    sender.scheduler = sender.RateLimitScheduler(global_rate=1e9, chat_rate=1)
+    items = [({'messageId': str(i)}, {'chat_id': 789, 'message': str(i)}) for i in range(4)]
+
+    results = sender.send_chat_messages(789, sender.plan_chat_messages(items))
+
+    deferred = [(message['message'], delay) for _, message, outcome, delay in results if outcome == 'deferred']
+    assert [text for text, _ in deferred] == ['1', '2', '3']
+    # One send slot apart, so they come back in order and one at a time
+    assert [later - earlier for (_, earlier), (_, later) in zip(deferred, deferred[1:])] == [pytest.approx(1)] * 2
+
+def test_429_honours_retry_after(sender):
+    sender.telegram.http.responses = [FakeResponse(429, {
+        'ok': False,
+        'error_code': 429,
+        'description': 'Too Many Requests: retry after 5',
+        'parameters': {'retry_after': 5}
+    })]
+
+    sender.lambda_handler(make_event({'chat_id': 789, 'message': 'hello'}), None)
+
+    assert sender.scheduler.reserve(789) >= 4
+
+def test_failed_send_reports_rest_of_chat(sender):
+    sender.COALESCE_MESSAGES = False
+    sender.scheduler = sender.RateLimitScheduler(global_rate=1e9, chat_rate=1e9)
+    sender.telegram.http.responses = [
+        FakeResponse(200, {'ok': True, 'result': {'message_id': 1, 'from': {'id': 1}, 'chat': {'id': 789}, 'text': 'a'}}),
+        FakeResponse(502, {'ok': False, 'description': 'Bad Gateway'}),
+    ]
+    event = make_event(
+        {'chat_id': 789, 'message': 'a'},
+        {'chat_id': 789, 'message': 'b'},
+        {'chat_id': 789, 'message': 'c'}
+    )
+
+    response = sender.lambda_handler(event, None)
+
+    # 'c' is not sent ahead of 'b', both are redelivered
+    assert [f['text'] for f in sender.telegram.http.sent] == ['a', 'b']
+    assert response['batchItemFailures'] == [{'itemIdentifier': '1'}, {'itemIdentifier': '2'}]
+
+def test_malformed_record_does_not_fail_the_batch(sender):
+    event = make_event({'chat_id': 789, 'message': 'ok'}, {'chat_id': 790})
+
+    response = sender.lambda_handler(event, None)
+
+    assert [f['text'] for f in sender.telegram.http.sent] == ['ok']
+    assert response['batchItemFailures'] == []
+
+def test_claim_check_read_error_is_left_to_sqs(sender, monkeypatch):
+    monkeypatch.setattr(payload, 'get_s3', lambda: ThrottledS3())
+    record = {'messageId': 'm1', 'body': json.dumps({payload.VERSION_KEY: payload.PAYLOAD_VERSION, 's3': {'b': 'test-file-storage', 'k': 'payloads/missing.json'}})}
+
+    response = sender.lambda_handler({'Records': [record]}, None)
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm1'}]
+
+def test_malformed_body_is_dropped(sender):
+    record = {'messageId': 'm1', 'body': '{not json'}
+
+    response = sender.lambda_handler({'Records': [record]}, None)
+
+    assert response['batchItemFailures'] == []
+
+def test_error_in_one_chat_fails_only_its_records(sender, monkeypatch):
+    plan = sender.plan_chat_messages
+
+    def failing_plan(items):
+        if items[0][1]['chat_id'] == 790:
+            raise RuntimeError('boom')
+        return plan(items)
+
+    monkeypatch.setattr(sender, 'plan_chat_messages', failing_plan)
+    event = make_event({'chat_id': 789, 'message': 'ok'}, {'chat_id': 790, 'message': 'fails'})
+
+    response = sender.lambda_handler(event, None)
+
+    assert [f['text'] for f in sender.telegram.http.sent] == ['ok']
+    assert response['batchItemFailures'] == [{'itemIdentifier': '1'}]
+
+def test_only_records_not_requeued_fail(sender, monkeypatch):
+    sender.COALESCE_MESSAGES = False
+
+    class RejectingSQS:
+        """Accepts the first entry of a batch and rejects the rest"""
+        def send_message_batch(self, QueueUrl, Entries):
+            return {
+                'Successful': [{'Id': Entries[0]['Id']}],
+                'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidParameterValue'} for entry in Entries[1:]]
+            }
+
+    monkeypatch.setattr(sender.telegram_utils.sqs_batch_sender, 'sqs', RejectingSQS())
+    event = make_event(
+        {'chat_id': 789, 'message': 'first'},
+        {'chat_id': 789, 'message': 'second'},
+        {'chat_id': 789, 'message': 'third'}
+    )
+
+    response = sender.lambda_handler(event, None)
+
+    assert [f['text'] for f in sender.telegram.http.sent] == ['first']
+    assert response['batchItemFailures'] == [{'itemIdentifier': '2'}]
+
+def test_blocked_chat_is_not_retried(sender):
+    sender.telegram.http.responses = [FakeResponse(403, {'ok': False, 'description': 'Forbidden: bot was blocked by the user'})]
+
+    response = sender.lambda_handler(make_event({'chat_id': 789, 'message': 'hello'}), None)
+
+    assert response['batchItemFailures'] == []
+
+def test_group_chat_has_per_minute_limit():
+    from tg_message_sender import RateLimitScheduler
+    scheduler = RateLimitScheduler(global_rate=1e9, chat_rate=1e9, group_rate_per_minute=3)
+
+    assert [scheduler.reserve(-100) == 0 for _ in range(4)] == [True, True, True, False]
+    assert scheduler.reserve(100) == 0
+
+def test_notices_are_coalesced_without_stacking_keyboards(sender):
+    sender.scheduler = sender.RateLimitScheduler(global_rate=1e9, chat_rate=1e9)
+    confirm = lambda i: {'inline_keyboard': [[{'text': '✅ Confirm', 'callback_data': f"confirm_{i}"}]]}
+    event = make_event(
+        {'chat_id': 789, 'message': 'Processing photo0.jpg', 'reply_to_message_id': 100},
+        {'chat_id': 789, 'message': 'Uploaded photo0.jpg', 'reply_markup': confirm(100)},
+        {'chat_id': 789, 'message': 'Uploaded photo1.jpg', 'reply_markup': confirm(101)},
+    )
+
+    response = sender.lambda_handler(event, None)
+
+    assert response['batchItemFailures'] == []
+    sent = sender.telegram.http.sent
+    assert len(sent) == 2
+    assert sent[0]['text'] == 'Processing photo0.jpg\n\nUploaded photo0.jpg'
+    assert sent[0]['reply_to_message_id'] == 100
+    assert [row[0]['callback_data'] for message in sent for row in message['reply_markup']['inline_keyboard']] == [
+        'confirm_100', 'confirm_101'
+    ]
+
+def test_group_replies_to_different_messages_are_not_merged():
+    from tg_message_sender import can_merge
+    first = {'chat_id': -100, 'message': 'a', 'reply_to_message_id': 1}
+
+    assert not can_merge(first, {'chat_id': -100, 'message': 'b', 'reply_to_message_id': 2})
+    assert can_merge(first, {'chat_id': -100, 'message': 'b', 'reply_to_message_id': 1})
+    assert can_merge(first, {'chat_id': -100, 'message': 'b'})
+    assert can_merge(dict(first, chat_id=789), {'chat_id': 789, 'message': 'b', 'reply_to_message_id': 2})
+
+def test_long_message_is_split(sender):
+    sender.scheduler = sender.RateLimitScheduler(global_rate=1e9, chat_rate=1e9)
+    text = '<b>' + ' '.join(['word'] * 2000) + '</b>'
+
+    response = sender.lambda_handler(make_event({'chat_id': 789, 'message': text, 'reply_to_message_id': 5}), None)
+
+    assert response['batchItemFailures'] == []
+    sent = sender.telegram.http.sent
+    assert len(sent) == 3
+    assert all(len(part['text']) <= 4096 for part in sent)
+    assert all(part['text'].startswith('<b>') and part['text'].endswith('</b>') for part in sent)
+    assert [part.get('reply_to_message_id') for part in sent] == [5, None, None]
+    assert ' '.join(part['text'][3:-4] for part in sent) == ' '.join(['word'] * 2000)
+
+def test_split_never_breaks_tags_or_entities():
+    from tg_message_sender import split_html
+    text = 'a &amp; <a href="https://example.com">link</a> ' * 50
+
+    parts = split_html(text, limit=100)
+
+    assert all(len(part) <= 100 for part in parts)
+    for part in parts:
+        assert part.count('<a ') == part.count('</a>')
+        assert '&amp' not in part.replace('&amp;', '')
+
+def test_split_keeps_preformatted_whitespace():
+    from tg_message_sender import split_html
+    code = '\n'.join(f'    line {i}' for i in range(40))
+    text = f'<pre>{code}</pre>'
+
+    parts = split_html(text, limit=100)
+
+    assert len(parts) > 1
+    assert all(part.startswith('<pre>') and part.endswith('</pre>') for part in parts)
+    assert ''.join(part[5:-6] for part in parts) == code
+
+def test_group_chat_slot_follows_per_minute_limit():
+    from tg_message_sender import RateLimitScheduler
+    scheduler = RateLimitScheduler(chat_rate=1, group_rate_per_minute=20)
+
+    assert scheduler.slot_seconds(789) == 1
+    assert scheduler.slot_seconds(-100) == 3
@@ -3,7 +3,8 @@ import json
 import pytest
 import boto3
 from moto import mock_aws
-from tg_message_validator import lambda_handler
+from tg_message_validator import lambda_handler, load_static_commands
+from common import payload
 
 # Test data
 TEXT_MESSAGE = {
@@ -49,6 +50,30 @@ DOCUMENT_MESSAGE = {
     })
 }
 
+START_COMMAND = {
+    'body': json.dumps({
+        'message': {
+            'message_id': 127,
+            'from': {'id': 456, 'is_bot': False},
+            'chat': {'id': 789},
+            'text': '/start'
+        }
+    })
+}
+
+def make_album_message(message_id, file_id):
+    return {
+        'body': json.dumps({
+            'message': {
+                'message_id': message_id,
+                'from': {'id': 456, 'is_bot': False},
+                'chat': {'id': 789},
+                'media_group_id': 'album1',
+                'photo': [{'file_id': file_id, 'file_unique_id': f'{file_id}_unique', 'file_size': 1024}]
+            }
+        })
+    }
+
 CALLBACK_QUERY = {
     'body': json.dumps({
         'callback_query': {
@@ -65,17 +90,7 @@ CALLBACK_QUERY = {
 }
 
 @pytest.fixture
-def aws_credentials():
-    """Mocked AWS Credentials for moto"""
-    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
-    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
-    os.environ['AWS_SECURITY_TOKEN'] = 'testing'
-    os.environ['AWS_SESSION_TOKEN'] = 'testing'
-    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
-    os.environ['TELEGRAM_BOT_TOKEN'] = 'test_token'
-
-@pytest.fixture
-def dynamodb(aws_credentials):
+def dynamodb(aws_credentials, monkeypatch):
     with mock_aws():
         dynamodb = boto3.resource('dynamodb')
         
@@ -102,11 +117,20 @@ def dynamodb(aws_credentials):
             BillingMode='PAY_PER_REQUEST'
         )
         
-        os.environ['MESSAGE_LOGS_TABLE'] = table.name
+        monkeypatch.setenv('MESSAGE_LOGS_TABLE', table.name)
+        
+        # Create bot state table
+        state_table = dynamodb.create_table(
+            TableName='test-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        monkeypatch.setenv('STATE_TABLE', state_table.name)
         yield dynamodb
 
 @pytest.fixture
-def sqs(aws_credentials):
+def sqs(aws_credentials, monkeypatch):
     with mock_aws():
         sqs = boto3.client('sqs')
         
@@ -114,15 +138,17 @@ def sqs(aws_credentials):
         queues = {
             'processing': sqs.create_queue(QueueName='test-processing-queue'),
             'upload': sqs.create_queue(QueueName='test-upload-queue'),
+            'large_upload': sqs.create_queue(QueueName='test-large-upload-queue'),
             'callback': sqs.create_queue(QueueName='test-callback-queue'),
             'outgoing': sqs.create_queue(QueueName='test-outgoing-queue')
         }
         
         # Set environment variables
-        os.environ['PROCESSING_QUEUE_URL'] = queues['processing']['QueueUrl']
-        os.environ['UPLOAD_QUEUE_URL'] = queues['upload']['QueueUrl']
-        os.environ['CALLBACK_QUEUE_URL'] = queues['callback']['QueueUrl']
-        os.environ['OUTGOING_QUEUE_URL'] = queues['outgoing']['QueueUrl']
+        monkeypatch.setenv('PROCESSING_QUEUE_URL', queues['processing']['QueueUrl'])
+        monkeypatch.setenv('UPLOAD_QUEUE_URL', queues['upload']['QueueUrl'])
+        monkeypatch.setenv('LARGE_UPLOAD_QUEUE_URL', queues['large_upload']['QueueUrl'])
+        monkeypatch.setenv('CALLBACK_QUEUE_URL', queues['callback']['QueueUrl'])
+        monkeypatch.setenv('OUTGOING_QUEUE_URL', queues['outgoing']['QueueUrl'])
         
         yield sqs
 
@@ -132,7 +158,7 @@ def get_sqs_messages(sqs, queue_url):
         QueueUrl=queue_url,
         MaxNumberOfMessages=10
     )
-    return [json.loads(msg['Body']) for msg in response.get('Messages', [])]
+    return [payload.decode(msg['Body']) for msg in response.get('Messages', [])]
 
 def test_text_message(dynamodb, sqs):
     # Process text message
@@ -192,4 +218,165 @@ def test_callback_query(dynamodb, sqs):
     messages = get_sqs_messages(sqs, os.environ['CALLBACK_QUEUE_URL'])
     assert len(messages) == 1
     assert messages[0]['callback_id'] == 'callback123'
-    assert messages[0]['data'] == 'test_callback' 
\ No newline at end of file
+    assert messages[0]['data'] == 'test_callback' 
+
+def test_album_gets_one_processing_notice(dynamodb, sqs):
+    for message_id in range(130, 133):
+        response = lambda_handler(make_album_message(message_id, f'photo{message_id}'), None)
+        assert response['statusCode'] == 200
+    
+    # Every photo is uploaded, but only the first one is acknowledged
+    assert len(get_sqs_messages(sqs, os.environ['UPLOAD_QUEUE_URL'])) == 3
+    notices = get_sqs_messages(sqs, os.environ['OUTGOING_QUEUE_URL'])
+    assert len(notices) == 1
+    assert notices[0]['reply_to_message_id'] == 130
+    # The album waits for every file, whichever upload queue it went to
+    album = dynamodb.Table(os.environ['STATE_TABLE']).get_item(Key={'pk': 'album#album1'})['Item']
+    assert album['expected'] == {130, 131, 132}
+
+def test_start_command_is_answered_inline(dynamodb, sqs):
+    response = lambda_handler(START_COMMAND, None)
+    assert response['statusCode'] == 200
+    
+    # Reply is a sendMessage call in the webhook response
+    reply = json.loads(response['body'])
+    assert reply['method'] == 'sendMessage'
+    assert reply['chat_id'] == '789'
+    assert reply['reply_to_message_id'] == 127
+    assert 'Welcome' in reply['text']
+    assert get_sqs_messages(sqs, os.environ['OUTGOING_QUEUE_URL']) == []
+    
+    # Both the command and the reply are logged
+    table = dynamodb.Table(os.environ['MESSAGE_LOGS_TABLE'])
+    items = table.scan()['Items']
+    assert sorted(item['message_type'] for item in items) == ['bot_message', 'user_message']
+
+def test_static_commands_are_configurable(monkeypatch, tmp_path):
+    assert set(load_static_commands()) == {'/start', '/help'}
+
+    monkeypatch.setenv('STATIC_COMMANDS', json.dumps({'/about': 'About this bot'}))
+    assert load_static_commands() == {'/about': 'About this bot'}
+
+    commands_file = tmp_path / 'commands.json'
+    commands_file.write_text(json.dumps({'/faq': 'Frequently asked questions'}))
+    monkeypatch.delenv('STATIC_COMMANDS')
+    monkeypatch.setenv('STATIC_COMMANDS_FILE', str(commands_file))
+    assert load_static_commands() == {'/faq': 'Frequently asked questions'}
+
+    commands_file.write_text(json.dumps(['/faq']))
+    with pytest.raises(ValueError):
+        load_static_commands()
+
+def test_redelivered_update_is_acknowledged_without_work(dynamodb, sqs):
+    update = {
+        'body': json.dumps({
+            'update_id': 1001,
+            'message': {
+                'message_id': 128,
+                'from': {'id': 456, 'is_bot': False},
+                'chat': {'id': 789},
+                'text': 'Hello again'
+            }
+        })
+    }
+    
+    assert lambda_handler(update, None)['statusCode'] == 200
+    response = lambda_handler(update, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['status'] == 'duplicate'
+    
+    # Processed once
+    assert len(get_sqs_messages(sqs, os.environ['PROCESSING_QUEUE_URL'])) == 1
+    table = dynamodb.Table(os.environ['MESSAGE_LOGS_TABLE'])
+    assert len(table.scan()['Items']) == 1
+
+def make_document_update(update_id, message_id, file_size):
+    return {
+        'body': json.dumps({
+            'update_id': update_id,
+            'message': {
+                'message_id': message_id,
+                'from': {'id': 123, 'is_bot': False},
+                'chat': {'id': 789},
+                'document': {
+                    'file_id': f"doc{message_id}",
+                    'file_unique_id': f"doc{message_id}_u",
+                    'file_name': 'video.mp4',
+                    'mime_type': 'application/octet-stream',
+                    'file_size': file_size
+                }
+            }
+        })
+    }
+
+def test_large_file_goes_to_large_upload_queue(dynamodb, sqs):
+    response = lambda_handler(make_document_update(301, 140, 10 * 1024 * 1024), None)
+
+    assert response['statusCode'] == 200
+    assert get_sqs_messages(sqs, os.environ['UPLOAD_QUEUE_URL']) == []
+    messages = get_sqs_messages(sqs, os.environ['LARGE_UPLOAD_QUEUE_URL'])
+    assert [m['message_id'] for m in messages] == [140]
+
+def test_oversized_file_is_rejected_inline(dynamodb, sqs):
+    response = lambda_handler(make_document_update(302, 141, 25 * 1024 * 1024), None)
+
+    reply = json.loads(response['body'])
+    assert reply['method'] == 'sendMessage'
+    assert reply['reply_to_message_id'] == 141
+    assert '20 MB' in reply['text']
+    for queue in ('UPLOAD_QUEUE_URL', 'LARGE_UPLOAD_QUEUE_URL', 'OUTGOING_QUEUE_URL'):
+        assert get_sqs_messages(sqs, os.environ[queue]) == []
+
+def flood(count, first_update_id):
+    return [
+        lambda_handler({'body': json.dumps({
+            'update_id': first_update_id + i,
+            'message': {'message_id': 500 + i, 'from': {'id': 321, 'is_bot': False}, 'chat': {'id': 321}, 'text': 'spam'}
+        })}, None)
+        for i in range(count)
+    ]
+
+def test_updates_over_the_user_limit_are_dropped(dynamodb, sqs, monkeypatch):
+    import tg_message_validator as validator
+    validator.get_aws_resources()
+    monkeypatch.setattr(validator, 'throttle', validator.Throttle(2, 0, 60, table=validator.state_table))
+
+    responses = flood(4, first_update_id=9000)
+
+    assert [json.loads(r['body'])['status'] for r in responses] == ['ok', 'ok', 'throttled', 'throttled']
+    assert len(get_sqs_messages(sqs, os.environ['PROCESSING_QUEUE_URL'])) == 2
+
+def test_deprioritised_updates_are_delayed(dynamodb, sqs, monkeypatch):
+    import tg_message_validator as validator
+    validator.get_aws_resources()
+    monkeypatch.setattr(validator, 'throttle', validator.Throttle(1, 0, 60, table=validator.state_table))
+    monkeypatch.setattr(validator, 'THROTTLE_ACTION', 'deprioritise')
+
+    responses = flood(2, first_update_id=9100)
+
+    assert [json.loads(r['body'])['status'] for r in responses] == ['ok', 'ok']
+    attributes = sqs.get_queue_attributes(QueueUrl=os.environ['PROCESSING_QUEUE_URL'], AttributeNames=['All'])['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '1'
+    assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+def test_redeliveries_are_not_counted_against_the_limits(dynamodb, sqs, monkeypatch):
+    import tg_message_validator as validator
+    validator.get_aws_resources()
+    monkeypatch.setattr(validator, 'throttle', validator.Throttle(1, 0, 60, table=validator.state_table))
+    update = {'update_id': 9200, 'message': {'message_id': 600, 'from': {'id': 322, 'is_bot': False}, 'chat': {'id': 322}, 'text': 'hi'}}
+
+    # A released update is counted once, however often Telegram redelivers it
+    assert validator.shed_action(update) is None
+    assert validator.shed_action(update) is None
+    assert validator.shed_action(dict(update, update_id=9201)) == 'drop'
+
+def test_known_redelivery_skips_the_throttle(dynamodb, sqs, monkeypatch):
+    import tg_message_validator as validator
+    update = {'body': json.dumps({
+        'update_id': 9300,
+        'message': {'message_id': 700, 'from': {'id': 323, 'is_bot': False}, 'chat': {'id': 323}, 'text': 'hi'}
+    })}
+    assert json.loads(lambda_handler(update, None)['body'])['status'] == 'ok'
+    monkeypatch.setattr(validator, 'shed_action', lambda body: pytest.fail('throttled a known redelivery'))
+
+    assert json.loads(lambda_handler(update, None)['body'])['status'] == 'duplicate'
@@ -0,0 +1,43 @@
+import json
+from common import metrics
+from common.metrics import timed, instrument_handler
+
+def emitted_lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+
+def handler(event, context):
+    with timed('json.parse'):
+        pass
+    with timed('dynamodb.put'):
+        pass
+    with timed('dynamodb.put'):
+        pass
+    return 'done'
+
+def test_sampled_invocation_emits_emf(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, 'SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(metrics, '_cold_start', False)
+
+    assert instrument_handler(handler)({}, None) == 'done'
+
+    lines = {line['stage']: line for line in emitted_lines(capsys)}
+    assert set(lines) == {'json.parse', 'dynamodb.put', 'handler'}
+    assert len(lines['dynamodb.put']['duration']) == 2
+    assert lines['handler']['start_type'] == 'warm'
+    assert lines['handler']['_aws']['CloudWatchMetrics'][0]['Metrics'] == [{'Name': 'duration', 'Unit': 'Milliseconds'}]
+
+def test_cold_start_reports_init(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, 'SAMPLE_RATE', 0.0001)
+    monkeypatch.setattr(metrics, '_cold_start', True)
+    wrapped = instrument_handler(handler)
+
+    wrapped({}, None)
+    lines = emitted_lines(capsys)
+    assert {'init', 'handler'} <= {line['stage'] for line in lines}
+    assert all(line['start_type'] == 'cold' for line in lines)
+
+def test_disabled_metrics_emit_nothing(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, 'SAMPLE_RATE', 0)
+
+    assert instrument_handler(handler)({}, None) == 'done'
+    assert emitted_lines(capsys) == []
@@ -0,0 +1,43 @@
+from common.models import Message
+
+PHOTO_MESSAGE = {
+    'message_id': 7,
+    'from': {'id': 123, 'is_bot': False},
+    'chat': {'id': -456},
+    'date': 1700000000,
+    'media_group_id': 'album-1',
+    'caption': 'holiday',
+    'photo': [
+        {'file_id': 'small', 'file_unique_id': 'u-small', 'file_size': 100},
+        {'file_id': 'large', 'file_unique_id': 'u-large', 'file_size': 1000}
+    ]
+}
+
+def test_parse_picks_largest_photo_and_stringifies_ids():
+    message = Message.parse(PHOTO_MESSAGE)
+
+    assert message.user_id == '123'
+    assert message.chat_id == '-456'
+    assert message.is_valid
+    assert message.file_info.type == 'photo'
+    assert message.file_info.file_id == 'large'
+    assert message.file_info.media_group_id == 'album-1'
+
+def test_queue_dict_and_log_item_share_file_info():
+    message = Message.parse(PHOTO_MESSAGE)
+
+    data = message.to_queue_dict()
+    item = message.to_log_item()
+
+    assert data['sender_id'] == '123'
+    assert data['file_info']['photo'] is PHOTO_MESSAGE['photo']
+    assert item['message'] == 'holiday'
+    assert item['media_group_id'] == 'album-1'
+    assert item['file_info'] is data['file_info']
+
+def test_message_without_sender_is_invalid():
+    message = Message.parse({'message_id': 1, 'chat': {'id': 1}, 'text': 'hi'})
+
+    assert not message.is_valid
+    assert message.file_info is None
+    assert 'file_info' not in message.to_queue_dict()
@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import urllib3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+from fake_telegram import FakeTelegramServer
+
+RUNNER = os.path.join(os.path.dirname(__file__), '..', 'monolith', 'runner.py')
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_webhook_update_is_answered_without_sqs():
+    telegram = FakeTelegramServer().start()
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN='1:test', TELEGRAM_API_URL=telegram.url)
+    for key in ('UPLOAD_QUEUE_URL', 'PROCESSING_QUEUE_URL', 'CALLBACK_QUEUE_URL', 'OUTGOING_QUEUE_URL'):
+        env.pop(key, None)
+    # Run in a subprocess so the runner's moto session and Lambda imports stay isolated
+    runner = subprocess.Popen(
+        [sys.executable, RUNNER, '--webhook', '0', '--moto'],
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True
+    )
+    try:
+        webhook_url = runner.stdout.readline().split()[-1]
+        http = urllib3.PoolManager()
+        update = {'update_id': 1, 'message': {
+            'message_id': 10,
+            'from': {'id': 123, 'is_bot': False},
+            'chat': {'id': 123},
+            'date': int(time.time()),
+            'text': 'hello'
+        }}
+
+        response = http.request('POST', webhook_url, body=json.dumps(update))
+
+        assert response.status == 200
+        assert wait_for(lambda: ('sendMessage', ('123', '10')) in telegram.replies)
+    finally:
+        runner.terminate()
+        runner.wait()
+        telegram.stop()
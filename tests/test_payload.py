@@ -0,0 +1,73 @@
+import os
+import json
+import pytest
+import boto3
+from moto import mock_aws
+from common import payload
+from common.models import Message
+
+PHOTO_MESSAGE = {
+    'message_id': 7,
+    'from': {'id': 123, 'is_bot': False},
+    'chat': {'id': 456},
+    'caption': 'holiday',
+    'photo': [
+        {'file_id': 'small', 'file_unique_id': 'u-small', 'file_size': 100},
+        {'file_id': 'large', 'file_unique_id': 'u-large', 'file_size': 1000}
+    ]
+}
+
+@pytest.fixture
+def payload_bucket(aws_credentials, monkeypatch):
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='test-payloads')
+        monkeypatch.setattr(payload, '_s3', s3)
+        monkeypatch.setattr(payload, 'PAYLOAD_BUCKET', 'test-payloads')
+        yield s3
+
+def test_user_message_round_trip_drops_raw_attachment():
+    data = Message.parse(PHOTO_MESSAGE).to_queue_dict()
+
+    body = payload.encode(data)
+    decoded = payload.decode(body)
+
+    assert len(body) < len(json.dumps(data)) / 2
+    expected_file_info = {k: v for k, v in data['file_info'].items() if k != 'photo'}
+    assert decoded == {**data, 'file_info': expected_file_info}
+
+def test_legacy_messages_decode_unchanged():
+    legacy = {'chat_id': 1, 'message': 'hi', 'reply_to_message_id': None}
+
+    assert payload.decode(json.dumps(legacy)) == legacy
+
+def test_outgoing_message_keeps_its_fields():
+    message = {'chat_id': '1', 'message': '', 'reply_markup': {'inline_keyboard': []}}
+
+    assert payload.decode(payload.encode(message)) == message
+
+def test_long_text_is_compressed():
+    data = {'chat_id': '1', 'message': 'spam ' * 2000}
+
+    body = payload.encode(data)
+
+    assert '"z"' in body
+    assert len(body) < 2000
+    assert payload.decode(body) == data
+
+def test_large_message_is_offloaded_to_s3(payload_bucket, monkeypatch):
+    monkeypatch.setattr(payload, 'MAX_INLINE_BYTES', 1024)
+    data = {'chat_id': '1', 'message': os.urandom(2048).hex()}
+
+    body = payload.encode(data)
+
+    assert len(body) < 200
+    assert payload_bucket.list_objects_v2(Bucket='test-payloads', Prefix='payloads/')['KeyCount'] == 1
+    assert payload.decode(body) == data
+
+def test_large_message_without_bucket_raises(monkeypatch):
+    monkeypatch.setattr(payload, 'MAX_INLINE_BYTES', 1024)
+    monkeypatch.setattr(payload, 'PAYLOAD_BUCKET', None)
+
+    with pytest.raises(Exception, match='PAYLOAD_BUCKET'):
+        payload.encode({'chat_id': '1', 'message': os.urandom(2048).hex()})
@@ -0,0 +1,25 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+def test_benchmark_answers_every_update():
+    # Run in a subprocess so the benchmark's moto session and Lambda imports stay isolated
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.pipeline_benchmark', '--updates', '30', '--global-rate', '1000', '--chat-rate', '1000', '--timeout', '60', '--json'],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    # Handler log lines may come first, the report is the last JSON document
+    output = '\n' + result.stdout
+    report = json.loads(output[output.rindex('\n{\n'):])
+    
+    assert report['updates'] == 30
+    assert report['unanswered'] == 0
+    for stage in ('webhook', 'message_processor', 'message_sender', 'attachment_processor', 'callback_processor'):
+        assert report['stages'][stage]['invocations'] > 0
+    assert report['end_to_end']['final_reply']['p50_ms'] is not None
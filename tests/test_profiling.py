@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import subprocess
+from common import profiling
+from common.profiling import profile_handler
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+class Context:
+    def __init__(self, request_id):
+        self.aws_request_id = request_id
+
+def handler(event, context):
+    return sorted(json.loads(json.dumps(list(range(1000)))))[-1]
+
+def test_disabled_profiling_writes_nothing(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, 'SAMPLE_RATE', 0)
+    monkeypatch.setattr(profiling, 'OUTPUT', str(tmp_path))
+
+    assert profile_handler(handler)({}, Context('r1')) == 999
+    assert list(tmp_path.iterdir()) == []
+
+def test_sampled_invocations_are_written_and_merged(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, 'SAMPLE_RATE', 1)
+    monkeypatch.setattr(profiling, 'MODES', {'cpu', 'memory'})
+    monkeypatch.setattr(profiling, 'OUTPUT', str(tmp_path))
+    wrapped = profile_handler(handler)
+
+    assert wrapped({}, Context('r1')) == 999
+    assert wrapped({}, Context('r2')) == 999
+
+    files = sorted(path.name.split('-', 1)[1] for path in (tmp_path / 'test_profiling').iterdir())
+    assert files == ['r1.json', 'r1.prof', 'r2.json', 'r2.prof']
+
+    merged = tmp_path / 'merged.prof'
+    result = subprocess.run(
+        [sys.executable, '-m', 'tools.merge_profiles', str(tmp_path), '--json', '--output', str(merged)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    report = json.loads(result.stdout)['test_profiling']
+    assert report['invocations'] == 2
+    assert report['peak_rss_max_kb'] > 0
+    assert report['traced_peak_max_bytes'] > 0
+
+    import pstats
+    calls = {func[2]: stat[1] for func, stat in pstats.Stats(str(merged)).stats.items()}
+    assert calls['handler'] == 2
@@ -0,0 +1,36 @@
+import pytest
+from botocore.exceptions import ClientError
+from urllib3.exceptions import ReadTimeoutError
+from common import retries
+from common.telegram_api import TelegramError, TelegramRateLimitError, TelegramBadRequestError
+
+def client_error(code, status):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'PutObject')
+
+@pytest.mark.parametrize('error, transient', [
+    (TelegramError(502, 'Bad Gateway'), True),
+    (TelegramRateLimitError(429, 'Too Many Requests', {'retry_after': 3}), True),
+    (TelegramBadRequestError(400, 'Bad Request: file is too big'), False),
+    (client_error('SlowDown', 503), True),
+    (client_error('InternalError', 500), True),
+    (client_error('AccessDenied', 403), False),
+    (ReadTimeoutError(None, None, 'Read timed out'), True),
+    (KeyError('file_id'), False),
+])
+def test_errors_are_classified(error, transient):
+    assert retries.is_transient(error) == transient
+
+def test_delay_grows_and_is_capped():
+    for attempt in range(1, 10):
+        delay = retries.BASE_DELAY_SECONDS * 2 ** (attempt - 1)
+        expected = min(delay, retries.MAX_DELAY_SECONDS)
+        assert expected // 2 <= retries.retry_delay(TelegramError(502, 'Bad Gateway'), attempt) <= expected
+
+def test_delay_honours_retry_after():
+    error = TelegramRateLimitError(429, 'Too Many Requests', {'retry_after': 30})
+    assert retries.retry_delay(error, 1) == 31
+
+def test_queue_url_from_arn():
+    assert retries.queue_url_from_arn('arn:aws:sqs:eu-west-1:123456789012:upload') == \
+        'https://sqs.eu-west-1.amazonaws.com/123456789012/upload'
+    assert retries.queue_url_from_arn('memory://upload') == 'memory://upload'
@@ -0,0 +1,21 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+def test_handlers_create_no_aws_clients_during_init():
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup_benchmark', '--runs', '1', '--clients', '--json'],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    report = json.loads(result.stdout)
+
+    assert len(report) == 5
+    for handler, stats in report.items():
+        assert stats['created_during_init'] == [], handler
+        assert stats['init_p50_ms'] > 0
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+import pytest
+from common.telegram_api import (
+    TelegramClient, TelegramError, TelegramRateLimitError,
+    TelegramBadRequestError, TelegramForbiddenError
+)
+from fakes import FakeResponse
+
+class FakeHttp:
+    """Stand-in for urllib3.PoolManager answering every call after a delay"""
+    def __init__(self, response=None, delay=0):
+        self.response = response
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        with self.lock:
+            self.requests.append((url, json.loads(body), headers))
+            message_id = len(self.requests)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return self.response or FakeResponse(200, {'ok': True, 'result': {'message_id': message_id}})
+
+@pytest.fixture
+def client():
+    client = TelegramClient(token='test_token', api_url='https://telegram.test')
+    client.http = FakeHttp()
+    return client
+
+def test_send_message_posts_json(client):
+    result = client.send_message(789, 'hi', reply_to_message_id=5, reply_markup={'inline_keyboard': []})
+
+    url, params, headers = client.http.requests[0]
+    assert result == {'message_id': 1}
+    assert url == 'https://telegram.test/bottest_token/sendMessage'
+    assert headers['Content-Type'] == 'application/json'
+    assert params == {
+        'chat_id': 789, 'text': 'hi', 'parse_mode': 'HTML',
+        'reply_to_message_id': 5, 'reply_markup': {'inline_keyboard': []}
+    }
+
+@pytest.mark.parametrize('status, payload, error_class, permanent', [
+    (429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 7}},
+     TelegramRateLimitError, False),
+    (400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'},
+     TelegramBadRequestError, True),
+    (403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'},
+     TelegramForbiddenError, True),
+    (502, {'ok': False, 'description': 'Bad Gateway'}, TelegramError, False),
+])
+def test_errors_are_structured(client, status, payload, error_class, permanent):
+    client.http.response = FakeResponse(status, payload)
+
+    with pytest.raises(error_class) as error:
+        client.send_message(789, 'hi')
+
+    assert type(error.value) is error_class
+    assert error.value.is_permanent == permanent
+    if status == 429:
+        assert error.value.retry_after == 7
+    if status == 400:
+        assert error.value.chat_not_found
+
+def test_call_many_runs_concurrently_and_keeps_order(client):
+    client.http.delay = 0.05
+    calls = [('sendMessage', {'chat_id': i, 'text': str(i)}) for i in range(8)]
+
+    start = time.perf_counter()
+    results = client.call_many(calls, max_concurrency=4)
+
+    assert time.perf_counter() - start < 0.05 * 8 / 2
+    assert client.http.max_in_flight == 4
+    assert len(results) == 8
+    assert sorted(result['message_id'] for result in results) == list(range(1, 9))
+
+def test_call_many_returns_errors_in_place(client):
+    client.http.response = FakeResponse(403, {'ok': False, 'error_code': 403, 'description': 'Forbidden'})
+
+    results = client.call_many([('sendMessage', {'chat_id': 1, 'text': 'a'})])
+
+    assert isinstance(results[0], TelegramForbiddenError)
@@ -0,0 +1,163 @@
+import os
+import pytest
+import boto3
+from moto import mock_aws
+from common.telegram_utils import TelegramUtils, SQSBatchSender, DynamoDBBatchWriter
+from common import payload
+
+@pytest.fixture
+def sqs(aws_credentials):
+    with mock_aws():
+        sqs = boto3.client('sqs')
+        os.environ['OUTGOING_QUEUE_URL'] = sqs.create_queue(QueueName='test-outgoing-queue')['QueueUrl']
+        yield sqs
+
+@pytest.fixture
+def dynamodb(aws_credentials):
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb')
+        table = dynamodb.create_table(
+            TableName='test-message-logs',
+            KeySchema=[
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        os.environ['MESSAGE_LOGS_TABLE'] = table.name
+        yield dynamodb
+
+class FlakySQS:
+    """SQS client stub that fails the first entry of the first batch call"""
+    def __init__(self):
+        self.calls = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append([entry['Id'] for entry in Entries])
+        if len(self.calls) == 1:
+            return {'Failed': [{'Id': Entries[0]['Id'], 'SenderFault': False, 'Code': 'InternalError'}]}
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+class ThrottledSQS:
+    """SQS client stub that raises for one queue"""
+    def __init__(self, failing_queue):
+        self.failing_queue = failing_queue
+        self.sent = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if QueueUrl == self.failing_queue:
+            raise Exception('Throttling')
+        self.sent.append((QueueUrl, len(Entries)))
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+def get_all_sqs_messages(sqs, queue_url):
+    """Helper to drain messages from SQS queue"""
+    messages = []
+    while True:
+        response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+        if not response.get('Messages'):
+            return messages
+        messages.extend(payload.decode(msg['Body']) for msg in response['Messages'])
+
+def test_batch_sends_flushes_on_exit(sqs):
+    telegram_utils = TelegramUtils()
+    queue_url = os.environ['OUTGOING_QUEUE_URL']
+
+    with telegram_utils.batch_sends():
+        for i in range(5):
+            telegram_utils.send_to_sqs(queue_url, {'n': i})
+        assert get_all_sqs_messages(sqs, queue_url) == []
+
+    messages = get_all_sqs_messages(sqs, queue_url)
+    assert sorted(m['n'] for m in messages) == list(range(5))
+
+def test_batches_respect_entry_and_size_limits():
+    sender = SQSBatchSender(sqs=None)
+    entries = [{'MessageBody': 'x' * 100 * 1024} for _ in range(3)] + [{'MessageBody': 'y'}] * 12
+
+    batches = list(sender._split_batches(entries))
+
+    assert [len(b) for b in batches] == [2, 10, 3]
+    for batch in batches:
+        assert sum(len(e['MessageBody']) for e in batch) <= SQSBatchSender.MAX_BATCH_BYTES
+
+def test_only_failed_entries_are_retried():
+    client = FlakySQS()
+    sender = SQSBatchSender(client)
+
+    for i in range(3):
+        sender.add('queue', {'n': i})
+    sender.flush()
+
+    assert client.calls == [['0', '1', '2'], ['0']]
+
+def test_failed_queue_does_not_hold_back_or_leave_buffers():
+    client = ThrottledSQS('q1')
+    sender = SQSBatchSender(client)
+    sender.add('q1', {'n': 1})
+    sender.add('q2', {'n': 2})
+
+    with pytest.raises(Exception):
+        sender.flush()
+
+    assert client.sent == [('q2', 1)]
+    assert sender.buffers == {}
+    sender.flush()
+    assert client.sent == [('q2', 1)]
+
+def test_send_reports_unsent_positions():
+    class RejectingSQS:
+        """Rejects the fourth entry of the first batch and throttles every later batch"""
+        def __init__(self):
+            self.calls = 0
+
+        def send_message_batch(self, QueueUrl, Entries):
+            self.calls += 1
+            if self.calls == 1:
+                return {'Failed': [{'Id': '3', 'SenderFault': True, 'Code': 'InvalidParameterValue'}]}
+            raise Exception('Throttling')
+
+    sender = SQSBatchSender(RejectingSQS())
+    failed = sender.send('queue', [({'n': i}, None) for i in range(12)])
+
+    assert failed == [3, 10, 11]
+    assert sender.buffers == {}
+
+def test_batch_sends_discards_when_body_raises(sqs):
+    telegram_utils = TelegramUtils()
+    queue_url = os.environ['OUTGOING_QUEUE_URL']
+
+    with pytest.raises(ValueError):
+        with telegram_utils.batch_sends():
+            telegram_utils.send_to_sqs(queue_url, {'n': 1})
+            raise ValueError('handler failed')
+
+    assert telegram_utils.sqs_batch_sender.buffers == {}
+    assert get_all_sqs_messages(sqs, queue_url) == []
+
+def test_batch_logs_writes_on_exit(dynamodb, sqs):
+    telegram_utils = TelegramUtils()
+    table = dynamodb.Table(os.environ['MESSAGE_LOGS_TABLE'])
+
+    with telegram_utils.batch_logs():
+        for i in range(30):
+            telegram_utils.log_message({
+                'message_id': i,
+                'from': {'id': i, 'is_bot': True},
+                'chat': {'id': 789},
+                'text': f'Message {i}'
+            }, message_type='bot_message')
+        # The first 25 items fill a batch and are written early
+        assert len(table.scan()['Items']) == 25
+
+    assert len(table.scan()['Items']) == 30
+
+def test_batch_writer_keeps_duplicate_keys_apart():
+    writer = DynamoDBBatchWriter(dynamodb=None, table_name='logs')
+    items = [{'user_id': '1', 'timestamp': 't1'}, {'user_id': '1', 'timestamp': 't1'}, {'user_id': '2', 'timestamp': 't1'}]
+
+    assert [len(b) for b in writer._split_batches(items)] == [1, 2]
@@ -0,0 +1,56 @@
+import pytest
+import boto3
+from moto import mock_aws
+from common.throttle import LocalWindowCounter, Throttle
+
+@pytest.fixture
+def state_table(aws_credentials):
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb')
+        yield dynamodb.create_table(
+            TableName='test-bot-state',
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+def test_previous_window_fades_out():
+    counter = LocalWindowCounter(window_seconds=60)
+    for _ in range(10):
+        counter.hit('user#1', now=60)
+
+    assert counter.estimate('user#1', now=119) == 10
+    assert counter.estimate('user#1', now=150) == pytest.approx(5)
+    assert counter.estimate('user#1', now=180) == 0
+
+def test_limit_is_enforced_per_user():
+    throttle = Throttle(user_limit=3, chat_limit=0, window_seconds=60)
+
+    assert [throttle.allow(1, 1, now=10) for _ in range(5)] == [True, True, True, False, False]
+    assert throttle.allow(2, 2, now=10)
+    # Refused updates aren't counted, so the user is let through again as the window slides
+    assert throttle.allow(1, 1, now=100)
+
+def test_chat_limit_covers_all_members():
+    throttle = Throttle(user_limit=10, chat_limit=2, window_seconds=60)
+
+    assert [throttle.allow(user_id, -100, now=10) for user_id in (1, 2, 3)] == [True, True, False]
+
+def test_instances_share_counts_through_dynamodb(state_table):
+    first = Throttle(user_limit=4, chat_limit=0, window_seconds=60, table=state_table)
+    second = Throttle(user_limit=4, chat_limit=0, window_seconds=60, table=state_table)
+
+    results = [throttle.allow(1, 1, now=10) for throttle in (first, second, first, second, first)]
+
+    assert results == [True, True, True, True, False]
+
+def test_warm_tier_refuses_without_dynamodb(state_table, monkeypatch):
+    throttle = Throttle(user_limit=1, chat_limit=0, window_seconds=60, table=state_table)
+    throttle.allow(1, 1, now=10)
+    throttle.allow(1, 1, now=10)
+
+    def fail(**kwargs):
+        raise AssertionError('DynamoDB called')
+    monkeypatch.setattr(throttle.shared.table, 'update_item', fail)
+
+    assert not throttle.allow(1, 1, now=11)
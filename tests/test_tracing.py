@@ -0,0 +1,39 @@
+import os
+from common import metrics, tracing
+
+def test_trace_follows_message_across_hops(monkeypatch):
+    monkeypatch.setitem(os.environ, 'UPLOAD_QUEUE_URL', 'https://sqs/upload-queue')
+    monkeypatch.setitem(os.environ, 'PROCESSING_QUEUE_URL', 'https://sqs/processing-queue')
+    recorder = metrics.Recorder('test', cold_start=False)
+    monkeypatch.setattr(metrics, '_current', recorder)
+
+    # Webhook
+    trace = tracing.begin({'message_id': 1, 'date': 1700000000})
+    upload_message = tracing.stamp({'chat_id': '789'}, 'https://sqs/upload-queue')
+    assert trace['ingress'] == 1700000000 * 1000
+
+    # Attachment processor
+    tracing.receive(upload_message)
+    processing_message = tracing.stamp(upload_message, 'https://sqs/processing-queue')
+
+    hops = processing_message[tracing.TRACE_KEY]['hops']
+    assert [hop['q'] for hop in hops] == ['upload', 'processing']
+    assert 'deq' in hops[0] and 'deq' not in hops[1]
+    assert processing_message[tracing.TRACE_KEY]['id'] == trace['id']
+    assert {'hop_processing.webhook', 'queue_dwell.upload', 'hop_processing.upload'} <= set(recorder.durations)
+
+def test_new_messages_inherit_current_trace():
+    trace = tracing.begin()
+    reply = tracing.stamp({'chat_id': '789', 'message': 'hi'}, 'https://sqs/outgoing')
+
+    assert reply[tracing.TRACE_KEY]['id'] == trace['id']
+
+def test_reply_latency_is_recorded(monkeypatch):
+    recorder = metrics.Recorder('test', cold_start=False)
+    monkeypatch.setattr(metrics, '_current', recorder)
+    tracing.begin({'date': 1700000000})
+    message = tracing.stamp({'chat_id': '789', 'message': 'hi'}, 'https://sqs/outgoing')
+
+    tracing.reply_sent(message)
+
+    assert set(recorder.durations) >= {'reply_latency', 'reply_latency_from_ingress'}
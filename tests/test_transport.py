@@ -0,0 +1,24 @@
+import time
+from common.transport import InMemoryTransport
+
+def test_receive_returns_batches_in_order():
+    transport = InMemoryTransport()
+    for i in range(3):
+        transport.send('memory://q', str(i))
+
+    records = transport.receive('memory://q', max_messages=2, wait_seconds=0)
+
+    assert [r['body'] for r in records] == ['0', '1']
+    assert records[0]['attributes']['ApproximateReceiveCount'] == '1'
+    assert transport.pending('memory://q') == 1
+
+def test_delayed_message_waits_until_due():
+    transport = InMemoryTransport()
+    transport.send('memory://q', 'later', delay_seconds=0.2)
+
+    assert transport.receive('memory://q', wait_seconds=0) == []
+    start = time.monotonic()
+    records = transport.receive('memory://q', wait_seconds=2)
+
+    assert [r['body'] for r in records] == ['later']
+    assert time.monotonic() - start < 1
@@ -0,0 +1,173 @@
+"""Merge the profiles written by common/profiling.py across invocations.
+
+Reads the `.prof` pstats dumps and `.json` summaries of one or more
+functions from a local directory or an S3 prefix, prints the hottest
+functions of all invocations together, the duration and peak RSS spread,
+and the allocation sites that held the most memory.
+
+    python -m tools.merge_profiles /tmp/profiles
+    python -m tools.merge_profiles s3://my-bucket/profiles/ --function tg_message_sender --sort tottime
+    python -m tools.merge_profiles s3://my-bucket/profiles/ --since 20260101 --output merged.prof
+"""
+import argparse
+import json
+import marshal
+import os
+import pstats
+import sys
+
+from benchmarks.stats import percentile
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def list_local(directory):
+    """(function, name, loader) of every profile file under directory"""
+    for function in sorted(os.listdir(directory)):
+        function_dir = os.path.join(directory, function)
+        if not os.path.isdir(function_dir):
+            continue
+        for name in sorted(os.listdir(function_dir)):
+            yield function, name, lambda path=os.path.join(function_dir, name): read_file(path)
+
+
+def list_s3(url):
+    """(function, name, loader) of every profile file under an s3:// prefix"""
+    import boto3
+
+    s3 = boto3.client('s3')
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            function, _, name = obj['Key'][len(prefix):].partition('/')
+            if not name or '/' in name:
+                continue
+            yield function, name, lambda key=obj['Key']: s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def load(sources, functions=None, since=None):
+    """Read the matching profiles
+
+    Returns:
+        tuple: (list of pstats dicts, list of summary dicts)
+    """
+    stats, summaries = [], []
+    for source in sources:
+        files = list_s3(source) if source.startswith('s3://') else list_local(source)
+        for function, name, read in files:
+            if functions and function not in functions:
+                continue
+            # Names start with the invocation's UTC time, e.g. 20260101T120000-<request id>
+            if since and name[:len(since)] < since:
+                continue
+            if name.endswith('.prof'):
+                stats.append(marshal.loads(read()))
+            elif name.endswith('.json'):
+                summaries.append(json.loads(read()))
+    return stats, summaries
+
+
+class Dump:
+    """A loaded pstats dump, in the shape pstats.Stats accepts profilers in"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def merge_stats(stats):
+    """Combine pstats dumps into one pstats.Stats, or None if there are none"""
+    merged = None
+    for raw in stats:
+        profile = pstats.Stats(Dump(raw))
+        if merged is None:
+            merged = profile
+        else:
+            merged.add(profile)
+    return merged
+
+
+def summarize(summaries, top):
+    """Per-function invocation count, duration and peak RSS spread, and the heaviest allocation sites"""
+    by_function = {}
+    for summary in summaries:
+        by_function.setdefault(summary['function'], []).append(summary)
+
+    report = {}
+    for function, items in sorted(by_function.items()):
+        durations = [item['duration_ms'] for item in items]
+        rss = [item['peak_rss_kb'] for item in items]
+        allocations = {}
+        for item in items:
+            for allocation in item.get('top_allocations', []):
+                site = allocations.setdefault(allocation['location'], {'size': 0, 'count': 0, 'invocations': 0})
+                site['size'] += allocation['size']
+                site['count'] += allocation['count']
+                site['invocations'] += 1
+        report[function] = {
+            'invocations': len(items),
+            'duration_p50_ms': percentile(durations, 50),
+            'duration_p95_ms': percentile(durations, 95),
+            'duration_max_ms': max(durations),
+            'peak_rss_max_kb': max(rss),
+            'traced_peak_max_bytes': max((item.get('traced_peak_bytes', 0) for item in items), default=0),
+            'top_allocations': sorted(
+                ({'location': location, **site} for location, site in allocations.items()),
+                key=lambda site: -site['size']
+            )[:top],
+        }
+    return report
+
+
+def print_summary(report):
+    for function, stats in report.items():
+        print(f"{function}: {stats['invocations']} invocations, duration p50 {stats['duration_p50_ms']} ms, "
+              f"p95 {stats['duration_p95_ms']} ms, max {stats['duration_max_ms']} ms, "
+              f"peak RSS {stats['peak_rss_max_kb'] / 1024:.1f} MB")
+        if stats['top_allocations']:
+            print(f"  traced peak {stats['traced_peak_max_bytes'] / 1024:.1f} KB; largest live allocations, summed over invocations:")
+            for site in stats['top_allocations']:
+                print(f"  {site['size'] / 1024:>10.1f} KB {site['count']:>8} blocks {site['invocations']:>5}x  {site['location']}")
+        print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge handler profiles across invocations')
+    parser.add_argument('sources', nargs='+', help='Local profile directories or s3://bucket/prefix')
+    parser.add_argument('--function', action='append', help='Only profiles of this function (repeatable)')
+    parser.add_argument('--since', help='Only invocations at or after this UTC time prefix, e.g. 20260101 or 20260101T12')
+    parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. cumulative, tottime, ncalls')
+    parser.add_argument('--limit', type=int, default=30, help='Functions and allocation sites to show')
+    parser.add_argument('--output', help='Also write the merged pstats dump here, for snakeviz and the like')
+    parser.add_argument('--json', action='store_true', help='Print the summaries as JSON instead')
+    args = parser.parse_args(argv)
+
+    stats, summaries = load(args.sources, args.function, args.since)
+    if not stats and not summaries:
+        print('No profiles found', file=sys.stderr)
+        return 1
+
+    report = summarize(summaries, args.limit)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_summary(report)
+
+    merged = merge_stats(stats)
+    if merged is not None:
+        if args.output:
+            merged.dump_stats(args.output)
+        if not args.json:
+            print(f"CPU profile of {len(stats)} invocations:")
+            merged.sort_stats(args.sort).print_stats(args.limit)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())